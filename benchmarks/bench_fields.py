@@ -0,0 +1,91 @@
+"""
+Micro-benchmarks of the per-value conversions done by fields: `to_python` (parsing a value
+read from the database), `validate`, and `to_db_string` (formatting a value for writing).
+These run once for every cell that is read or written, so each field type is measured separately.
+"""
+from enum import Enum
+
+import pytz
+
+from infi.clickhouse_orm.fields import *
+
+from .runner import benchmark
+
+
+VALUES = 1000
+
+
+class Fruit(Enum):
+    apple = 1
+    banana = 2
+    orange = 3
+
+
+def _cycle(values, n=VALUES):
+    return [values[i % len(values)] for i in range(n)]
+
+
+# For each case: the field, and sample values as they are returned by ClickHouse in TSV
+CASES = dict(
+    string=(StringField(), ['hello', 'caf\xe9 au lait', 'with\ttab']),
+    fixed_string=(FixedStringField(12), ['hello', 'world']),
+    date=(DateField(), ['2020-01-31', '1999-12-01']),
+    datetime=(DateTimeField(), ['2020-01-31 12:34:56', '1999-12-01 00:00:00']),
+    datetime_epoch=(DateTimeField(), ['1580474096', '1044006400']),
+    datetime_tz=(DateTimeField(timezone='Asia/Jerusalem'), ['2020-01-31 12:34:56', '2020-07-01 23:59:59']),
+    datetime64=(DateTime64Field(precision=3), ['2020-01-31 12:34:56.789', '1999-12-01 00:00:00.000']),
+    uint8=(UInt8Field(), ['0', '17', '255']),
+    int8=(Int8Field(), ['-128', '0', '127']),
+    uint16=(UInt16Field(), ['0', '1234', '65535']),
+    int16=(Int16Field(), ['-32768', '0', '12345']),
+    uint32=(UInt32Field(), ['0', '123456', '4294967295']),
+    int32=(Int32Field(), ['-2147483648', '0', '123456']),
+    uint64=(UInt64Field(), ['18446744073709551615', '0', '123456789']),
+    int64=(Int64Field(), ['-9223372036854775808', '0', '123456789']),
+    float32=(Float32Field(), ['1.5', '-0.25', '3.14159']),
+    float64=(Float64Field(), ['1.5', '-0.25', '2.718281828459045']),
+    decimal=(DecimalField(18, 4), ['12345678901234.5678', '-0.0001']),
+    decimal32=(Decimal32Field(4), ['12345.6789', '-0.0001']),
+    decimal64=(Decimal64Field(6), ['123456789.123456', '-1.5']),
+    decimal128=(Decimal128Field(10), ['1234567890123456.0123456789', '0']),
+    enum8=(Enum8Field(Fruit), ['apple', 'banana', 'orange']),
+    enum16=(Enum16Field(Fruit), ['apple', 'banana', 'orange']),
+    array_of_ints=(ArrayField(Int32Field()), ['[1,2,3,4,5]', '[]', '[-1]']),
+    array_of_strings=(ArrayField(StringField()), ["['a','b\\'c','d']", '[]']),
+    nullable_int=(NullableField(Int32Field()), ['\\N', '42', '-7']),
+    nullable_string=(NullableField(StringField()), ['\\N', 'hello']),
+    low_cardinality=(LowCardinalityField(StringField()), ['red', 'green', 'blue']),
+    uuid=(UUIDField(), ['12345678-1234-5678-1234-567812345678', '00000000-0000-0000-0000-000000000000']),
+    ipv4=(IPv4Field(), ['192.168.1.1', '10.0.0.255']),
+    ipv6=(IPv6Field(), ['2001:db8::1', '::ffff:192.168.1.1']),
+)
+
+
+def _make_benchmarks(case, field, db_values):
+    db_values = _cycle(db_values)
+    # Like Model.from_tsv, use the field's own timezone when it has one
+    timezone = getattr(field, 'timezone', None) or pytz.utc
+
+    @benchmark(rows=VALUES)
+    def to_python():
+        return lambda: [field.to_python(v, timezone) for v in db_values]
+
+    python_values = [field.to_python(v, timezone) for v in db_values]
+
+    @benchmark(rows=VALUES)
+    def validate():
+        return lambda: [field.validate(v) for v in python_values]
+
+    @benchmark(rows=VALUES)
+    def to_db_string():
+        return lambda: [field.to_db_string(v) for v in python_values]
+
+    return {
+        '%s_to_python' % case: to_python,
+        '%s_validate' % case: validate,
+        '%s_to_db_string' % case: to_db_string,
+    }
+
+
+for _case, (_field, _db_values) in CASES.items():
+    globals().update(_make_benchmarks(_case, _field, _db_values))
@@ -0,0 +1,123 @@
+"""
+Benchmarks of the ORM's hot paths: inserting and selecting model instances through the
+HTTP interface (served by the in-process stand-in), converting rows to and from TSV,
+generating SQL for querysets, and parsing arrays.
+"""
+import random
+from datetime import date, timedelta
+
+from infi.clickhouse_orm.database import Database
+from infi.clickhouse_orm.engines import MergeTree
+from infi.clickhouse_orm.fields import *
+from infi.clickhouse_orm.funcs import F
+from infi.clickhouse_orm.models import Model
+from infi.clickhouse_orm.utils import parse_array, parse_tsv
+
+from .runner import benchmark
+from .stand_in import ClickHouseStandIn, tsv_response
+
+
+ROWS = 1000
+
+
+class Person(Model):
+
+    first_name = StringField()
+    last_name = LowCardinalityField(StringField())
+    birthday = DateField()
+    height = Float32Field()
+    passport = NullableField(UInt32Field())
+    tags = ArrayField(StringField())
+
+    engine = MergeTree('birthday', ('first_name', 'last_name', 'birthday'))
+
+
+def make_people(n=ROWS, seed=0):
+    """
+    Returns a deterministic list of `n` Person instances.
+    """
+    rnd = random.Random(seed)
+    names = ['Abdul', 'Adam', "O'Neil", 'Zoë', 'Tab\there', 'Chen']
+    return [
+        Person(
+            first_name=rnd.choice(names),
+            last_name=rnd.choice(names),
+            birthday=date(1970, 1, 1) + timedelta(days=rnd.randrange(20000)),
+            height=round(rnd.uniform(1.5, 2.0), 2),
+            passport=rnd.choice([None, rnd.randrange(10 ** 8)]),
+            tags=rnd.sample(names, rnd.randrange(4)),
+        )
+        for _ in range(n)
+    ]
+
+
+_server = None
+
+
+def get_database():
+    """
+    Returns a `Database` connected to a shared stand-in server, which is started on first use.
+    """
+    global _server
+    if _server is None:
+        _server = ClickHouseStandIn().start()
+        db = Database('bench', db_url=_server.url)
+        _server.add_response('SELECT * FROM `bench`.`person`', tsv_response(Person, make_people(), db=db))
+        return db
+    return Database('bench', db_url=_server.url)
+
+
+@benchmark(rows=ROWS)
+def insert():
+    db = get_database()
+    people = make_people()
+    return lambda: db.insert(people)
+
+
+@benchmark(rows=ROWS)
+def select_model():
+    db = get_database()
+    return lambda: list(db.select('SELECT * FROM $table', Person))
+
+
+@benchmark(rows=ROWS)
+def select_ad_hoc():
+    db = get_database()
+    return lambda: list(db.select('SELECT * FROM `bench`.`person`'))
+
+
+@benchmark(rows=ROWS)
+def from_tsv():
+    lines = tsv_response(Person, make_people(), db=get_database()).decode('utf-8').splitlines()
+    field_names = parse_tsv(lines[0])
+    rows = lines[2:]
+    return lambda: [Person.from_tsv(line, field_names) for line in rows]
+
+
+@benchmark(rows=ROWS)
+def to_db_string():
+    people = make_people()
+    return lambda: [person.to_db_string() for person in people]
+
+
+@benchmark()
+def queryset_as_sql():
+    qs = Person.objects_in(None)
+    def func():
+        return qs.filter(first_name__in=['Adam', 'Chen'], height__gt=1.7) \
+                 .exclude(birthday__lt=date(1980, 1, 1)) \
+                 .aggregate('last_name', count='count()', tallest=F.max(Person.height)) \
+                 .order_by('-count').limit_by(5, 'last_name').as_sql()
+    return func
+
+
+@benchmark(rows=ROWS)
+def parse_array_of_numbers():
+    arrays = ['[%s]' % ','.join(str(i * j) for j in range(10)) for i in range(ROWS)]
+    return lambda: [parse_array(s) for s in arrays]
+
+
+@benchmark(rows=ROWS)
+def parse_array_of_strings():
+    arrays = ["['abc','d\\'ef','ghi\\\\jkl','%d']" % i for i in range(ROWS)]
+    return lambda: [parse_array(s) for s in arrays]
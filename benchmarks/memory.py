@@ -0,0 +1,228 @@
+"""
+Measures the memory footprint of selecting and inserting model instances, in bytes per row,
+for several model shapes. Run it using:
+```
+    PYTHONPATH=src python -m benchmarks.memory
+```
+Every measurement runs in a fresh subprocess that talks to a stand-in server in the parent
+process, so that the peak RSS reflects only the work being measured. Each measurement is done
+twice: once for the peak RSS, and once with `tracemalloc` for the peak of Python allocations
+(which also slows the code down, and therefore is not combined with the RSS measurement).
+The RSS is read from `/proc`, so the harness runs on Linux only.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+from infi.clickhouse_orm.database import Database
+from infi.clickhouse_orm.engines import MergeTree
+from infi.clickhouse_orm.fields import *
+from infi.clickhouse_orm.models import Model
+
+from .stand_in import ClickHouseStandIn, tsv_response
+
+
+DEFAULT_ROWS = 100000
+
+INSERT_BATCH_SIZES = (100, 1000, 10000)
+
+
+class Narrow(Model):
+
+    id = UInt64Field()
+    name = StringField()
+
+    engine = MergeTree(partition_key=('tuple()',), order_by=('id',))
+
+
+class Person(Model):
+
+    id = UInt64Field()
+    first_name = StringField()
+    last_name = LowCardinalityField(StringField())
+    birthday = DateField()
+    height = Float32Field()
+    passport = NullableField(UInt32Field())
+
+    engine = MergeTree('birthday', ('id',))
+
+
+class CompactPerson(Model):
+
+    _compact = True
+
+    id = UInt64Field()
+    first_name = StringField()
+    last_name = LowCardinalityField(StringField())
+    birthday = DateField()
+    height = Float32Field()
+    passport = NullableField(UInt32Field())
+
+    engine = MergeTree('birthday', ('id',))
+
+
+def _wide_model(columns_per_type=10):
+    attrs = dict(id=UInt64Field(), created=DateTimeField())
+    for i in range(columns_per_type):
+        attrs['int_%d' % i] = Int32Field()
+        attrs['float_%d' % i] = Float64Field()
+        attrs['str_%d' % i] = StringField()
+    attrs['engine'] = MergeTree(partition_key=('tuple()',), order_by=('id',))
+    return type(Model)('Wide', (Model,), attrs)
+
+
+Wide = _wide_model()
+
+
+def make_instance(model_class, i):
+    """
+    Returns an instance of the given model class, with values derived from `i`.
+    """
+    values = {}
+    for name, field in model_class.fields().items():
+        if name == 'id':
+            values[name] = i
+        elif isinstance(field, DateTimeField):
+            values[name] = datetime(2020, 1, 1) + timedelta(seconds=i)
+        elif isinstance(field, DateField):
+            values[name] = date(1970, 1, 1) + timedelta(days=i % 20000)
+        elif field.isinstance(StringField):
+            values[name] = '%s-%d' % (name, i % 1000)
+        elif field.isinstance((Float32Field, Float64Field)):
+            values[name] = i / 7
+        elif isinstance(field, NullableField) and i % 10 == 0:
+            values[name] = None
+        else:
+            values[name] = i % 1000
+    return model_class(**values)
+
+
+SHAPES = dict(narrow=Narrow, person=Person, compact_person=CompactPerson, wide=Wide)
+
+
+def scenarios():
+    """
+    Yields (scenario, shape, batch_size) tuples for all the measurements.
+    """
+    for shape in SHAPES:
+        yield 'select_model', shape, None
+        yield 'select_model_list', shape, None
+        yield 'select_ad_hoc_list', shape, None
+        for batch_size in INSERT_BATCH_SIZES:
+            yield 'insert', shape, batch_size
+
+
+def run_scenario(db, scenario, model_class, rows, batch_size):
+    query = 'SELECT * FROM $table LIMIT %d' % rows
+    if scenario == 'select_model':
+        # Iterate without keeping the instances
+        for instance in db.select(query, model_class):
+            pass
+    elif scenario == 'select_model_list':
+        return list(db.select(query, model_class))
+    elif scenario == 'select_ad_hoc_list':
+        return list(db.select(db._substitute(query, model_class)))
+    elif scenario == 'insert':
+        db.insert((make_instance(model_class, i) for i in range(rows)), batch_size=batch_size)
+
+
+def _read_status(key):
+    with open('/proc/self/status') as f:
+        return int(re.search(r'%s:\s+(\d+) kB' % key, f.read()).group(1)) * 1024
+
+
+def reset_peak_rss():
+    # Resets the peak RSS (VmHWM) to the current RSS
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def measure_in_child(url, scenario, shape, rows, batch_size, mode):
+    """
+    Runs inside the subprocess. Returns the number of bytes used by the scenario.
+    """
+    db = Database('bench', db_url=url)
+    model_class = SHAPES[shape]
+    # Warm up, so that one-time allocations (imports, caches) are not measured
+    run_scenario(db, scenario, model_class, 10, batch_size)
+    if mode == 'tracemalloc':
+        tracemalloc.start()
+        result = run_scenario(db, scenario, model_class, rows, batch_size)
+        used = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        reset_peak_rss()
+        before = _read_status('VmRSS')
+        result = run_scenario(db, scenario, model_class, rows, batch_size)
+        used = _read_status('VmHWM') - before
+    del result
+    return used
+
+
+def measure(server, scenario, shape, rows, batch_size, mode):
+    """
+    Runs a single measurement in a subprocess, and returns the number of bytes used.
+    """
+    cmd = [sys.executable, '-m', 'benchmarks.memory', '--child', server.url, scenario, shape,
+           str(rows), str(batch_size or 0), mode]
+    output = subprocess.check_output(cmd, env=os.environ)
+    return int(output.decode().split()[-1])
+
+
+def record_responses(server, rows):
+    db = Database('bench', db_url=server.url)
+    for model_class in SHAPES.values():
+        # The full response, and a small one for warming up
+        for n in (rows, 10):
+            instances = (make_instance(model_class, i) for i in range(n))
+            server.add_response('SELECT * FROM `bench`.`%s` LIMIT %d' % (model_class.table_name(), n),
+                                tsv_response(model_class, instances, db=db))
+
+
+def format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(n) < 1024:
+            return '%.1f %s' % (n, unit)
+        n /= 1024
+    return '%.1f GiB' % n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.memory',
+                                     description='Measures the memory used for selecting and inserting rows.')
+    parser.add_argument('--rows', type=int, default=DEFAULT_ROWS, help='number of rows per measurement (default: %d)' % DEFAULT_ROWS)
+    parser.add_argument('-k', dest='pattern', help='run only scenarios or shapes containing this string')
+    parser.add_argument('--json', dest='json_path', help='write the results to this file')
+    parser.add_argument('--child', nargs=6, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        url, scenario, shape, rows, batch_size, mode = args.child
+        print(measure_in_child(url, scenario, shape, int(rows), int(batch_size) or None, mode))
+        return 0
+    results = []
+    print('%-20s %-15s %6s %14s %14s %18s' % ('scenario', 'shape', 'batch', 'RSS/row', 'traced/row', 'RSS/million rows'))
+    with ClickHouseStandIn() as server:
+        record_responses(server, args.rows)
+        for scenario, shape, batch_size in scenarios():
+            if args.pattern and args.pattern not in scenario and args.pattern not in shape:
+                continue
+            rss = measure(server, scenario, shape, args.rows, batch_size, 'rss') / args.rows
+            traced = measure(server, scenario, shape, args.rows, batch_size, 'tracemalloc') / args.rows
+            results.append(dict(scenario=scenario, shape=shape, batch_size=batch_size,
+                                rss_bytes_per_row=rss, traced_bytes_per_row=traced))
+            print('%-20s %-15s %6s %14s %14s %18s' % (scenario, shape, batch_size or '', format_bytes(rss),
+                                                      format_bytes(traced), format_bytes(rss * 1000000)))
+            sys.stdout.flush()
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+A minimal benchmark runner, based on `timeit`.
+
+A benchmark is a function decorated with `@benchmark`, which prepares its data and
+returns a callable that performs the measured operation. The runner calls it repeatedly
+and reports the best time per call, and the number of rows processed per second.
+
+Results can be saved to a JSON file, and later runs compared against it: the run fails
+when any benchmark is slower than in the baseline by more than the given threshold.
+"""
+import argparse
+import fnmatch
+import importlib
+import json
+import sys
+import timeit
+
+
+BENCHMARK_MODULES = ['benchmarks.bench_orm', 'benchmarks.bench_fields']
+
+DEFAULT_THRESHOLD = 0.2
+
+
+def benchmark(rows=1):
+    """
+    Decorates a benchmark setup function.
+
+    - `rows`: the number of rows that each call of the measured operation processes.
+    """
+    def decorator(setup):
+        setup.benchmark_rows = rows
+        return setup
+    return decorator
+
+
+def collect(pattern=None):
+    """
+    Returns a list of (name, setup function) tuples for all benchmarks whose
+    name matches the given shell-style pattern.
+    """
+    found = []
+    for module_name in BENCHMARK_MODULES:
+        module = importlib.import_module(module_name)
+        for attr, obj in vars(module).items():
+            if hasattr(obj, 'benchmark_rows'):
+                name = '%s.%s' % (module_name.split('.')[-1], attr)
+                if not pattern or fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(attr, pattern):
+                    found.append((name, obj))
+    return found
+
+
+def measure(setup, repeat=5):
+    """
+    Runs a single benchmark, and returns its result as a dict with the keys
+    `seconds` (best time per call) and `rows_per_second`.
+    """
+    func = setup()
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat, number)) / number
+    return dict(seconds=seconds, rows_per_second=setup.benchmark_rows / seconds)
+
+
+def format_seconds(seconds):
+    for unit, factor in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * factor >= 1:
+            return '%.2f %s' % (seconds * factor, unit)
+    return '%.0f ns' % (seconds * 1e9)
+
+
+def slowdown(result, baseline_result):
+    """
+    Returns the relative change in time per call compared to the baseline,
+    for example 0.25 when the benchmark became 25% slower.
+    """
+    return result['seconds'] / baseline_result['seconds'] - 1
+
+
+def run(pattern=None, repeat=5, baseline=None, out=sys.stdout):
+    """
+    Runs the matching benchmarks, prints a line for each one, and returns
+    a mapping from benchmark name to its result. When a baseline mapping
+    is given, the change relative to it is printed as well.
+    """
+    results = {}
+    for name, setup in collect(pattern):
+        results[name] = result = measure(setup, repeat)
+        line = '%-45s %12s %16s rows/s' % (name, format_seconds(result['seconds']),
+                                           '{:,.0f}'.format(result['rows_per_second']))
+        if baseline and name in baseline:
+            line += ' %+8.1f%%' % (slowdown(result, baseline[name]) * 100)
+        out.write(line + '\n')
+        out.flush()
+    return results
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns a list of (name, slowdown) tuples for the benchmarks that are slower
+    than in the baseline by more than the threshold. Benchmarks that do not
+    appear in the baseline are ignored.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name in baseline:
+            change = slowdown(result, baseline[name])
+            if change > threshold:
+                regressions.append((name, change))
+    return regressions
+
+
+def remeasure(results, names, repeat=5):
+    """
+    Measures the named benchmarks again, keeping the best result of each.
+    This is used for ruling out regressions caused by momentary noise.
+    """
+    for name, setup in collect():
+        if name in names:
+            result = measure(setup, repeat)
+            if result['seconds'] < results[name]['seconds']:
+                results[name] = result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Runs the ORM benchmarks.')
+    parser.add_argument('-k', dest='pattern', help='run only benchmarks matching this shell-style pattern')
+    parser.add_argument('--repeat', type=int, default=5, help='number of measurements per benchmark (default: 5)')
+    parser.add_argument('--json', dest='json_path', help='write the results to this file')
+    parser.add_argument('--compare', dest='baseline_path', help='compare the results to a baseline file saved using --json')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown relative to the baseline (default: %s)' % DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.baseline_path:
+        with open(args.baseline_path) as f:
+            baseline = json.load(f)
+    results = run(args.pattern, args.repeat, baseline)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            remeasure(results, [name for name, change in regressions], args.repeat)
+            regressions = find_regressions(results, baseline, args.threshold)
+        for name, change in regressions:
+            sys.stderr.write('Regression: %s is %.1f%% slower than the baseline\n' % (name, change * 100))
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,145 @@
+"""
+An in-process stand-in for the ClickHouse HTTP interface, so that the ORM can be
+benchmarked without a real server. It answers the queries that `Database` sends
+when connecting, serves pre-recorded responses to SELECT queries, and reads and
+discards the data of INSERT queries.
+"""
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from infi.clickhouse_orm.utils import escape
+
+
+FORMAT_REGEX = re.compile(r'\s+FORMAT\s+\w+\s*$')
+
+
+class ClickHouseStandIn(object):
+    """
+    A fake ClickHouse server running in a background thread. Use it as a context manager:
+    ```
+        with ClickHouseStandIn() as server:
+            server.add_response('SELECT * FROM `bench`.`person`', tsv_response(Person, people))
+            db = Database('bench', db_url=server.url)
+    ```
+    """
+
+    def __init__(self, version='20.8.1.1', timezone='UTC'):
+        self.responses = {
+            'SELECT version();': version.encode(),
+            'SELECT timezone()': timezone.encode(),
+        }
+        self.bytes_received = 0
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    def add_response(self, query, body):
+        """
+        Registers the response to a query. The query's FORMAT clause is ignored when matching.
+
+        - `query`: the SQL query, after substitution of `$db` and `$table`.
+        - `body`: the response as bytes, see `tsv_response`.
+        """
+        self.responses[FORMAT_REGEX.sub('', query.strip())] = body
+
+    def start(self):
+        stand_in = self
+
+        class Handler(_RequestHandler):
+            def get_response(self, query):
+                return stand_in._get_response(query)
+
+            def count_bytes(self, n):
+                stand_in.bytes_received += n
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _get_response(self, query):
+        query = FORMAT_REGEX.sub('', query.strip())
+        if query.startswith('INSERT') or query.startswith('CREATE') or query.startswith('DROP'):
+            return b''
+        if query.startswith('SELECT count() FROM system.databases'):
+            return b'1\n'
+        return self.responses.get(query)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        # The query is at the start of the body, INSERT data may follow it in the same body
+        body = self._read_body()
+        query = body.split(b'\n', 1)[0] if body.startswith(b'INSERT') else body
+        response = self.get_response(query.decode('utf-8'))
+        if response is None:
+            self._send(404, b'Code: 60. DB::Exception: No recorded response for query: ' + query)
+        else:
+            self._send(200, response)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                chunk = self.rfile.read(size + 2)[:size]   # each chunk ends with CRLF
+                self.count_bytes(size)
+                if not size:
+                    return b''.join(chunks)
+                # Keep only the beginning of the data, which holds the query
+                if not chunks:
+                    chunks.append(chunk)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.count_bytes(len(body))
+        return body
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/tab-separated-values; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def tsv_response(model_class, instances, field_names=None, db=None):
+    """
+    Builds the response to a SELECT query in TabSeparatedWithNamesAndTypes format,
+    as ClickHouse would return it for the given model instances.
+
+    - `model_class`: the model of the instances.
+    - `instances`: an iterable of model instances.
+    - `field_names`: the fields to include (all fields by default).
+    - `db`: the database whose server version determines the column types.
+    """
+    fields = model_class.fields()
+    field_names = list(field_names or fields)
+    types = [fields[name].get_sql(with_default_expression=False, db=db) for name in field_names]
+    lines = ['\t'.join(field_names), '\t'.join(escape(t, quote=False) for t in types)]
+    for instance in instances:
+        lines.append(_to_tsv(instance, field_names))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _to_tsv(instance, field_names):
+    fields = instance.fields()
+    return '\t'.join(fields[name].to_db_string(getattr(instance, name), quote=False) for name in field_names)
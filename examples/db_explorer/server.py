@@ -52,13 +52,14 @@ def table_view(db_name, tbl_name):
     A view that displays information about a single table.
     '''
     db = _get_db(db_name)
+    # Create models for the system tables we need, using a single query
+    models = db.get_models_for_tables(['tables', 'columns'], system_tables=True)
+    TablesTable, ColumnsTable = models['tables'], models['columns']
     # Get table information from system.tables
-    TablesTable = db.get_model_for_table('tables', system_table=True)
     tbl_info = TablesTable.objects_in(db).filter(database=db_name, name=tbl_name)[0]
     # Get the SQL used for creating the table
     create_table_sql = db.raw('SHOW CREATE TABLE %s FORMAT TabSeparatedRaw' % tbl_name)
     # Get all columns in the table from system.columns
-    ColumnsTable = db.get_model_for_table('columns', system_table=True)
     columns = ColumnsTable.objects_in(db).filter(database=db_name, table=tbl_name)
     # Generate the page
     return render_template('table.html',
@@ -132,9 +132,9 @@ if __name__ == '__main__':
     print('===============')
     print()
     module_doc([database.Database, database.DatabaseException])
-    module_doc([models.Model, models.BufferModel, models.MergeModel, models.DistributedModel, models.Constraint, models.Index])
+    module_doc([models.Model, models.BufferModel, models.MergeModel, models.DistributedModel, models.MaterializedViewModel, models.Constraint, models.Index])
     module_doc(sorted([fields.Field] + all_subclasses(fields.Field), key=lambda x: x.__name__), False)
     module_doc([engines.Engine] + all_subclasses(engines.Engine), False)
-    module_doc([query.QuerySet, query.AggregateQuerySet, query.Q])
+    module_doc([query.QuerySet, query.AggregateQuerySet, query.Q, query.Param, query.PreparedQuery])
     module_doc([funcs.F])
     module_doc([system_models.SystemPart])
@@ -4,10 +4,21 @@ from infi.clickhouse_orm.database import *
 from infi.clickhouse_orm.engines import *
 from infi.clickhouse_orm.fields import *
 from infi.clickhouse_orm.funcs import *
-from infi.clickhouse_orm.migrations import *
 from infi.clickhouse_orm.models import *
 from infi.clickhouse_orm.query import *
 from infi.clickhouse_orm.system_models import *
 
+from importlib import import_module
 from inspect import isclass
-__all__ = [c.__name__ for c in locals().values() if isclass(c)]
+_eager_names = [c.__name__ for c in locals().values() if isclass(c)]
+
+
+def __getattr__(name):
+    # The migrations module is only loaded when one of its classes (or __all__) is needed
+    migrations = import_module('infi.clickhouse_orm.migrations')
+    names = [n for n in migrations.__all__ if isclass(getattr(migrations, n))]
+    globals().update((n, getattr(migrations, n)) for n in names)
+    globals()['__all__'] = _eager_names + names
+    if name in globals():
+        return globals()[name]
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
@@ -1,13 +1,16 @@
 from __future__ import unicode_literals
 
 import re
-import requests
-from collections import namedtuple
+import threading
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from itertools import cycle
 from .models import ModelBase
-from .utils import escape, parse_tsv, import_submodules
+from .utils import escape, parse_tsv, import_submodules, comma_join
 from math import ceil
 import datetime
 from string import Template
+from functools import lru_cache
 import pytz
 
 import logging
@@ -16,6 +19,25 @@ logger = logging.getLogger('clickhouse_orm')
 
 Page = namedtuple('Page', 'objects number_of_objects pages_total number page_size')
 
+# Matches query parameter placeholders such as {name:String}, skipping over string literals
+QUERY_PARAM_REGEX = re.compile(r"'(?:[^'\\]|\\.)*'|\{\s*(\w+)\s*:\s*([^{}]+?)\s*\}")
+
+# Matches statements that only read data, which can be sent to read replicas
+READ_QUERY_REGEX = re.compile(r'^\s*(SELECT|WITH|SHOW|DESCRIBE|DESC|EXISTS|EXPLAIN)\b', re.IGNORECASE)
+
+# DDL statements that accept ON CLUSTER after the name of the table or database,
+# and those that accept it at the end of the statement
+DDL_QUERY_REGEX = re.compile(r'^\s*(CREATE|DROP|ALTER|OPTIMIZE|TRUNCATE)\s+(TEMPORARY\s+)?'
+                             r'(TABLE|DATABASE|MATERIALIZED\s+VIEW|VIEW|DICTIONARY)\s+(IF\s+(NOT\s+)?EXISTS\s+)?'
+                             r'(`[^`]*`|\w+)(\.(`[^`]*`|\w+))?', re.IGNORECASE)
+RENAME_QUERY_REGEX = re.compile(r'^\s*(RENAME|EXCHANGE)\s+(TABLES?|DATABASE|DICTIONARY)\b', re.IGNORECASE)
+ON_CLUSTER_REGEX = re.compile(r'\bON\s+CLUSTER\b', re.IGNORECASE)
+
+# The number of recent read latencies kept for computing the automatic hedging delay,
+# and the minimal number needed before hedging starts
+READ_LATENCIES_KEPT = 200
+READ_LATENCIES_NEEDED = 20
+
 
 class DatabaseException(Exception):
     '''
@@ -79,6 +101,27 @@ class ServerError(DatabaseException):
             return "{} ({})".format(self.message, self.code)
 
 
+@lru_cache(maxsize=1000)
+def _get_query_param_fields(query):
+    '''
+    Returns a mapping from the name of each query parameter in the given query
+    to an ad-hoc field matching its type (or `None` for unsupported types).
+    '''
+    fields = {}
+    for match in QUERY_PARAM_REGEX.finditer(query):
+        name, db_type = match.groups()
+        if name and name not in fields:
+            if db_type.startswith('Tuple'):
+                # Ad-hoc fields represent tuples as arrays, which have a different syntax
+                fields[name] = None
+                continue
+            try:
+                fields[name] = ModelBase.create_ad_hoc_field(db_type)
+            except (NotImplementedError, AssertionError, ValueError):
+                fields[name] = None
+    return fields
+
+
 class Database(object):
     '''
     Database instances connect to a specific ClickHouse database for running queries,
@@ -87,13 +130,18 @@ class Database(object):
 
     def __init__(self, db_name, db_url='http://localhost:8123/',
                  username=None, password=None, readonly=False, autocreate=True,
-                 timeout=60, verify_ssl_cert=True, log_statements=False):
+                 timeout=60, verify_ssl_cert=True, log_statements=False,
+                 read_urls=None, sequential_consistency=False, hedge_after=None,
+                 cluster=None, ddl_timeout=180):
         '''
         Initializes a database instance. Unless it's readonly, the database will be
         created on the ClickHouse server if it does not already exist.
 
         - `db_name`: name of the database to connect to.
-        - `db_url`: URL of the ClickHouse server.
+        - `db_url`: URL of the ClickHouse server, or a list of URLs of servers to spread
+          the writes across (inserts, mutations and other statements). Schema changes and the queries
+          that read the schema are always sent to the first of them; use `cluster` for applying
+          the schema changes to all the servers.
         - `username`: optional connection credentials.
         - `password`: optional connection credentials.
         - `readonly`: use a read-only connection.
@@ -101,29 +149,59 @@ class Database(object):
         - `timeout`: the connection timeout in seconds.
         - `verify_ssl_cert`: whether to verify the server's certificate when connecting via HTTPS.
         - `log_statements`: when True, all database statements are logged.
+        - `read_urls`: optional list of URLs of replicas to spread the read-only queries across
+          (such as those of `select`, `count` and `paginate`). By default, reads are sent to the write servers.
+        - `sequential_consistency`: when True, read-only queries use the `select_sequential_consistency`
+          setting, so that they see all the data previously written to replicated tables.
+        - `hedge_after`: enables hedged reads in `select`. If a query sent to a read replica has not
+          responded within this number of seconds, it is sent to another replica as well, the first
+          response is used and the other query is killed. Pass `'auto'` for using the 95th percentile
+          of the latencies of recent read queries. Requires at least two `read_urls`.
+        - `cluster`: optional name of a cluster for running DDL statements on all of its nodes,
+          using `ON CLUSTER`. This applies only to creating and dropping the database and its tables,
+          and to migrations. Other statements, such as mutations, partition operations and `raw`
+          queries, run on a single server.
+        - `ddl_timeout`: the number of seconds to wait for DDL statements to complete on all
+          the nodes of the cluster (sent as the `distributed_ddl_task_timeout` setting).
         '''
         self.db_name = db_name
-        self.db_url = db_url
+        self.write_urls = [db_url] if isinstance(db_url, str) else list(db_url)
+        self.read_urls = list(read_urls or self.write_urls)
+        self.db_url = self.write_urls[0]
+        self.sequential_consistency = sequential_consistency
+        self._write_url_cycle = cycle(self.write_urls)
+        self._read_url_cycle = cycle(self.read_urls)
+        self._local = threading.local()
+        self.hedge_after = hedge_after
+        self._read_latencies = deque(maxlen=READ_LATENCIES_KEPT)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.cluster = cluster
+        self.ddl_timeout = ddl_timeout
         self.readonly = False
         self.timeout = timeout
+        import requests
         self.request_session = requests.Session()
         self.request_session.verify = verify_ssl_cert
         if username:
             self.request_session.auth = (username, password or '')
         self.log_statements = log_statements
         self.settings = {}
+        self.shard_databases = {} # connections to shards, used by insert_to_shards
+        self._table_models = {} # cached models of existing tables, used by get_models_for_tables
         self.db_exists = False # this is required before running _is_existing_database
-        self.db_exists = self._is_existing_database()
-        if readonly:
-            if not self.db_exists:
-                raise DatabaseException('Database does not exist, and cannot be created under readonly connection')
-            self.connection_readonly = self._is_connection_readonly()
-            self.readonly = True
-        elif autocreate and not self.db_exists:
-            self.create_database()
-        self.server_version = self._get_server_version()
-        # Versions 1.1.53981 and below don't have timezone function
-        self.server_timezone = self._get_server_timezone() if self.server_version > (1, 1, 53981) else pytz.utc
+        with self._single_server(read=False):
+            self.db_exists = self._is_existing_database()
+            if readonly:
+                if not self.db_exists:
+                    raise DatabaseException('Database does not exist, and cannot be created under readonly connection')
+                self.connection_readonly = self._is_connection_readonly()
+                self.readonly = True
+            elif autocreate and not self.db_exists:
+                self.create_database()
+            self.server_version = self._get_server_version()
+            # Versions 1.1.53981 and below don't have timezone function
+            self.server_timezone = self._get_server_timezone() if self.server_version > (1, 1, 53981) else pytz.utc
         # Versions 19.1.16 and above support codec compression
         self.has_codec_support = self.server_version >= (19, 1, 16)
         # Version 19.0 and above support LowCardinality
@@ -133,33 +211,45 @@ class Database(object):
         '''
         Creates the database on the ClickHouse server if it does not already exist.
         '''
-        self._send('CREATE DATABASE IF NOT EXISTS `%s`' % self.db_name)
+        with self._single_server(read=False), self._on_cluster(self.cluster):
+            self._send('CREATE DATABASE IF NOT EXISTS `%s`' % self.db_name)
         self.db_exists = True
 
     def drop_database(self):
         '''
         Deletes the database on the ClickHouse server.
         '''
-        self._send('DROP DATABASE `%s`' % self.db_name)
+        with self._single_server(read=False), self._on_cluster(self.cluster):
+            self._send('DROP DATABASE `%s`' % self.db_name)
         self.db_exists = False
 
-    def create_table(self, model_class):
+    def create_table(self, model_class, cluster=None):
         '''
         Creates a table for the given model class, if it does not exist already.
+
+        - `model_class`: the model whose table should be created.
+        - `cluster`: optional name of a cluster for creating the table on all of its nodes,
+          overriding the database's `cluster`.
         '''
         if model_class.is_system_model():
             raise DatabaseException("You can't create system table")
         if getattr(model_class, 'engine') is None:
             raise DatabaseException("%s class must define an engine" % model_class.__name__)
-        self._send(model_class.create_table_sql(self))
+        with self._single_server(read=False), self._on_cluster(cluster or self.cluster):
+            self._send(model_class.create_table_sql(self))
 
-    def drop_table(self, model_class):
+    def drop_table(self, model_class, cluster=None):
         '''
         Drops the database table of the given model class, if it exists.
+
+        - `model_class`: the model whose table should be dropped.
+        - `cluster`: optional name of a cluster for dropping the table on all of its nodes,
+          overriding the database's `cluster`.
         '''
         if model_class.is_system_model():
             raise DatabaseException("You can't drop system table")
-        self._send(model_class.drop_table_sql(self))
+        with self._single_server(read=False), self._on_cluster(cluster or self.cluster):
+            self._send(model_class.drop_table_sql(self))
 
     def does_table_exist(self, model_class):
         '''
@@ -167,7 +257,8 @@ class Database(object):
         Note that this only checks for existence of a table with the expected name.
         '''
         sql = "SELECT count() FROM system.tables WHERE database = '%s' AND name = '%s'"
-        r = self._send(sql % (self.db_name, model_class.table_name()))
+        with self._single_server(read=False):
+            r = self._send(sql % (self.db_name, model_class.table_name()))
         return r.text.strip() == '1'
 
     def get_model_for_table(self, table_name, system_table=False):
@@ -181,13 +272,54 @@ class Database(object):
         '''
         db_name = 'system' if system_table else self.db_name
         sql = "DESCRIBE `%s`.`%s` FORMAT TSV" % (db_name, table_name)
-        lines = self._send(sql).iter_lines()
+        with self._single_server(read=False):
+            lines = self._send(sql).iter_lines()
         fields = [parse_tsv(line)[:2] for line in lines]
         model = ModelBase.create_ad_hoc_model(fields, table_name)
         if system_table:
             model._system = model._readonly = True
         return model
 
+    def get_models_for_tables(self, names=None, system_tables=False):
+        '''
+        Generates model classes for many existing tables at once, reading the columns of
+        all the tables using a single query. Returns a dict from table name to model class.
+        The models are cached, and are generated again only for tables whose metadata was
+        modified since.
+
+        - `names`: the tables to create models for, or None for all the tables in the database.
+          Tables that do not exist are not included in the result.
+        - `system_tables`: whether the tables are system tables, or belong to the current database
+        '''
+        db_name = 'system' if system_tables else self.db_name
+        conditions = 'database = %s' % escape(db_name)
+        if names is not None:
+            if not names:
+                return {}
+            conditions += ' AND name IN (%s)' % comma_join(escape(name) for name in names)
+        # The modification time has a resolution of one second, so compare the table definition too
+        sql = 'SELECT name, metadata_modification_time, cityHash64(create_table_query) ' \
+              'FROM system.tables WHERE %s FORMAT TSV' % conditions
+        with self._single_server(read=False):
+            versions = {name: version for name, *version in map(parse_tsv, self._send(sql).iter_lines())}
+            stale = [name for name, version in versions.items()
+                     if self._table_models.get((db_name, name), (None,))[0] != version]
+            columns = {}
+            if stale:
+                sql = 'SELECT table, name, type FROM system.columns WHERE database = %s AND table IN (%s) FORMAT TSV' \
+                      % (escape(db_name), comma_join(escape(name) for name in stale))
+                for table, name, db_type in map(parse_tsv, self._send(sql).iter_lines()):
+                    columns.setdefault(table, []).append((name, db_type))
+        for table in stale:
+            if table not in columns:
+                continue # dropped in the meantime
+            model = ModelBase.create_ad_hoc_model(columns[table], table)
+            if system_tables:
+                model._system = model._readonly = True
+            self._table_models[(db_name, table)] = (versions[table], model)
+        return {name: self._table_models[(db_name, name)][1] for name in versions
+                if (db_name, name) in self._table_models}
+
     def add_setting(self, name, value):
         '''
         Adds a database setting that will be sent with every request.
@@ -209,6 +341,30 @@ class Database(object):
         - `model_instances`: any iterable containing instances of a single model class.
         - `batch_size`: number of records to send per chunk (use a lower number if your records are very large).
         '''
+        self._insert(model_instances, batch_size)
+
+    def insert_to_shards(self, model_instances, batch_size=1000, shard_urls=None):
+        '''
+        Insert records of a `DistributedModel` directly into the underlying table on each shard,
+        instead of sending all of them to a single node that forwards them to the shards.
+        The cluster layout is read from `system.clusters`, and the shard of each record is found
+        by evaluating the engine's sharding key on the client. The supported sharding keys are
+        `rand()`, a column, `cityHash64` of columns, `intHash64` of a column, and any of these modulo a number.
+        The shards are written to in parallel, each by a single INSERT query.
+        This is not atomic: when the insert fails on some of the shards, a `DatabaseException` listing
+        them and the number of rows sent to each is raised, but the rows of the other shards remain inserted
+        (as may some of the rows of the failed shards), so retrying the whole call duplicates them.
+
+        - `model_instances`: any iterable containing instances of a single distributed model class.
+        - `batch_size`: number of records to send per chunk (use a lower number if your records are very large).
+        - `shard_urls`: optional mapping from shard number to the URL of a ClickHouse server in that shard.
+          By default, the URL of the shard's first replica is built from its host name in `system.clusters`,
+          using the scheme and port of this database's URL.
+        '''
+        from .sharding import insert_to_shards
+        insert_to_shards(self, model_instances, batch_size, shard_urls)
+
+    def _insert(self, model_instances, batch_size, table_name=None):
         from io import BytesIO
         i = iter(model_instances)
         try:
@@ -223,7 +379,8 @@ class Database(object):
         fields_list = ','.join(
             ['`%s`' % name for name in first_instance.fields(writable=True)])
         fmt = 'TSKV' if model_class.has_funcs_as_defaults() else 'TabSeparated'
-        query = 'INSERT INTO $table (%s) FORMAT %s\n' % (fields_list, fmt)
+        table = '`%s`.`%s`' % (self.db_name, table_name) if table_name else '$table'
+        query = 'INSERT INTO %s (%s) FORMAT %s\n' % (table, fields_list, fmt)
 
         def gen():
             buf = BytesIO()
@@ -264,7 +421,7 @@ class Database(object):
         r = self._send(query)
         return int(r.text) if r.text else 0
 
-    def select(self, query, model_class=None, settings=None):
+    def select(self, query, model_class=None, settings=None, params=None, hedge_after=None):
         '''
         Performs a query and returns a generator of model instances.
 
@@ -272,10 +429,13 @@ class Database(object):
         - `model_class`: the model class matching the query's table,
           or `None` for getting back instances of an ad-hoc model.
         - `settings`: query settings to send as HTTP GET parameters
+        - `params`: values for the query parameters (placeholders such as `{name:String}`)
+        - `hedge_after`: the delay in seconds (or `'auto'`) for sending the query to a second
+          replica, overriding the database's `hedge_after` for this query.
         '''
         query += ' FORMAT TabSeparatedWithNamesAndTypes'
         query = self._substitute(query, model_class)
-        r = self._send(query, settings, True)
+        r = self._send(query, settings, True, params, self.hedge_after if hedge_after is None else hedge_after)
         lines = r.iter_lines()
         field_names = parse_tsv(next(lines))
         field_types = parse_tsv(next(lines))
@@ -285,18 +445,20 @@ class Database(object):
             if line:
                 yield model_class.from_tsv(line, field_names, self.server_timezone, self)
 
-    def raw(self, query, settings=None, stream=False):
+    def raw(self, query, settings=None, stream=False, params=None):
         '''
         Performs a query and returns its output as text.
 
         - `query`: the SQL query to execute.
         - `settings`: query settings to send as HTTP GET parameters
         - `stream`: if true, the HTTP response from ClickHouse will be streamed.
+        - `params`: values for the query parameters (placeholders such as `{name:String}`)
         '''
         query = self._substitute(query, None)
-        return self._send(query, settings=settings, stream=stream).text
+        return self._send(query, settings=settings, stream=stream, query_params=params).text
 
-    def paginate(self, model_class, order_by, page_num=1, page_size=100, conditions=None, settings=None):
+    def paginate(self, model_class, order_by, page_num=1, page_size=100, conditions=None, settings=None,
+                 single_query=False):
         '''
         Selects records and returns a single page of model instances.
 
@@ -307,11 +469,26 @@ class Database(object):
         - `page_size`: number of records to return per page.
         - `conditions`: optional SQL conditions (contents of the WHERE clause).
         - `settings`: query settings to send as HTTP GET parameters
+        - `single_query`: if true, get the page and the total number of records in a single
+          query using `count() OVER ()`, instead of running a separate count query first.
+          Requires a ClickHouse version that supports window functions.
 
         The result is a namedtuple containing `objects` (list), `number_of_objects`,
         `pages_total`, `number` (of the current page), and `page_size`.
         '''
         from infi.clickhouse_orm.query import Q
+        fields = ", ".join(model_class.fields().keys())
+        query = ' FROM $table'
+        if conditions:
+            if isinstance(conditions, Q):
+                conditions = conditions.to_sql(model_class)
+            query += ' WHERE ' + str(conditions)
+        query += ' ORDER BY %s' % order_by
+        if single_query and page_num != -1:
+            def build_query(offset):
+                return 'SELECT %s, count() OVER () AS `_total`%s LIMIT %d, %d' % (fields, query, offset, page_size)
+            return self._paginate_single_query(build_query, lambda: self.count(model_class, conditions),
+                                               model_class, page_num, page_size, settings)
         count = self.count(model_class, conditions)
         pages_total = int(ceil(count / float(page_size)))
         if page_num == -1:
@@ -319,14 +496,7 @@ class Database(object):
         elif page_num < 1:
             raise ValueError('Invalid page number: %d' % page_num)
         offset = (page_num - 1) * page_size
-        query = 'SELECT {} FROM $table'.format(", ".join(model_class.fields().keys()))
-        
-        if conditions:
-            if isinstance(conditions, Q):
-                conditions = conditions.to_sql(model_class)
-            query += ' WHERE ' + str(conditions)
-        query += ' ORDER BY %s' % order_by
-        query += ' LIMIT %d, %d' % (offset, page_size)
+        query = 'SELECT %s%s LIMIT %d, %d' % (fields, query, offset, page_size)
         query = self._substitute(query, model_class)
         return Page(
             objects=list(self.select(query, model_class, settings)) if count else [],
@@ -336,26 +506,76 @@ class Database(object):
             page_size=page_size
         )
 
-    def migrate(self, migrations_package_name, up_to=9999):
+    def _paginate_single_query(self, build_query, count_func, model_class, page_num, page_size, settings=None):
+        '''
+        Returns a page of model instances using a query whose last column is the
+        total number of matching records, calculated by `count() OVER ()`.
+
+        - `build_query`: a function that receives the offset of the page and returns the query.
+        - `count_func`: a function that counts the matching records, for when the page is empty.
+        '''
+        if page_num < 1:
+            raise ValueError('Invalid page number: %d' % page_num)
+        query = build_query((page_num - 1) * page_size) + ' FORMAT TabSeparatedWithNamesAndTypes'
+        query = self._substitute(query, model_class)
+        r = self._send(query, settings, True)
+        lines = r.iter_lines()
+        field_names = parse_tsv(next(lines))[:-1]
+        field_types = parse_tsv(next(lines))[:-1]
+        model_class = model_class or ModelBase.create_ad_hoc_model(zip(field_names, field_types))
+        objects = []
+        count = None
+        for line in lines:
+            if line:
+                # The model ignores the extra column, so only the total needs to be parsed
+                objects.append(model_class.from_tsv(line, field_names, self.server_timezone, self))
+                count = int(line.rsplit(b'\t', 1)[1])
+        if count is None:
+            count = count_func()
+        return Page(
+            objects=objects,
+            number_of_objects=count,
+            pages_total=int(ceil(count / float(page_size))),
+            number=page_num,
+            page_size=page_size
+        )
+
+    def migrate(self, migrations_package_name, up_to=9999, cluster=None, parallel=False):
         '''
         Executes schema migrations.
 
         - `migrations_package_name` - fully qualified name of the Python package
           containing the migrations.
         - `up_to` - number of the last migration to apply.
+        - `cluster` - optional name of a cluster for applying the migrations on all of its nodes,
+          overriding the database's `cluster`.
+        - `parallel` - when false, the schema changes are sent once using `ON CLUSTER`, and the
+          migration history is kept on a single server. When true, the migrations are applied
+          separately on every node of the cluster, in parallel, and each node keeps its own history.
+          This waits up to `ddl_timeout` seconds for all the nodes to complete.
         '''
         from .migrations import MigrationHistory
         logger = logging.getLogger('migrations')
-        applied_migrations = self._get_applied_migrations(migrations_package_name)
-        modules = import_submodules(migrations_package_name)
-        unapplied_migrations = set(modules.keys()) - applied_migrations
-        for name in sorted(unapplied_migrations):
-            logger.info('Applying migration %s...', name)
-            for operation in modules[name].operations:
-                operation.apply(self)
-            self.insert([MigrationHistory(package_name=migrations_package_name, module_name=name, applied=datetime.date.today())])
-            if int(name[:4]) >= up_to:
-                break
+        cluster = cluster or self.cluster
+        if parallel:
+            assert cluster, 'Parallel migrations require a cluster'
+            from .sharding import run_on_nodes
+            run_on_nodes(self, cluster, lambda db: db.migrate(migrations_package_name, up_to), self.ddl_timeout)
+            return
+        # Operations read the schema that was just changed, so they must not use a lagging replica
+        with self._single_server(read=False), self._on_cluster(cluster):
+            if cluster:
+                self.create_database()
+            applied_migrations = self._get_applied_migrations(migrations_package_name)
+            modules = import_submodules(migrations_package_name)
+            unapplied_migrations = set(modules.keys()) - applied_migrations
+            for name in sorted(unapplied_migrations):
+                logger.info('Applying migration %s...', name)
+                for operation in modules[name].operations:
+                    operation.apply(self)
+                self.insert([MigrationHistory(package_name=migrations_package_name, module_name=name, applied=datetime.date.today())])
+                if int(name[:4]) >= up_to:
+                    break
 
     def _get_applied_migrations(self, migrations_package_name):
         from .migrations import MigrationHistory
@@ -364,17 +584,171 @@ class Database(object):
         query = self._substitute(query, MigrationHistory)
         return set(obj.module_name for obj in self.select(query))
 
-    def _send(self, data, settings=None, stream=False):
+    @contextmanager
+    def _single_server(self, read=True):
+        '''
+        Sends all the queries made in the current thread within the block to the same
+        server - one of the read replicas, or the first write server if `read` is false.
+        Schema changes and introspection always use the first write server, so that they
+        see each other's changes.
+        '''
+        previous = getattr(self._local, 'url', None)
+        self._local.url = previous or (next(self._read_url_cycle) if read else self.db_url)
+        try:
+            yield
+        finally:
+            self._local.url = previous
+
+    @contextmanager
+    def _on_cluster(self, cluster):
+        '''
+        Runs the DDL statements sent in the current thread within the block on all
+        the nodes of the given cluster. Does nothing if `cluster` is None.
+        '''
+        previous = getattr(self._local, 'cluster', None)
+        self._local.cluster = cluster or previous
+        try:
+            yield
+        finally:
+            self._local.cluster = previous
+
+    def _add_on_cluster(self, sql, cluster):
+        '''
+        Returns the given statement with an `ON CLUSTER` clause, or None if it is not
+        a DDL statement (or already has this clause).
+        '''
+        if ON_CLUSTER_REGEX.search(sql):
+            return None
+        clause = ' ON CLUSTER %s' % escape(cluster)
+        match = DDL_QUERY_REGEX.match(sql)
+        if match:
+            return sql[:match.end()] + clause + sql[match.end():]
+        if RENAME_QUERY_REGEX.match(sql):
+            return sql.rstrip().rstrip(';') + clause
+        return None
+
+    def _get_url(self, data):
+        '''
+        Returns the URL of the server to send the query to.
+        '''
+        url = getattr(self._local, 'url', None)
+        if url:
+            return url
+        return next(self._read_url_cycle if self._is_read_query(data) else self._write_url_cycle)
+
+    def _is_read_query(self, data):
+        return isinstance(data, str) and READ_QUERY_REGEX.match(data) is not None
+
+    def _send(self, data, settings=None, stream=False, query_params=None, hedge_after=None):
+        params = self._build_params(settings)
+        if query_params is not None:
+            params.update(self._build_query_params(data, query_params))
+        timeout = self.timeout
+        cluster = getattr(self._local, 'cluster', None)
+        if cluster and isinstance(data, str):
+            ddl = self._add_on_cluster(data, cluster)
+            if ddl:
+                # Wait for all the nodes of the cluster to complete
+                data = ddl
+                params.setdefault('distributed_ddl_task_timeout', self.ddl_timeout)
+                timeout += self.ddl_timeout
+        is_read = self._is_read_query(data)
+        if self.sequential_consistency and is_read:
+            params.setdefault('select_sequential_consistency', '1')
+        delay = self._get_hedge_delay(hedge_after) if is_read else None
+        hedged = delay is not None and len(self.read_urls) > 1 and not getattr(self._local, 'url', None)
+        url = None if hedged else self._get_url(data)
         if isinstance(data, str):
             data = data.encode('utf-8')
             if self.log_statements:
                 logger.info(data)
-        params = self._build_params(settings)
-        r = self.request_session.post(self.db_url, params=params, data=data, stream=stream, timeout=self.timeout)
+        if hedged:
+            r = self._send_hedged(data, params, stream, delay)
+        else:
+            r = self._post(url, params, data, stream, timeout)
+        if is_read:
+            self._read_latencies.append(r.elapsed.total_seconds())
+        return r
+
+    def _post(self, url, params, data, stream=False, timeout=None):
+        r = self.request_session.post(url, params=params, data=data, stream=stream, timeout=timeout or self.timeout)
         if r.status_code != 200:
             raise ServerError(r.text)
         return r
 
+    def _get_hedge_delay(self, hedge_after):
+        '''
+        Returns the number of seconds to wait before sending a read query to a second replica,
+        or None for not sending it.
+        '''
+        if hedge_after == 'auto':
+            latencies = sorted(self._read_latencies)
+            if len(latencies) < READ_LATENCIES_NEEDED:
+                return None
+            return latencies[int(len(latencies) * 0.95)]
+        return hedge_after
+
+    def _send_hedged(self, data, params, stream, delay):
+        '''
+        Sends a read query to a replica, and if it does not respond within `delay` seconds
+        (or fails), to another replica as well. Returns the first successful response, and
+        kills the query on the other replica.
+        '''
+        from concurrent.futures import wait, FIRST_COMPLETED
+        from uuid import uuid4
+        with self._executor_lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=4 * len(self.read_urls))
+        attempts = {}
+        started = threading.Event()
+        def post(url, params):
+            started.set()
+            return self._post(url, params, data, stream)
+        def start():
+            # Other threads advance the cycle too, so skip the replicas that were already tried
+            used = set(url for url, query_id in attempts.values())
+            for i in range(len(self.read_urls)):
+                url = next(self._read_url_cycle)
+                if url not in used:
+                    break
+            query_id = str(uuid4())
+            future = self._executor.submit(post, url, dict(params, query_id=query_id))
+            attempts[future] = (url, query_id)
+        start()
+        # Time spent waiting for a free worker does not count towards the delay
+        started.wait()
+        done, pending = wait(attempts, timeout=delay)
+        if not done or next(iter(done)).exception():
+            start()
+        pending = set(attempts)
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            responses = [future.result() for future in done if not future.exception()]
+            errors.extend(future.exception() for future in done if future.exception())
+            if responses:
+                for r in responses[1:]:
+                    r.close()
+                for future in pending:
+                    self._cancel_hedged_query(future, *attempts[future])
+                return responses[0]
+        raise errors[0]
+
+    def _cancel_hedged_query(self, future, url, query_id):
+        def close_response(future):
+            if not future.exception():
+                future.result().close()
+        future.add_done_callback(close_response)
+        self._executor.submit(self._kill_query, url, query_id)
+
+    def _kill_query(self, url, query_id, sync=False):
+        sql = 'KILL QUERY WHERE query_id = %s %s' % (escape(query_id), 'SYNC' if sync else 'ASYNC')
+        try:
+            self._post(url, self._build_params(None), sql.encode('utf-8'))
+        except Exception as e:
+            logger.warning('Cannot kill query %s: %s', query_id, e)
+
     def _build_params(self, settings):
         params = dict(settings or {})
         params.update(self.settings)
@@ -385,6 +759,22 @@ class Database(object):
             params['readonly'] = '1'
         return params
 
+    def _build_query_params(self, query, values):
+        '''
+        Converts the values of the query parameters that appear in the query
+        to HTTP GET parameters, serializing each value according to its type.
+        '''
+        params = {}
+        for name, field in _get_query_param_fields(query).items():
+            if name not in values:
+                raise DatabaseException('Missing value for query parameter "%s"' % name)
+            value = values[name]
+            if field is None:
+                params['param_' + name] = escape(value, quote=False)
+            else:
+                params['param_' + name] = field.to_db_string(field.to_python(value, pytz.utc), quote=False)
+        return params
+
     def _substitute(self, query, model_class=None):
         '''
         Replaces $db and $table placeholders in the query.
@@ -168,6 +168,14 @@ class ReplacingMergeTree(MergeTree):
         return params
 
 
+class AggregatingMergeTree(MergeTree):
+    """
+    A MergeTree engine that combines rows with the same sorting key into a single row
+    when merging, using the aggregate functions of its `AggregateFunctionField` and
+    `SimpleAggregateFunctionField` columns.
+    """
+
+
 class Buffer(Engine):
     """
     Buffers the data to write in RAM, periodically flushing it to another table.
@@ -1,15 +1,14 @@
 from __future__ import unicode_literals
 import datetime
-import iso8601
 import pytz
 from calendar import timegm
 from decimal import Decimal, localcontext
 from uuid import UUID
+from ipaddress import IPv4Address, IPv6Address
 from logging import getLogger
 from pytz import BaseTzInfo
-from .utils import escape, parse_array, comma_join, string_or_func, get_subclass_names
+from .utils import escape, parse_array, parse_datetime, localize, comma_join, string_or_func, get_subclass_names
 from .funcs import F, FunctionOperatorsMixin
-from ipaddress import IPv4Address, IPv6Address
 
 logger = getLogger('clickhouse_orm')
 
@@ -180,6 +179,12 @@ class DateField(Field):
         if isinstance(value, str):
             if value == '0000-00-00':
                 return DateField.min_value
+            if len(value) == 10 and value[4] == '-' and value[7] == '-':
+                # Fast path for the layout used by ClickHouse
+                try:
+                    return datetime.date.fromisoformat(value)
+                except ValueError:
+                    pass
             return datetime.datetime.strptime(value, '%Y-%m-%d').date()
         raise ValueError('Invalid value for %s - %r' % (self.__class__.__name__, value))
 
@@ -219,12 +224,17 @@ class DateTimeField(Field):
         if isinstance(value, str):
             if value == '0000-00-00 00:00:00':
                 return self.class_default
+            # Fast path for the layout used by ClickHouse
+            dt = parse_datetime(value)
+            if dt is not None:
+                return localize(dt, timezone_in_use)
             if len(value) == 10:
                 try:
                     value = int(value)
                     return datetime.datetime.utcfromtimestamp(value).replace(tzinfo=pytz.utc)
                 except ValueError:
                     pass
+            import iso8601
             try:
                 # left the date naive in case of no tzinfo set
                 dt = iso8601.parse_date(value, default_timezone=None)
@@ -233,7 +243,7 @@ class DateTimeField(Field):
 
             # convert naive to aware
             if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
-                dt = timezone_in_use.localize(dt)
+                dt = localize(dt, timezone_in_use)
             return dt
         raise ValueError('Invalid value for %s - %r' % (self.__class__.__name__, value))
 
@@ -670,5 +680,64 @@ class LowCardinalityField(Field):
         return sql
 
 
+class AggregateFunctionField(Field):
+    '''
+    A field that holds the intermediate state of an aggregate function, for use with the
+    `AggregatingMergeTree` engine. States are written using the `-State` combinator of the
+    function (for example `F.uniqState`) and read using its `-Merge` combinator (for example
+    `F.uniqMerge`). Since the ORM cannot create states by itself, the field is always read-only.
+
+    - `function`: the aggregate function's name, including any parameters (for example `'quantiles(0.5, 0.9)'`).
+    - `arg_fields`: fields that describe the types of the function's arguments.
+    '''
+
+    class_default = None
+
+    def __init__(self, function, *arg_fields, default=None, alias=None, materialized=None, codec=None):
+        assert isinstance(function, str) and function, "The function of AggregateFunctionField must be a non-empty string"
+        assert all(isinstance(f, Field) for f in arg_fields), "The arguments of AggregateFunctionField must be Field instances"
+        self.function = function
+        self.arg_fields = arg_fields
+        super(AggregateFunctionField, self).__init__(default, alias, materialized, readonly=True, codec=codec)
+
+    def get_sql(self, with_default_expression=True, db=None):
+        args = [self.function] + [f.get_sql(with_default_expression=False, db=db) for f in self.arg_fields]
+        sql = 'AggregateFunction(%s)' % comma_join(args)
+        if with_default_expression:
+            sql += self._extra_params(db)
+        return sql
+
+
+class SimpleAggregateFunctionField(Field):
+    '''
+    A field for the `AggregatingMergeTree` engine, that holds a plain value of its inner field.
+    When rows are merged, their values are combined using the given function, such as `sum`,
+    `min`, `max` or `anyLast`.
+    '''
+
+    def __init__(self, function, inner_field, default=None, alias=None, materialized=None, readonly=None, codec=None):
+        assert isinstance(function, str) and function, "The function of SimpleAggregateFunctionField must be a non-empty string"
+        assert isinstance(inner_field, Field), "The second argument of SimpleAggregateFunctionField must be a Field instance. Not: {}".format(inner_field)
+        self.function = function
+        self.inner_field = inner_field
+        self.class_default = self.inner_field.class_default
+        super(SimpleAggregateFunctionField, self).__init__(default, alias, materialized, readonly, codec)
+
+    def to_python(self, value, timezone_in_use):
+        return self.inner_field.to_python(value, timezone_in_use)
+
+    def validate(self, value):
+        self.inner_field.validate(value)
+
+    def to_db_string(self, value, quote=True):
+        return self.inner_field.to_db_string(value, quote=quote)
+
+    def get_sql(self, with_default_expression=True, db=None):
+        sql = 'SimpleAggregateFunction(%s, %s)' % (self.function, self.inner_field.get_sql(with_default_expression=False, db=db))
+        if with_default_expression:
+            sql += self._extra_params(db)
+        return sql
+
+
 # Expose only relevant classes in import *
 __all__ = get_subclass_names(locals(), Field)
@@ -187,6 +187,9 @@ class FMeta(type):
             {'suffix': 'If',          'args': ['cond']},
             {'suffix': 'OrDefaultIf', 'args': ['cond']},
             {'suffix': 'OrNullIf',    'args': ['cond']},
+            {'suffix': 'State'},
+            {'suffix': 'Merge',       'args': ['state'], 'base_args': False},
+            {'suffix': 'MergeState',  'args': ['state'], 'base_args': False},
         ],
         'with_utf8_support': [
             {'suffix': 'UTF8'},
@@ -194,20 +197,37 @@ class FMeta(type):
     }
 
     def __init__(cls, name, bases, dct):
+        # Combinators are only generated when first accessed, see __getattr__
+        cls._combinators = {}
         for name, obj in dct.items():
             if hasattr(obj, '__func__'):
                 f_type = getattr(obj.__func__, 'f_type', '')
                 for combinator in FMeta.FUNCTION_COMBINATORS.get(f_type, []):
                     new_name = name + combinator['suffix']
-                    FMeta._add_func(cls, obj.__func__, new_name, combinator.get('args'))
+                    cls._combinators[new_name] = (obj.__func__, combinator.get('args'), combinator.get('base_args', True))
+
+    def __getattr__(cls, name):
+        for klass in cls.__mro__:
+            combinator = vars(klass).get('_combinators', {}).get(name)
+            if combinator:
+                FMeta._add_func(klass, combinator[0], name, *combinator[1:])
+                return getattr(cls, name)
+        raise AttributeError("type object '%s' has no attribute '%s'" % (cls.__name__, name))
+
+    def __dir__(cls):
+        names = set(super().__dir__())
+        for klass in cls.__mro__:
+            names.update(vars(klass).get('_combinators', {}))
+        return sorted(names)
 
     @staticmethod
-    def _add_func(cls, base_func, new_name, extra_args):
+    def _add_func(cls, base_func, new_name, extra_args, base_args=True):
         """
         Adds a new func to the cls, based on the signature of the given base_func but with a new name.
+        When base_args is false, the new func accepts only the extra args.
         """
         # Get the function's signature
-        sig = signature(base_func)
+        sig = signature(base_func if base_args else lambda: None)
         new_sig = str(sig)[1 : -1] # omit the parentheses
         args = comma_join(sig.parameters)
         # Add extra args
@@ -1775,6 +1795,10 @@ class F(Cond, FunctionOperatorsMixin, metaclass=FMeta):
 
     # Misc functions
 
+    @staticmethod
+    def finalizeAggregation(state):
+        return F('finalizeAggregation', state)
+
     @staticmethod
     def ifNotFinite(x, y):
         return F('ifNotFinite', x, y)
@@ -1,6 +1,8 @@
-from .models import Model, BufferModel
+from .models import Model, BufferModel, MaterializedViewModel
 from .fields import DateField, StringField
 from .engines import MergeTree
+from .database import DatabaseException, ServerError
+from .system_models import SystemPart
 from .utils import escape, get_subclass_names
 
 import logging
@@ -46,6 +48,8 @@ class CreateTable(ModelOperation):
         logger.info('    Create table %s', self.table_name)
         if issubclass(self.model_class, BufferModel):
             database.create_table(self.model_class.engine.main_model)
+        if issubclass(self.model_class, MaterializedViewModel):
+            database.create_table(self.model_class.target_model())
         database.create_table(self.model_class)
 
 
@@ -56,6 +60,7 @@ class AlterTable(ModelOperation):
       - add new columns
       - drop obsolete columns
       - modify column types
+    All the changes are applied using a single ALTER TABLE statement.
     Default values are not altered by this operation.
     '''
 
@@ -70,11 +75,15 @@ class AlterTable(ModelOperation):
         # ADD COLUMN ... AFTER doesn't affect it
         table_fields = dict(self._get_table_fields(database))
 
+        # All the changes are sent in a single ALTER TABLE statement, whose clauses
+        # are applied in order
+        clauses = []
+
         # Identify fields that were deleted from the model
         deleted_fields = set(table_fields.keys()) - set(self.model_class.fields())
         for name in deleted_fields:
             logger.info('        Drop column %s', name)
-            self._alter_table(database, 'DROP COLUMN %s' % name)
+            clauses.append('DROP COLUMN %s' % name)
             del table_fields[name]
 
         # Identify fields that were added to the model
@@ -89,7 +98,7 @@ class AlterTable(ModelOperation):
                         cmd += ' AFTER %s' % prev_name
                     else:
                         cmd += ' FIRST'
-                self._alter_table(database, cmd)
+                clauses.append(cmd)
 
             if is_regular_field:
                 # ALIAS and MATERIALIZED fields are not stored in the database, and raise DatabaseError
@@ -102,14 +111,14 @@ class AlterTable(ModelOperation):
         # attribute position. Watch https://github.com/Infinidat/infi.clickhouse_orm/issues/47
         model_fields = {name: field.get_sql(with_default_expression=False, db=database)
                         for name, field in self.model_class.fields().items()}
-        for field_name, field_sql in self._get_table_fields(database):
-            # All fields must have been created and dropped by this moment
-            assert field_name in model_fields, 'Model fields and table columns in disagreement'
-
+        for field_name, field_sql in table_fields.items():
             if field_sql != model_fields[field_name]:
                 logger.info('        Change type of column %s from %s to %s', field_name, field_sql,
                             model_fields[field_name])
-                self._alter_table(database, 'MODIFY COLUMN %s %s' % (field_name, model_fields[field_name]))
+                clauses.append('MODIFY COLUMN %s %s' % (field_name, model_fields[field_name]))
+
+        if clauses:
+            self._alter_table(database, ', '.join(clauses))
 
 
 class AlterTableWithBuffer(ModelOperation):
@@ -220,6 +229,205 @@ class AlterIndexes(ModelOperation):
         return set(matches)
 
 
+class RebuildTable(ModelOperation):
+    '''
+    A migration operation that rebuilds the table of a given model class, for changes that
+    cannot be applied in place, such as changing the engine's `order_by` or `partition_key`,
+    or column codecs. A shadow table is created using the model's definition, the data is
+    copied into it partition by partition, and then the two tables are exchanged and the
+    old table is dropped. The copied partitions are recorded in a bookkeeping table, so if
+    the operation fails it can be applied again, and partitions that were already copied
+    and not modified since are not copied again (unless the partition key was changed).
+
+    Writes to the table must be stopped while it is rebuilt. Partitions modified while they
+    are copied are copied again, but writes made after the last pass cannot be copied safely,
+    so when the table was modified by then a `DatabaseException` is raised instead of replacing
+    it. Applying the operation again copies only the modified partitions.
+
+    Replicated tables are not supported, since the shadow table would use the same replication
+    path. The operation cannot run on a cluster either, because the data is copied on a single
+    node - apply it on each node separately, for example using `migrate(..., parallel=True)`.
+    '''
+
+    def __init__(self, model_class, workers=1, progress=None):
+        '''
+        Initializer.
+
+        - `model_class`: the model whose table should be rebuilt. Its engine must be of the MergeTree family.
+        - `workers`: the number of partitions to copy in parallel.
+        - `progress`: an optional function to call after each partition is copied, with the number
+          of partitions that were copied so far and the number of partitions to copy.
+        '''
+        super().__init__(model_class)
+        assert isinstance(model_class.engine, MergeTree), 'RebuildTable supports only MergeTree tables'
+        assert not model_class.engine.replica_table_path, 'RebuildTable does not support replicated tables'
+        assert workers >= 1, 'workers must be at least 1'
+        self.workers = workers
+        self.progress = progress
+        self.shadow_table_name = self.table_name + '_rebuild'
+        self.copied_table_name = self.table_name + '_rebuild_partitions'
+
+    def apply(self, database):
+        logger.info('    Rebuild table %s', self.table_name)
+        if database.cluster or getattr(database._local, 'cluster', None):
+            # Only the schema changes would run on all the nodes, but not the copying
+            raise DatabaseException('RebuildTable cannot run on a cluster. Apply it on each node separately, '
+                                    'for example using migrate(..., parallel=True)')
+        if not database.does_table_exist(self.model_class):
+            database.create_table(self.model_class)
+            return
+        # Create the shadow table, unless it remains from a previous attempt with the same definition
+        sql = self.model_class.create_table_sql(database)
+        table = '`%s`.`%s`' % (database.db_name, self.table_name)
+        sql = sql.replace(table, '`%s`.`%s`' % (database.db_name, self.shadow_table_name), 1)
+        if not self._is_shadow_table_current(database, sql):
+            logger.info('        Dropping the shadow table of a previous attempt, which has another definition')
+            database.raw('DROP TABLE $db.`%s`' % self.shadow_table_name)
+            database.raw('DROP TABLE IF EXISTS $db.`%s`' % self.copied_table_name)
+        database.raw(sql)
+        database.raw('CREATE TABLE IF NOT EXISTS $db.`%s` (partition_id String, version String) ENGINE = Log'
+                     % self.copied_table_name)
+        columns = self._get_columns_to_copy(database)
+        if self._get_partition_key(database, self.table_name) == self._get_partition_key(database, self.shadow_table_name):
+            self._copy_partitions(database, columns)
+            # Partitions that changed while copying are copied again
+            versions = self._copy_partitions(database, columns)
+        else:
+            # Partitions of the two tables do not match, so there is no way to resume
+            database.raw('TRUNCATE TABLE $db.`%s`' % self.shadow_table_name)
+            database.raw('TRUNCATE TABLE $db.`%s`' % self.copied_table_name)
+            versions = self._copy_partitions(database, columns, same_partitions=False)
+        # Writes made since the last pass started would be lost
+        if self._get_versions(database, self.table_name) != versions:
+            raise DatabaseException('Table %s was modified while it was rebuilt. Stop writing to it '
+                                    'and apply the operation again' % self.table_name)
+        self._replace_table(database)
+        database.raw('DROP TABLE $db.`%s`' % self.copied_table_name)
+
+    def _is_shadow_table_current(self, database, sql):
+        '''
+        Checks whether the shadow table that remains from a previous attempt, if any, was created
+        by the given statement. For comparing the definitions as normalized by the server, another
+        table is created by the same statement.
+        '''
+        shadow_definition = self._get_table_definition(database, self.shadow_table_name)
+        if not shadow_definition:
+            return True
+        check_table_name = self.shadow_table_name + '_check'
+        database.raw(sql.replace('`%s`' % self.shadow_table_name, '`%s`' % check_table_name, 1))
+        try:
+            check_definition = self._get_table_definition(database, check_table_name)
+        finally:
+            database.raw('DROP TABLE $db.`%s`' % check_table_name)
+        return shadow_definition == check_definition.replace(check_table_name, self.shadow_table_name, 1)
+
+    def _get_table_definition(self, database, table_name):
+        query = "SELECT create_table_query FROM system.tables WHERE database = %s AND name = %s" \
+                % (escape(database.db_name), escape(table_name))
+        return database.raw(query).strip()
+
+    def _get_columns_to_copy(self, database):
+        '''
+        Returns the names of the model's stored columns that exist in the current table.
+        '''
+        query = "DESC `%s`.`%s`" % (database.db_name, self.table_name)
+        table_columns = set(row.name for row in database.select(query))
+        return [name for name, field in self.model_class.fields().items()
+                if name in table_columns and not (field.materialized or field.alias)]
+
+    def _get_partition_key(self, database, table_name):
+        query = "SELECT partition_key FROM system.tables WHERE database = %s AND name = %s" \
+                % (escape(database.db_name), escape(table_name))
+        return database.raw(query).strip()
+
+    def _get_parts(self, database, table_name):
+        '''
+        Returns a dict from partition ID to the active parts of the partition in the given table.
+        '''
+        parts = {}
+        for part in SystemPart.get_active(database, conditions='table = %s' % escape(table_name)):
+            parts.setdefault(part.partition_id, []).append(part)
+        return parts
+
+    def _get_versions(self, database, table_name):
+        '''
+        Returns a dict from partition ID to a string that changes whenever the data in the partition
+        changes. It consists of the highest block number in the partition, which grows with every
+        insert, and the highest mutation number. Neither of them is changed by merges.
+        '''
+        versions = {}
+        for partition_id, parts in self._get_parts(database, table_name).items():
+            max_block = mutation = 0
+            for part in parts:
+                # Part names are partition_minblock_maxblock_level[_mutation], or in the
+                # legacy format mindate_maxdate_minblock_maxblock_level[_mutation]
+                if part.name.startswith(partition_id + '_'):
+                    numbers = part.name[len(partition_id) + 1:].split('_')
+                else:
+                    numbers = part.name.split('_')[2:]
+                max_block = max(max_block, int(numbers[1]))
+                if len(numbers) > 3:
+                    mutation = max(mutation, int(numbers[3]))
+            versions[partition_id] = '%d_%d' % (max_block, mutation)
+        return versions
+
+    def _copy_partitions(self, database, columns, same_partitions=True):
+        '''
+        Copies the partitions that were not copied yet, or were modified since they were copied,
+        and records them in the bookkeeping table. When the shadow table has the same partitions
+        (`same_partitions`), their previous copies and partitions no longer in the current table are
+        dropped from it. Returns the versions of the partitions, from before they were copied.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        versions = self._get_versions(database, self.table_name)
+        query = 'SELECT partition_id, version FROM $db.`%s`' % self.copied_table_name
+        copied = set(tuple(line.split('\t')) for line in database.raw(query).splitlines())
+        pending = [partition_id for partition_id, version in sorted(versions.items())
+                   if (partition_id, version) not in copied]
+        if same_partitions:
+            for partition_id, parts in self._get_parts(database, self.shadow_table_name).items():
+                if partition_id in pending or partition_id not in versions:
+                    # Partially copied, modified since it was copied, or dropped
+                    parts[0].drop()
+        if not pending:
+            return versions
+        logger.info('        Copying %d partitions of %d', len(pending), len(versions))
+        columns_sql = ', '.join('`%s`' % name for name in columns)
+        def copy(partition_id):
+            database.raw('INSERT INTO $db.`%s` (%s) SELECT %s FROM $db.`%s` WHERE _partition_id = %s'
+                         % (self.shadow_table_name, columns_sql, columns_sql, self.table_name, escape(partition_id)))
+            database.raw('INSERT INTO $db.`%s` VALUES (%s, %s)'
+                         % (self.copied_table_name, escape(partition_id), escape(versions[partition_id])))
+            return partition_id
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(copy, partition_id) for partition_id in pending]
+            try:
+                for done, future in enumerate(futures, 1):
+                    logger.info('        Copied partition %s (%d/%d)', future.result(), done, len(pending))
+                    if self.progress:
+                        self.progress(done, len(pending))
+            finally:
+                # After a failure, do not start copying any more partitions
+                for future in futures:
+                    future.cancel()
+        return versions
+
+    def _replace_table(self, database):
+        '''
+        Replaces the current table with the shadow table, and drops the current table.
+        '''
+        try:
+            database.raw('EXCHANGE TABLES $db.`%s` AND $db.`%s`' % (self.table_name, self.shadow_table_name))
+        except ServerError:
+            # EXCHANGE TABLES is supported only in Atomic databases
+            old_table_name = self.table_name + '_old'
+            database.raw('RENAME TABLE $db.`%s` TO $db.`%s`, $db.`%s` TO $db.`%s`' % (
+                self.table_name, old_table_name, self.shadow_table_name, self.table_name))
+            database.raw('DROP TABLE $db.`%s`' % old_table_name)
+        else:
+            database.raw('DROP TABLE $db.`%s`' % self.shadow_table_name)
+
+
 class RunPython(Operation):
     '''
     A migration operation that executes a Python function.
@@ -119,6 +119,25 @@ class Index:
         return 'bloom_filter(%f)' % false_positive
 
 
+class FieldSlot(object):
+    '''
+    A descriptor used by compact models for storing a field's value in a slot.
+    Accessing it on the model class returns the `Field` instance itself.
+    '''
+
+    def __init__(self, field, member):
+        self.field = field
+        self.member = member # the slot's member descriptor
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.field
+        return self.member.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        self.member.__set__(instance, value)
+
+
 class ModelBase(type):
     '''
     A metaclass for ORM models. It adds the _fields list to model classes.
@@ -172,6 +191,9 @@ class ModelBase(type):
             _defaults=defaults,
             _has_funcs_as_defaults=has_funcs_as_defaults
         )
+        compact = attrs.get('_compact', any(getattr(base, '_compact', False) for base in bases))
+        if compact:
+            slot_members = cls._prepare_compact_attrs(name, bases, attrs, fields)
         model = super(ModelBase, cls).__new__(cls, str(name), bases, attrs)
 
         # Let each field, constraint and index know its parent and its own name
@@ -179,8 +201,42 @@ class ModelBase(type):
             setattr(obj, 'parent', model)
             setattr(obj, 'name', n)
 
+        # In compact models, replace the slots with descriptors that also expose the fields
+        if compact:
+            for n, f in fields:
+                member = model.__dict__.get(n) if n in attrs['__slots__'] else slot_members.get(n)
+                if member is not None:
+                    setattr(model, n, FieldSlot(f, member))
+
         return model
 
+    @classmethod
+    def _prepare_compact_attrs(cls, name, bases, attrs, fields):
+        '''
+        Adds `__slots__` to the attributes of a compact model class, with one slot per field
+        that is not already stored in a slot by one of the base classes. Fields are removed
+        from the class attributes since they may not conflict with the slot names.
+        Returns a dict of inherited slot member descriptors, for fields that this class overrides.
+        '''
+        inherited = {}
+        for base in bases:
+            for klass in base.__mro__:
+                if klass is not object and '__slots__' not in klass.__dict__:
+                    raise TypeError('Compact model %s cannot inherit from %s, which does not define __slots__'
+                                    % (name, klass.__name__))
+                for n, obj in klass.__dict__.items():
+                    if isinstance(obj, FieldSlot):
+                        inherited.setdefault(n, obj.member)
+                    elif n == '_database' and n in klass.__slots__:
+                        inherited.setdefault(n, obj)
+        slots = [n for n, f in fields if n not in inherited]
+        if '_database' not in inherited:
+            slots.append('_database')
+        for n in slots:
+            attrs.pop(n, None)
+        attrs['__slots__'] = tuple(slots)
+        return {n: member for n, member in inherited.items() if n in attrs}
+
     @classmethod
     def create_ad_hoc_model(cls, fields, model_name='AdHocModel'):
         # fields is a list of tuples (name, db_type)
@@ -237,6 +293,12 @@ class ModelBase(type):
             args = [int(n.strip()) for n in db_type[p + 1 : -1].split(',')]
             field_class = getattr(orm_fields, db_type[:p] + 'Field')
             return field_class(*args)
+        # AggregateFunction / SimpleAggregateFunction
+        if db_type.startswith('AggregateFunction') or db_type.startswith('SimpleAggregateFunction'):
+            p = db_type.index('(')
+            function, *types = cls._split_type_args(db_type[p + 1 : -1])
+            field_class = getattr(orm_fields, db_type[:p] + 'Field')
+            return field_class(function, *[cls.create_ad_hoc_field(t) for t in types])
         # Nullable
         if db_type.startswith('Nullable'):
             inner_field = cls.create_ad_hoc_field(db_type[9 : -1])
@@ -251,6 +313,23 @@ class ModelBase(type):
             raise NotImplementedError('No field class for %s' % db_type)
         return getattr(orm_fields, name)()
 
+    @staticmethod
+    def _split_type_args(args):
+        # Splits type arguments on the commas that are not nested in parentheses, for example
+        # "quantiles(0.5, 0.9), Float64" ==> ["quantiles(0.5, 0.9)", "Float64"]
+        parts = []
+        depth = start = 0
+        for i, c in enumerate(args):
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == ',' and depth == 0:
+                parts.append(args[start : i].strip())
+                start = i + 1
+        parts.append(args[start:].strip())
+        return parts
+
 
 class Model(metaclass=ModelBase):
     '''
@@ -263,11 +342,17 @@ class Model(metaclass=ModelBase):
             engine = Memory()
     '''
 
+    # Model instances have a __dict__ unless the model is compact
+    __slots__ = ()
+
     engine = None
 
     # Insert operations are restricted for read only models
     _readonly = False
 
+    # Compact models store field values in slots instead of a per-instance __dict__
+    _compact = False
+
     # Create table, drop table, insert operations are restricted for system models
     _system = False
 
@@ -282,7 +367,13 @@ class Model(metaclass=ModelBase):
         '''
         super(Model, self).__init__()
         # Assign default values
-        self.__dict__.update(self._defaults)
+        if self._compact:
+            set_value = super(Model, self).__setattr__
+            set_value('_database', None)
+            for name, value in self._defaults.items():
+                set_value(name, value)
+        else:
+            self.__dict__.update(self._defaults)
         # Assign field values from keyword arguments
         for name, value in kwargs.items():
             field = self.get_field(name)
@@ -330,6 +421,14 @@ class Model(metaclass=ModelBase):
         '''
         return self._fields.get(name)
 
+    def _get_values(self):
+        '''
+        Returns a mapping from field name to the instance's value for that field.
+        '''
+        if self._compact:
+            return {name: getattr(self, name) for name in self._fields}
+        return self.__dict__
+
     @classmethod
     def table_name(cls):
         '''
@@ -406,7 +505,7 @@ class Model(metaclass=ModelBase):
 
         - `include_readonly`: if false, returns only fields that can be inserted into database.
         '''
-        data = self.__dict__
+        data = self._get_values()
         fields = self.fields(writable=not include_readonly)
         return '\t'.join(field.to_db_string(data[name], quote=False) for name, field in fields.items())
 
@@ -417,7 +516,7 @@ class Model(metaclass=ModelBase):
 
         - `include_readonly`: if false, returns only fields that can be inserted into database.
         '''
-        data = self.__dict__
+        data = self._get_values()
         fields = self.fields(writable=not include_readonly)
         parts = []
         for name, field in fields.items():
@@ -445,7 +544,7 @@ class Model(metaclass=ModelBase):
         if field_names is not None:
             fields = [f for f in fields if f in field_names]
 
-        data = self.__dict__
+        data = self._get_values()
         return {name: data[name] for name in fields}
 
     @classmethod
@@ -479,9 +578,18 @@ class Model(metaclass=ModelBase):
         '''
         return cls._system
 
+    @classmethod
+    def is_compact(cls):
+        '''
+        Returns true if the model stores its field values in slots instead of a `__dict__`.
+        '''
+        return cls._compact
+
 
 class BufferModel(Model):
 
+    __slots__ = ()
+
     @classmethod
     def create_table_sql(cls, db):
         '''
@@ -500,6 +608,8 @@ class MergeModel(Model):
     Predefines virtual _table column an controls that rows can't be inserted to this table type
     https://clickhouse.tech/docs/en/single/index.html#document-table_engines/merge
     '''
+    __slots__ = ()
+
     readonly = True
 
     # Virtual fields can't be inserted into database
@@ -529,6 +639,8 @@ class DistributedModel(Model):
     Model class for use with a `Distributed` engine.
     """
 
+    __slots__ = ()
+
     def set_database(self, db):
         '''
         Sets the `Database` that this model instance belongs to.
@@ -605,5 +717,52 @@ class DistributedModel(Model):
         return '\n'.join(parts)
 
 
+class MaterializedViewModel(Model):
+    """
+    Model class for a materialized view. Whenever rows are inserted into the source table,
+    the view runs its query over them and writes the results into a target table.
+    The target is the model's superclass, and the model inherits its fields.
+    The query is given in the `view_query` attribute, and its model is the source table:
+
+        class EventRollupView(EventRollup, MaterializedViewModel):
+            view_query = Event.objects_in(None).aggregate(...)
+
+    The names of the selected fields must match the names of the target model's fields.
+    Rows that existed in the source table before the view was created are not copied
+    to the target table.
+    """
+
+    __slots__ = ()
+
+    _readonly = True
+
+    view_query = None
+
+    @classmethod
+    def target_model(cls):
+        """
+        Returns the model of the table that the view writes to, which is the
+        model's only superclass that is not a materialized view.
+        """
+        target_models = [b for b in cls.__bases__ if issubclass(b, Model)
+                         and not issubclass(b, MaterializedViewModel)]
+        if len(target_models) != 1:
+            raise TypeError("When defining a materialized view "
+                            "ensure that your model has exactly one non-view superclass")
+        return target_models[0]
+
+    @classmethod
+    def create_table_sql(cls, db):
+        '''
+        Returns the SQL statement for creating the materialized view.
+        '''
+        assert isinstance(cls.view_query, QuerySet), "view_query must be a QuerySet instance"
+        parts = [
+            'CREATE MATERIALIZED VIEW IF NOT EXISTS `{0}`.`{1}` TO `{0}`.`{2}`'.format(
+                db.db_name, cls.table_name(), cls.target_model().table_name()),
+            'AS ' + cls.view_query.as_sql()]
+        return '\n'.join(parts)
+
+
 # Expose only relevant classes in import *
 __all__ = get_subclass_names(locals(), (Model, Constraint, Index))
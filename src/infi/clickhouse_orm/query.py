@@ -1,10 +1,13 @@
 from __future__ import unicode_literals
 
+import re
+import json
 import pytz
-from copy import copy, deepcopy
+from copy import copy
 from math import ceil
+from fractions import Fraction
 from datetime import date, datetime
-from .utils import comma_join, string_or_func, arg_to_sql
+from .utils import comma_join, string_or_func, arg_to_sql, escape
 
 
 # TODO
@@ -26,6 +29,8 @@ class Operator(object):
         from infi.clickhouse_orm.funcs import F
         if isinstance(value, F):
             return value.to_sql()
+        if isinstance(value, Param):
+            return value.to_sql(field.get_sql(with_default_expression=False))
         return field.to_db_string(field.to_python(value, pytz.utc), quote)
 
 
@@ -59,6 +64,9 @@ class InOperator(Operator):
         field = getattr(model_cls, field_name)
         if isinstance(value, QuerySet):
             value = value.as_sql()
+        elif isinstance(value, Param):
+            # The parameter's value is an array of values
+            return '%s IN %s' % (field_name, value.to_sql('Array(%s)' % field.get_sql(with_default_expression=False)))
         elif isinstance(value, str):
             pass
         else:
@@ -78,6 +86,8 @@ class LikeOperator(Operator):
 
     def to_sql(self, model_cls, field_name, value):
         field = getattr(model_cls, field_name)
+        if isinstance(value, Param):
+            return self._param_to_sql(field, field_name, value)
         value = self._value_to_sql(field, value, quote=False)
         value = value.replace('\\', '\\\\').replace('%', '\\\\%').replace('_', '\\\\_')
         pattern = self._pattern.format(value)
@@ -86,6 +96,16 @@ class LikeOperator(Operator):
         else:
             return 'lowerUTF8(%s) LIKE lowerUTF8(\'%s\')' % (field_name, pattern)
 
+    def _param_to_sql(self, field, field_name, param):
+        # Build the pattern on the server, escaping special characters in the parameter's value
+        prefix, suffix = self._pattern.split('{}')
+        value = r"replaceRegexpAll(%s, '([\\\\%%_])', '\\\\\\1')" % self._value_to_sql(field, param)
+        pattern = "concat('%s', %s, '%s')" % (prefix, value, suffix)
+        if self._case_sensitive:
+            return '%s LIKE %s' % (field_name, pattern)
+        else:
+            return 'lowerUTF8(%s) LIKE lowerUTF8(%s)' % (field_name, pattern)
+
 
 class IExactOperator(Operator):
     """
@@ -157,6 +177,36 @@ register_operator('iendswith',   LikeOperator('%{}', False))
 register_operator('iexact',      IExactOperator())
 
 
+class Param(object):
+    """
+    A placeholder for a query parameter, whose value is sent to the server separately
+    from the query. Can be used instead of a value in queryset filters and in functions.
+    """
+
+    def __init__(self, name, db_type=None):
+        """
+        Initializer.
+
+        - `name`: the parameter name, to use when supplying its value.
+        - `db_type`: the parameter's ClickHouse type, for example `'Array(String)'`. When the
+          parameter is used in a queryset filter, the type is taken from the model field by default.
+        """
+        assert name.isidentifier(), 'Invalid query parameter name: %s' % name
+        self.name = name
+        self.db_type = db_type
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
+
+    def to_sql(self, db_type=None):
+        """
+        Returns the placeholder's SQL, with the given type unless one was specified in the initializer.
+        """
+        db_type = self.db_type or db_type
+        assert db_type, 'No type was given for query parameter %s' % self.name
+        return '{%s:%s}' % (self.name, db_type)
+
+
 class Cond(object):
     """
     An abstract object for storing a single query condition Field + Operator + Value.
@@ -166,9 +216,21 @@ class Cond(object):
         raise NotImplementedError
 
 
+class SQLCond(Cond):
+    """
+    A query condition given as an SQL expression, for example a condition on a virtual column.
+    """
+    def __init__(self, sql):
+        self._sql = sql
+
+    def to_sql(self, model_cls):
+        return self._sql
+
+
 class FieldCond(Cond):
     """
     A single query condition made up of Field + Operator + Value.
+    Conditions are immutable, so they can be shared between querysets.
     """
     def __init__(self, field_name, operator, value):
         self._field_name = field_name
@@ -177,27 +239,41 @@ class FieldCond(Cond):
             # The field name contains __ like my__field
             self._field_name = field_name + '__' + operator
             self._operator = _operators['eq']
+        if isinstance(value, (list, set, frozenset)):
+            # Take a snapshot of mutable values, so that changing them later does not affect the query
+            value = tuple(value)
         self._value = value
+        self._sql_cache = {}
 
     def to_sql(self, model_cls):
-        return self._operator.to_sql(model_cls, self._field_name, self._value)
+        sql = self._sql_cache.get(model_cls)
+        if sql is None:
+            sql = self._sql_cache[model_cls] = self._operator.to_sql(model_cls, self._field_name, self._value)
+        return sql
+
+    def __copy__(self):
+        return self
 
     def __deepcopy__(self, memodict={}):
-        res = copy(self)
-        res._value = deepcopy(self._value)
-        return res
+        return self
 
 
 class Q(object):
+    """
+    A tree of query conditions that can be combined using `&`, `|` and `~`.
+    Q objects are immutable - combining them creates a new object that shares
+    the existing subtrees, and the SQL of each subtree is generated only once.
+    """
 
     AND_MODE = 'AND'
     OR_MODE = 'OR'
 
     def __init__(self, *filter_funcs, **filter_fields):
-        self._conds = list(filter_funcs) + [self._build_cond(k, v) for k, v in filter_fields.items()]
-        self._children = []
+        self._conds = tuple(filter_funcs) + tuple(self._build_cond(k, v) for k, v in filter_fields.items())
+        self._children = ()
         self._negate = False
         self._mode = self.AND_MODE
+        self._sql_cache = {}
 
     @property
     def is_empty(self):
@@ -207,21 +283,25 @@ class Q(object):
         """
         return not bool(self._conds or self._children)
 
+    @classmethod
+    def _create(cls, conds, children, mode, negate):
+        q = cls.__new__(cls)
+        q._conds = conds
+        q._children = children
+        q._mode = mode
+        q._negate = negate
+        q._sql_cache = {}
+        return q
+
     @classmethod
     def _construct_from(cls, l_child, r_child, mode):
         if mode == l_child._mode and not l_child._negate:
-            q = deepcopy(l_child)
-            q._children.append(deepcopy(r_child))
+            return cls._create(l_child._conds, l_child._children + (r_child,), mode, False)
         elif mode == r_child._mode and not r_child._negate:
-            q = deepcopy(r_child)
-            q._children.append(deepcopy(l_child))
+            return cls._create(r_child._conds, r_child._children + (l_child,), mode, False)
         else:
             # Different modes
-            q = Q()
-            q._children = [l_child, r_child]
-            q._mode = mode  # AND/OR
-
-        return q
+            return cls._create((), (l_child, r_child), mode, False)
 
     def _build_cond(self, key, value):
         if '__' in key:
@@ -231,6 +311,12 @@ class Q(object):
         return FieldCond(field_name, operator, value)
 
     def to_sql(self, model_cls):
+        sql = self._sql_cache.get(model_cls)
+        if sql is None:
+            sql = self._sql_cache[model_cls] = self._build_sql(model_cls)
+        return sql
+
+    def _build_sql(self, model_cls):
         condition_sql = []
 
         if self._conds:
@@ -261,23 +347,16 @@ class Q(object):
         return Q._construct_from(self, other, self.AND_MODE)
 
     def __invert__(self):
-        q = copy(self)
-        q._negate = True
-        return q
+        return self._create(self._conds, self._children, self._mode, True)
 
     def __bool__(self):
         return not self.is_empty
 
-    def __deepcopy__(self, memodict={}):
-        q = Q()
-        q._conds = [deepcopy(cond) for cond in self._conds]
-        q._negate = self._negate
-        q._mode = self._mode
-
-        if self._children:
-            q._children = [deepcopy(child) for child in self._children]
+    def __copy__(self):
+        return self
 
-        return q
+    def __deepcopy__(self, memodict={}):
+        return self
 
 
 class QuerySet(object):
@@ -306,6 +385,7 @@ class QuerySet(object):
         self._limit_by_fields = None
         self._distinct = False
         self._final = False
+        self._sample = None
 
     def __iter__(self):
         """
@@ -317,7 +397,7 @@ class QuerySet(object):
         """
         Returns true if this queryset matches any rows.
         """
-        return bool(self.count())
+        return self.exists()
 
     def __nonzero__(self):      # Python 2 compatibility
         return type(self).__bool__(self)
@@ -373,14 +453,22 @@ class QuerySet(object):
         """
         Returns the whole query as a SQL string.
         """
+        return self._build_sql(self.select_fields_as_sql())
+
+    def _build_sql(self, select_fields_sql):
         distinct = 'DISTINCT ' if self._distinct else ''
         final = ' FINAL' if self._final else ''
         table_name = '`%s`' % self._model_cls.table_name()
         if self._model_cls.is_system_model():
             table_name = '`system`.' + table_name
-        params = (distinct, self.select_fields_as_sql(), table_name, final)
+        params = (distinct, select_fields_sql, table_name, final)
         sql = u'SELECT %s%s\nFROM %s%s' % params
 
+        if self._sample:
+            sql += ' SAMPLE %s' % self._sample[0]
+            if self._sample[1] is not None:
+                sql += ' OFFSET %s' % self._sample[1]
+
         if self._prewhere_q and not self._prewhere_q.is_empty:
             sql += '\nPREWHERE ' + self.conditions_as_sql(prewhere=True)
 
@@ -421,11 +509,34 @@ class QuerySet(object):
         q_object = self._prewhere_q if prewhere else self._where_q
         return q_object.to_sql(self._model_cls)
 
-    def count(self):
+    def count(self, scaled=False, approximate=False):
         """
         Returns the number of matching model instances.
+
+        - `scaled`: for sampled querysets, whether to return an estimate of the number of
+          matching instances in the whole table instead of in the sample.
+        - `approximate`: if true, and the queryset is not filtered, sliced or sampled,
+          the number of rows is taken from the table's active parts in `system.parts`
+          without reading any data. The result might include rows that are not yet
+          collapsed or deduplicated by a merge. Otherwise an exact count is returned.
         """
-        if self._distinct or self._limits:
+        if approximate and self._is_whole_table():
+            from .system_models import SystemPart
+            conditions = 'table=%s' % escape(self._model_cls.table_name())
+            return sum(part.rows for part in SystemPart.get_active(self._database, conditions))
+
+        if scaled:
+            assert self._sample, 'Only sampled querysets can be counted with scaled=True'
+            assert not self._distinct, 'Cannot estimate the count of a distinct queryset'
+            # Sum the _sample_factor virtual column, each sampled row stands for that many rows
+            qs = copy(self)
+            qs._fields = ['_sample_factor']
+            qs._order_by = []
+            sql = u'SELECT sum(_sample_factor) FROM (%s)' % qs.as_sql()
+            raw = self._database.raw(sql)
+            return int(round(float(raw))) if raw.strip() else 0
+
+        if self._distinct or self._limits or self._sample:
             # Use a subquery, since a simple count won't be accurate
             sql = u'SELECT count() FROM (%s)' % self.as_sql()
             raw = self._database.raw(sql)
@@ -435,6 +546,34 @@ class QuerySet(object):
         conditions = (self._where_q & self._prewhere_q).to_sql(self._model_cls)
         return self._database.count(self._model_cls, conditions)
 
+    def _is_whole_table(self):
+        # Whether the queryset covers all the rows of a MergeTree table
+        from .engines import MergeTree
+        from .models import MaterializedViewModel
+        if self._model_cls.is_system_model() or not isinstance(getattr(self._model_cls, 'engine', None), MergeTree):
+            return False
+        if issubclass(self._model_cls, MaterializedViewModel):
+            # The rows are stored in the view's target table
+            return False
+        if self._distinct or self._final or self._limits or self._limit_by or self._sample:
+            return False
+        return self._where_q.is_empty and self._prewhere_q.is_empty
+
+    def exists(self):
+        """
+        Returns true if this queryset matches any rows. This is cheaper than
+        `count()`, since the query stops at the first matching row.
+        """
+        if self._distinct or self._limits or self._limit_by:
+            # The matching rows depend on the whole query
+            sql = u'SELECT 1 FROM (%s) LIMIT 1' % self.as_sql()
+        else:
+            qs = copy(self)
+            qs._order_by = []
+            qs._limits = (0, 1)
+            sql = qs._build_sql('1')
+        return bool(self._database.raw(sql))
+
     def order_by(self, *field_names):
         """
         Returns a copy of this queryset with the ordering changed.
@@ -476,7 +615,7 @@ class QuerySet(object):
         if inverse:
             condition = ~condition
 
-        condition = copy(self._prewhere_q if prewhere else self._where_q) & condition
+        condition = (self._prewhere_q if prewhere else self._where_q) & condition
         if prewhere:
             qs._prewhere_q = condition
         else:
@@ -498,7 +637,7 @@ class QuerySet(object):
         """
         return self._filter_or_exclude(*q, _inverse=True, **kwargs)
 
-    def paginate(self, page_num=1, page_size=100):
+    def paginate(self, page_num=1, page_size=100, single_query=False):
         """
         Returns a single page of model instances that match the queryset.
         Note that `order_by` should be used first, to ensure a correct
@@ -506,11 +645,23 @@ class QuerySet(object):
 
         - `page_num`: the page number (1-based), or -1 to get the last page.
         - `page_size`: number of records to return per page.
+        - `single_query`: if true, get the page and the total number of matches in a single
+          query using `count() OVER ()`, instead of running a separate count query first.
+          Requires a ClickHouse version that supports window functions.
 
         The result is a namedtuple containing `objects` (list), `number_of_objects`,
         `pages_total`, `number` (of the current page), and `page_size`.
         """
         from .database import Page
+        if single_query and page_num != -1 and not (self._distinct or self._limits or self._limit_by
+                                                    or self._grouping_with_totals):
+            # The window function is computed before DISTINCT, LIMIT BY and WITH TOTALS,
+            # so those querysets use a separate count query
+            def build_query(offset):
+                qs = self[offset : offset + page_size]
+                return qs._build_sql(comma_join([qs.select_fields_as_sql(), 'count() OVER () AS `_total`']))
+            model_cls = None if isinstance(self, AggregateQuerySet) else self._model_cls
+            return self._database._paginate_single_query(build_query, self.count, model_cls, page_num, page_size)
         count = self.count()
         pages_total = int(ceil(count / float(page_size)))
         if page_num == -1:
@@ -548,6 +699,40 @@ class QuerySet(object):
         qs._final = True
         return qs
 
+    def sample(self, ratio_or_rows, offset=None):
+        """
+        Returns a copy of this queryset that reads only a sample of the data, using
+        the `SAMPLE` clause. Can be used only with tables that have a sampling key
+        (see the `sampling_expr` parameter of the `MergeTree` engines).
+
+        - `ratio_or_rows`: the relative size of the sample as a number between 0 and 1
+          (for example `0.1` or `Fraction(1, 10)`), or an integer greater than 1
+          for the approximate number of rows to read.
+        - `offset`: the relative offset of the sample, as a number between 0 and 1.
+
+        Use `count(scaled=True)` to estimate the number of matching rows in the whole table.
+        In aggregations, the `_sample_factor` virtual column can be used to scale the
+        results, for example `sum(_sample_factor)` instead of `count()`.
+        """
+        from .engines import MergeTree, Distributed
+        engine = getattr(self._model_cls, 'engine', None)
+        if isinstance(engine, Distributed) and not isinstance(engine.table, str):
+            engine = getattr(engine.table, 'engine', None)
+        if not isinstance(engine, MergeTree) or not engine.sampling_expr:
+            raise TypeError('sample() method can be used only with tables that have a sampling key')
+        is_rows = isinstance(ratio_or_rows, int) and ratio_or_rows > 1
+        assert is_rows or 0 < ratio_or_rows <= 1, 'Sample size must be a ratio between 0 and 1, or a number of rows'
+        assert offset is None or 0 <= offset < 1, 'Sample offset must be a ratio between 0 and 1'
+        assert offset is None or not is_rows, 'Sample offset can be used only with a relative sample size'
+        qs = copy(self)
+        qs._sample = (self._ratio_to_sql(ratio_or_rows), None if offset is None else self._ratio_to_sql(offset))
+        return qs
+
+    def _ratio_to_sql(self, value):
+        if isinstance(value, Fraction):
+            return '%d/%d' % (value.numerator, value.denominator)
+        return str(value)
+
     def delete(self):
         """
         Deletes all records matched by this queryset's conditions.
@@ -582,6 +767,113 @@ class QuerySet(object):
         assert not self._distinct, 'Mutations are not allowed after calling distinct()'
         assert not self._final, 'Mutations are not allowed after calling final()'
 
+    def insert_into(self, target_model, workers=1, by_partition=True, key=None, chunks=None,
+                    retries=2, progress=None):
+        """
+        Copies the rows matching this queryset into the table of another model, using
+        `INSERT INTO ... SELECT` statements that run on the server. The rows are split
+        into chunks that are copied in parallel, so that no single statement runs for too long.
+        A chunk that fails with a server error, a connection error or a timeout is retried. After a
+        connection error or a timeout the attempt may still be running, so it is killed first.
+        A failed attempt may have inserted some of its rows, so retrying can insert them twice,
+        unless the target table deduplicates inserts. On ClickHouse 22.2 and above every chunk is
+        inserted with its own `insert_deduplication_token`, which is used by replicated tables, and
+        by other MergeTree tables that set `non_replicated_deduplication_window`.
+
+        - `target_model`: the model of the table to insert into. Only the fields that exist in
+          both models are copied, and other columns of the target table get their default values.
+        - `workers`: the number of chunks to copy in parallel.
+        - `by_partition`: whether to copy each partition of the source table separately.
+        - `key`: when `by_partition` is false, the name of a numeric or date field for splitting
+          the rows into ranges of similar sizes. Rows whose key is NULL or NaN are copied in a chunk of
+          their own. Without a key, the rows are copied in a single chunk.
+        - `chunks`: the number of key ranges (by default, 4 times the number of workers).
+        - `retries`: the number of times to retry a chunk that failed.
+          Other errors, such as a `DatabaseException` raised by the client, are not retried.
+        - `progress`: an optional function to call after each chunk is copied, with the number
+          of chunks that were copied so far and the total number of chunks.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from time import sleep
+        from uuid import uuid4
+        from requests.exceptions import ConnectionError, Timeout
+        from .database import ServerError
+        assert not self._limits, 'Cannot insert from a sliced queryset'
+        assert not self._limit_by, 'Cannot insert from a queryset after calling limit_by(...)'
+        assert not self._distinct, 'Cannot insert from a queryset after calling distinct()'
+        assert workers >= 1, 'workers must be at least 1'
+        target_fields = target_model.fields()
+        columns = [name for name in self._fields
+                   if name in target_fields and not (target_fields[name].materialized or target_fields[name].alias)]
+        assert columns, 'The models have no fields in common'
+        qs = copy(self)
+        qs._fields = columns
+        qs._order_by = []
+        insert_sql = 'INSERT INTO $db.`%s` (%s)\n' % (target_model.table_name(), comma_join('`%s`' % c for c in columns))
+        statements = [insert_sql + chunk_qs.as_sql() for chunk_qs in qs._split(by_partition, key, chunks or 4 * workers)]
+        token = str(uuid4())
+        def run(i):
+            settings = {}
+            if self._database.server_version >= (22, 2):
+                # Retries of the same chunk have the same token, for deduplication
+                settings['insert_deduplication_token'] = '%s-%d' % (token, i)
+            for attempt in range(retries + 1):
+                settings['query_id'] = '%s-%d-%d' % (token, i, attempt)
+                try:
+                    self._database.raw(statements[i], settings=settings)
+                    return
+                except (ServerError, ConnectionError, Timeout) as e:
+                    if attempt == retries:
+                        raise
+                    if not isinstance(e, ServerError):
+                        # The query may still be running on the server it was sent to
+                        for url in set(self._database.write_urls):
+                            self._database._kill_query(url, settings['query_id'], sync=True)
+                    sleep(2 ** attempt)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run, i) for i in range(len(statements))]
+            try:
+                for done, future in enumerate(futures, 1):
+                    future.result()
+                    if progress:
+                        progress(done, len(statements))
+            finally:
+                # After a failure, do not start copying any more chunks
+                for future in futures:
+                    future.cancel()
+
+    def _split(self, by_partition, key, chunks):
+        """
+        Returns a list of querysets that together cover the rows of this queryset.
+        """
+        from .engines import MergeTree
+        from .fields import BaseFloatField, NullableField
+        if by_partition and isinstance(self._model_cls.engine, MergeTree):
+            from .system_models import SystemPart
+            conditions = 'table=%s' % escape(self._model_cls.table_name())
+            partition_ids = sorted(set(part.partition_id for part in SystemPart.get_active(self._database, conditions)))
+            return [self.filter(Q(SQLCond('_partition_id = %s' % escape(partition_id))))
+                    for partition_id in partition_ids]
+        if key and chunks > 1:
+            # Find boundaries that split the rows into ranges of similar sizes
+            levels = comma_join('%g' % (i / chunks) for i in range(1, chunks))
+            aggregate_qs = self.aggregate(boundaries='quantiles(%s)(`%s`)' % (levels, key))
+            # Quantiles of numbers are NaN when there are no rows
+            boundaries = sorted(set(b for b in next(iter(aggregate_qs)).boundaries if b == b))
+            if boundaries:
+                ranges = [Q(**{key + '__lt': boundaries[0]})]
+                ranges += [Q(**{key + '__gte': low, key + '__lt': high}) for low, high in zip(boundaries, boundaries[1:])]
+                ranges.append(Q(**{key + '__gte': boundaries[-1]}))
+                # NULL and NaN values are not in any of the ranges
+                field = self._model_cls.fields()[key]
+                if isinstance(field, NullableField):
+                    ranges.append(Q(SQLCond('isNull(`%s`)' % key)))
+                    field = field.inner_field
+                if isinstance(field, BaseFloatField):
+                    ranges.append(Q(SQLCond('isNaN(`%s`)' % key)))
+                return [self.filter(q) for q in ranges]
+        return [self]
+
     def aggregate(self, *args, **kwargs):
         """
         Returns an `AggregateQuerySet` over this query, with `args` serving as
@@ -599,6 +891,83 @@ class QuerySet(object):
         """
         return AggregateQuerySet(self, args, kwargs)
 
+    def prepare(self):
+        """
+        Returns a `PreparedQuery` holding the SQL of this queryset, which can be executed
+        many times with different values for its query parameters. Use `Param` objects
+        instead of values to define the parameters. For example:
+        ```
+            query = Person.objects_in(database).filter(last_name=Param('name')).prepare()
+            people = list(query.execute(name='Smith'))
+        ```
+        """
+        return PreparedQuery(self._database, self.as_sql(), self._model_cls)
+
+    def explain(self, kind='plan'):
+        """
+        Returns the output of ClickHouse's `EXPLAIN` statement for this queryset.
+
+        - `kind`: `'plan'` or `'pipeline'` to get the query plan or the query pipeline,
+          as a list of lines. `'indexes'` to get a list of dicts, describing how each of
+          the indexes of the table was used for skipping data. Each dict contains the
+          `table` and the index `type`, along with keys such as `condition`, `initial_parts`,
+          `selected_parts`, `initial_granules` and `selected_granules`.
+        """
+        assert kind in ('plan', 'pipeline', 'indexes'), 'kind must be "plan", "pipeline" or "indexes"'
+        if kind == 'indexes':
+            sql = u'EXPLAIN json = 1, indexes = 1\n' + self.as_sql()
+            lines = [row.explain for row in self._database.select(sql)]
+            return list(self._parse_explained_indexes(json.loads('\n'.join(lines))))
+        sql = u'EXPLAIN %s\n%s' % (kind.upper(), self.as_sql())
+        return [row.explain for row in self._database.select(sql)]
+
+    def _parse_explained_indexes(self, plans):
+        # Finds the steps in the JSON plan that read from tables, and yields their indexes
+        for item in plans:
+            plan = item.get('Plan', item)
+            for index in plan.get('Indexes', []):
+                index = {key.lower().replace(' ', '_'): value for key, value in index.items()}
+                index['table'] = plan.get('Description')
+                yield index
+            yield from self._parse_explained_indexes(plan.get('Plans', []))
+
+    def profile(self):
+        """
+        Runs the query on the server without fetching its results, and returns the
+        query's statistics as recorded in `system.query_log`. The returned object has the
+        attributes `query_duration_ms`, `read_rows`, `read_bytes`, `result_rows` and
+        `memory_usage`. This requires query logging to be enabled on the server.
+        """
+        from uuid import uuid4
+        from .database import DatabaseException
+        query_id = str(uuid4())
+        # The query log is local to each server, so all the queries must go to the same one
+        with self._database._single_server():
+            self._database.raw(self.as_sql() + '\nFORMAT Null', settings={'query_id': query_id, 'log_queries': 1})
+            self._database.raw('SYSTEM FLUSH LOGS')
+            sql = "SELECT query_duration_ms, read_rows, read_bytes, result_rows, memory_usage " \
+                  "FROM system.query_log WHERE event_date >= yesterday() AND type = 'QueryFinish' AND query_id = %s"
+            for row in self._database.select(sql % escape(query_id)):
+                return row
+        raise DatabaseException('Query %s was not found in system.query_log' % query_id)
+
+
+# Exact aggregate functions and their cheaper approximate variants
+APPROXIMATE_FUNCTIONS = {
+    'uniqExact': 'uniq',
+    'medianExact': 'median',
+    'quantileExact': 'quantile',
+    'quantilesExact': 'quantiles',
+    'quantileExactWeighted': 'quantileTDigestWeighted',
+    'quantilesExactWeighted': 'quantilesTDigestWeighted',
+}
+
+# Matches a call to an exact function, possibly with combinators that do not change its result type
+APPROXIMATE_FUNCTIONS_REGEX = re.compile(r'\b(%s)((?:If|Array|ForEach|OrDefault|OrNull)*\s*\()' %
+                                         '|'.join(sorted(APPROXIMATE_FUNCTIONS, key=len, reverse=True)))
+
+COUNT_DISTINCT_REGEX = re.compile(r'\bcount\s*\(\s*DISTINCT\b\s*', re.IGNORECASE)
+
 
 class AggregateQuerySet(QuerySet):
     """
@@ -629,6 +998,8 @@ class AggregateQuerySet(QuerySet):
         self._prewhere_q = base_qs._prewhere_q
         self._limits = base_qs._limits
         self._distinct = base_qs._distinct
+        self._sample = base_qs._sample
+        self._approximate = False
 
     def group_by(self, *args):
         """
@@ -655,15 +1026,35 @@ class AggregateQuerySet(QuerySet):
         """
         raise NotImplementedError('Cannot re-aggregate an AggregateQuerySet')
 
+    def insert_into(self, *args, **kwargs):
+        """
+        This method is not supported on `AggregateQuerySet`.
+        """
+        raise NotImplementedError('Cannot use "insert_into" with AggregateQuerySet')
+
     def select_fields_as_sql(self):
         """
         Returns the selected fields or expressions as a SQL string.
         """
-        return comma_join([str(f) for f in self._fields] + ['%s AS %s' % (v, k) for k, v in self._calculated_fields.items()])
+        calculated_fields = ['%s AS %s' % (v, k) for k, v in self._calculated_fields.items()]
+        if self._approximate:
+            calculated_fields = [self._approximate_sql(f) for f in calculated_fields]
+        return comma_join([str(f) for f in self._fields] + calculated_fields)
+
+    def _approximate_sql(self, sql):
+        sql = APPROXIMATE_FUNCTIONS_REGEX.sub(lambda m: APPROXIMATE_FUNCTIONS[m.group(1)] + m.group(2), sql)
+        return COUNT_DISTINCT_REGEX.sub('uniq(', sql)
 
     def __iter__(self):
         return self._database.select(self.as_sql()) # using an ad-hoc model
 
+    def prepare(self):
+        """
+        Returns a `PreparedQuery` holding the SQL of this queryset. Its results
+        are instances of an ad-hoc model, as when iterating over the queryset.
+        """
+        return PreparedQuery(self._database, self.as_sql())
+
     def count(self):
         """
         Returns the number of rows after aggregation.
@@ -672,6 +1063,26 @@ class AggregateQuerySet(QuerySet):
         raw = self._database.raw(sql)
         return int(raw) if raw else 0
 
+    def exists(self):
+        """
+        Returns true if the aggregation results in any rows.
+        """
+        sql = u'SELECT 1 FROM (%s) LIMIT 1' % self.as_sql()
+        return bool(self._database.raw(sql))
+
+    def approximate(self):
+        """
+        Returns a copy of this queryset in which exact aggregate functions are replaced
+        with their cheaper approximate variants, that use less memory and time:
+        `uniqExact` and `count(DISTINCT ...)` become `uniq`, `quantileExact` becomes
+        `quantile`, `medianExact` becomes `median`, and so on.
+        Functions with the `-State` and `-Merge` combinators are left unchanged,
+        since their results depend on the exact function.
+        """
+        qs = copy(self)
+        qs._approximate = True
+        return qs
+
     def with_totals(self):
         """
         Adds WITH TOTALS modifier ot GROUP BY, making query return extra row
@@ -686,5 +1097,43 @@ class AggregateQuerySet(QuerySet):
         raise AssertionError('Cannot mutate an AggregateQuerySet')
 
 
+class PreparedQuery(object):
+    """
+    A query whose SQL is generated only once, and which can be executed repeatedly
+    with different values for its query parameters. The values are sent to the
+    database separately from the query, so they never need to be escaped.
+    Normally you should not create this but rather use `QuerySet.prepare()`.
+    """
+
+    def __init__(self, database, sql, model_cls=None):
+        self._database = database
+        self._sql = sql
+        self._model_cls = model_cls
+
+    def __str__(self):
+        return self._sql
+
+    def as_sql(self):
+        """
+        Returns the query as an SQL string, with placeholders for its parameters.
+        """
+        return self._sql
+
+    def execute(self, **params):
+        """
+        Runs the query using the given parameter values, and returns a generator
+        of model instances (or ad-hoc model instances for aggregate queries).
+        """
+        return self._database.select(self._sql, self._model_cls, params=params)
+
+    def count(self, **params):
+        """
+        Returns the number of rows matched by the query using the given parameter values.
+        """
+        sql = u'SELECT count() FROM (%s)' % self._sql
+        raw = self._database.raw(sql, params=params)
+        return int(raw) if raw else 0
+
+
 # Expose only relevant classes in import *
-__all__ = [c.__name__ for c in [Q, QuerySet, AggregateQuerySet]]
+__all__ = [c.__name__ for c in [Q, QuerySet, AggregateQuerySet, Param, PreparedQuery]]
@@ -0,0 +1,402 @@
+'''
+Client-side evaluation of the sharding keys of `Distributed` tables, used by
+`Database.insert_to_shards` for sending each row directly to its shard.
+'''
+import random
+import re
+import struct
+from datetime import date
+from itertools import chain
+
+from .fields import (BaseEnumField, BaseIntField, DateField, DateTimeField, FixedStringField,
+                     LowCardinalityField, StringField)
+from .utils import escape
+
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# Constants of CityHash v1.0.2, the version used by ClickHouse's cityHash64
+K0 = 0xc3a5c85c97cb3127
+K1 = 0xb492b66fbe98f273
+K2 = 0x9ae16a3b2f90404f
+K3 = 0xc949d7c7509e6557
+K_MUL = 0x9ddfea08eb382d69
+
+
+def _fetch64(s, i):
+    return struct.unpack_from('<Q', s, i)[0]
+
+
+def _fetch32(s, i):
+    return struct.unpack_from('<I', s, i)[0]
+
+
+def _rotate(val, shift):
+    return val if shift == 0 else ((val >> shift) | (val << (64 - shift))) & MASK64
+
+
+def _shift_mix(val):
+    return val ^ (val >> 47)
+
+
+def _hash_128_to_64(low, high):
+    a = ((low ^ high) * K_MUL) & MASK64
+    a ^= a >> 47
+    b = ((high ^ a) * K_MUL) & MASK64
+    b ^= b >> 47
+    return (b * K_MUL) & MASK64
+
+
+def _hash_len_0_to_16(s):
+    n = len(s)
+    if n > 8:
+        a = _fetch64(s, 0)
+        b = _fetch64(s, n - 8)
+        return _hash_128_to_64(a, _rotate((b + n) & MASK64, n)) ^ b
+    if n >= 4:
+        a = _fetch32(s, 0)
+        return _hash_128_to_64((n + (a << 3)) & MASK64, _fetch32(s, n - 4))
+    if n > 0:
+        y = s[0] + (s[n >> 1] << 8)
+        z = n + (s[n - 1] << 2)
+        return (_shift_mix(((y * K2) ^ (z * K3)) & MASK64) * K2) & MASK64
+    return K2
+
+
+def _hash_len_17_to_32(s):
+    n = len(s)
+    a = (_fetch64(s, 0) * K1) & MASK64
+    b = _fetch64(s, 8)
+    c = (_fetch64(s, n - 8) * K2) & MASK64
+    d = (_fetch64(s, n - 16) * K0) & MASK64
+    return _hash_128_to_64((_rotate((a - b) & MASK64, 43) + _rotate(c, 30) + d) & MASK64,
+                           (a + _rotate(b ^ K3, 20) - c + n) & MASK64)
+
+
+def _weak_hash_len_32_with_seeds(s, i, a, b):
+    w, x, y, z = struct.unpack_from('<4Q', s, i)
+    a = (a + w) & MASK64
+    b = _rotate((b + a + z) & MASK64, 21)
+    c = a
+    a = (a + x + y) & MASK64
+    b = (b + _rotate(a, 44)) & MASK64
+    return (a + z) & MASK64, (b + c) & MASK64
+
+
+def _hash_len_33_to_64(s):
+    n = len(s)
+    z = _fetch64(s, 24)
+    a = (_fetch64(s, 0) + (n + _fetch64(s, n - 16)) * K0) & MASK64
+    b = _rotate((a + z) & MASK64, 52)
+    c = _rotate(a, 37)
+    a = (a + _fetch64(s, 8)) & MASK64
+    c = (c + _rotate(a, 7)) & MASK64
+    a = (a + _fetch64(s, 16)) & MASK64
+    vf = (a + z) & MASK64
+    vs = (b + _rotate(a, 31) + c) & MASK64
+    a = (_fetch64(s, 16) + _fetch64(s, n - 32)) & MASK64
+    z = _fetch64(s, n - 8)
+    b = _rotate((a + z) & MASK64, 52)
+    c = _rotate(a, 37)
+    a = (a + _fetch64(s, n - 24)) & MASK64
+    c = (c + _rotate(a, 7)) & MASK64
+    a = (a + _fetch64(s, n - 16)) & MASK64
+    wf = (a + z) & MASK64
+    ws = (b + _rotate(a, 31) + c) & MASK64
+    r = _shift_mix(((vf + ws) * K2 + (wf + vs) * K0) & MASK64)
+    return (_shift_mix((r * K0 + vs) & MASK64) * K2) & MASK64
+
+
+def city_hash64(data):
+    '''
+    Returns the 64-bit CityHash (version 1.0.2) of the given bytes, which is
+    the value of ClickHouse's `cityHash64` function for a string argument.
+    '''
+    n = len(data)
+    if n <= 16:
+        return _hash_len_0_to_16(data)
+    if n <= 32:
+        return _hash_len_17_to_32(data)
+    if n <= 64:
+        return _hash_len_33_to_64(data)
+    # For strings over 64 bytes, hash the end first, and then hash 64-byte chunks
+    s = data
+    x = _fetch64(s, 0)
+    y = _fetch64(s, n - 16) ^ K1
+    z = _fetch64(s, n - 56) ^ K0
+    v = _weak_hash_len_32_with_seeds(s, n - 64, n, y)
+    w = _weak_hash_len_32_with_seeds(s, n - 32, (n * K1) & MASK64, K0)
+    z = (z + _shift_mix(v[1]) * K1) & MASK64
+    x = (_rotate((z + x) & MASK64, 39) * K1) & MASK64
+    y = (_rotate(y, 33) * K1) & MASK64
+    for i in range(0, (n - 1) & ~63, 64):
+        x = (_rotate((x + y + v[0] + _fetch64(s, i + 16)) & MASK64, 37) * K1) & MASK64
+        y = (_rotate((y + v[1] + _fetch64(s, i + 48)) & MASK64, 42) * K1) & MASK64
+        x ^= w[1]
+        y ^= v[0]
+        z = _rotate(z ^ w[0], 33)
+        v = _weak_hash_len_32_with_seeds(s, i, (v[1] * K1) & MASK64, (x + w[0]) & MASK64)
+        w = _weak_hash_len_32_with_seeds(s, i + 32, (z + w[1]) & MASK64, y)
+        z, x = x, z
+    return _hash_128_to_64((_hash_128_to_64(v[0], w[0]) + _shift_mix(y) * K1 + z) & MASK64,
+                           (_hash_128_to_64(v[1], w[1]) + x) & MASK64)
+
+
+def int_hash64(value):
+    '''
+    Returns the value of ClickHouse's `intHash64` function for the given integer.
+    '''
+    x = (value & MASK64) ^ 0x4cf2d2baae6da887
+    x ^= x >> 33
+    x = (x * 0xff51afd7ed558ccd) & MASK64
+    x ^= x >> 33
+    x = (x * 0xc4ceb9fe1a85ec53) & MASK64
+    x ^= x >> 33
+    return x
+
+
+def _column_value(model_class, name):
+    '''
+    Returns a function that extracts the value of the given column from a model instance
+    as an integer or as bytes (for strings), the number of bits in an integer value
+    (`None` for strings), and whether the integer is signed.
+    '''
+    field = model_class.fields().get(name.strip('`'))
+    if field is None:
+        raise ValueError('Sharding key refers to an unknown column: %s' % name)
+    attr = field.name
+    if isinstance(field, LowCardinalityField):
+        field = field.inner_field
+    if isinstance(field, FixedStringField):
+        length = field._length
+        return lambda instance: getattr(instance, attr).encode('utf-8').ljust(length, b'\0'), None, False
+    if isinstance(field, StringField):
+        return lambda instance: getattr(instance, attr).encode('utf-8'), None, False
+    if isinstance(field, (BaseIntField, BaseEnumField)):
+        bits = int(re.search(r'\d+', field.db_type).group())
+        signed = not field.db_type.startswith('U')
+        if isinstance(field, BaseEnumField):
+            return lambda instance: getattr(instance, attr).value, bits, signed
+        return lambda instance: getattr(instance, attr), bits, signed
+    if isinstance(field, DateField):
+        epoch = date(1970, 1, 1)
+        return lambda instance: (getattr(instance, attr) - epoch).days, 16, False
+    if type(field) is DateTimeField:
+        return lambda instance: int(getattr(instance, attr).timestamp()), 32, False
+    raise ValueError('Sharding key cannot be evaluated for column %s of type %s' % (name, field.db_type))
+
+
+def _parse_sharding_key(expr, model_class):
+    '''
+    Returns a function that evaluates the given sharding key expression for a model
+    instance, the number of bits in its result, and whether the result is signed.
+    '''
+    match = re.match(r'^(.*\S)\s*%\s*(\d+)$', expr)
+    if match:
+        func, bits, signed = _parse_sharding_key(match.group(1), model_class)
+        divisor = int(match.group(2))
+        # The result type is the divisor's type, enlarged if the result can be negative
+        bits = next(b for b in (8, 16, 32, 64) if divisor < 2 ** b or b == 64)
+        if signed:
+            bits = min(bits * 2, 64)
+        def modulo(instance):
+            # Like in ClickHouse, the remainder has the sign of the dividend
+            value = func(instance)
+            return abs(value) % divisor * (-1 if value < 0 else 1)
+        return modulo, bits, signed
+    match = re.match(r'^(\w+)\s*\((.*)\)$', expr)
+    if not match:
+        func, bits, signed = _column_value(model_class, expr)
+        if bits is None:
+            raise ValueError('Sharding key must be an integer, not a string column: %s' % expr)
+        return func, bits, signed
+    name, args = match.group(1), [arg.strip() for arg in match.group(2).split(',') if arg.strip()]
+    if name in ('rand', 'rand64') and not args:
+        bits = 32 if name == 'rand' else 64
+        return lambda instance: random.getrandbits(bits), bits, False
+    if name == 'intHash64' and len(args) == 1:
+        func, bits, signed = _column_value(model_class, args[0])
+        if bits is not None:
+            # Unlike in cityHash64, signed integers are converted to UInt64 by sign extension
+            return lambda instance: int_hash64(func(instance)), 64, False
+    if name == 'cityHash64' and args:
+        hashers = [_column_hasher(model_class, arg) for arg in args]
+        def city_hash(instance):
+            h = hashers[0](instance)
+            for hasher in hashers[1:]:
+                h = _hash_128_to_64(h, hasher(instance))
+            return h
+        return city_hash, 64, False
+    raise ValueError('Sharding key cannot be evaluated on the client: %s' % expr)
+
+
+def _column_hasher(model_class, name):
+    # Returns a function that computes the cityHash64 of a single column
+    func, bits, signed = _column_value(model_class, name)
+    if bits is None:
+        return lambda instance: city_hash64(func(instance))
+    # Integers are hashed as unsigned numbers of the same size
+    mask = (1 << bits) - 1
+    return lambda instance: int_hash64(func(instance) & mask)
+
+
+def get_sharding_function(sharding_key, model_class):
+    '''
+    Returns a function that evaluates the sharding key of a `Distributed` engine
+    for an instance of the given model class, as an unsigned integer. Raises
+    `ValueError` if the expression is not supported.
+    '''
+    func, bits, signed = _parse_sharding_key(sharding_key.strip(), model_class)
+    mask = (1 << bits) - 1
+    # ClickHouse treats signed keys as unsigned integers of the same size
+    return lambda instance: func(instance) & mask
+
+
+def get_shards(db, cluster):
+    '''
+    Returns the shards of the given cluster as a list of ad-hoc model instances
+    with the fields `shard_num`, `shard_weight` and `host_name` (of the shard's first replica).
+    '''
+    from .database import DatabaseException
+    query = 'SELECT shard_num, shard_weight, host_name FROM system.clusters ' \
+            'WHERE cluster = %s AND replica_num = 1 ORDER BY shard_num' % escape(cluster)
+    shards = list(db.select(query))
+    if not shards:
+        raise DatabaseException('Cluster %s not found in system.clusters' % cluster)
+    return shards
+
+
+def _shard_url(db, host_name):
+    from urllib.parse import urlsplit
+    parts = urlsplit(db.db_url)
+    netloc = '[%s]' % host_name if ':' in host_name else host_name
+    if parts.port:
+        netloc += ':%d' % parts.port
+    return parts._replace(netloc=netloc).geturl()
+
+
+def _connect_to_node(db, url, autocreate=False):
+    # Returns a Database for the same database on another node, with the same connection settings
+    from .database import Database
+    username, password = db.request_session.auth or (None, None)
+    return Database(db.db_name, db_url=url, username=username, password=password, autocreate=autocreate,
+                    timeout=db.timeout, verify_ssl_cert=db.request_session.verify,
+                    log_statements=db.log_statements)
+
+
+def _get_shard_database(db, url):
+    shard_db = db.shard_databases.get(url)
+    if shard_db is None:
+        shard_db = _connect_to_node(db, url)
+        db.shard_databases[url] = shard_db
+    return shard_db
+
+
+def get_cluster_hosts(db, cluster):
+    '''
+    Returns the host names of all the nodes (all the replicas of all the shards) of the given cluster.
+    '''
+    from .database import DatabaseException
+    query = 'SELECT DISTINCT host_name FROM system.clusters WHERE cluster = %s ORDER BY host_name' % escape(cluster)
+    hosts = [row.host_name for row in db.select(query)]
+    if not hosts:
+        raise DatabaseException('Cluster %s not found in system.clusters' % cluster)
+    return hosts
+
+
+def run_on_nodes(db, cluster, func, timeout=None, node_urls=None):
+    '''
+    Calls `func` with a `Database` connected to each node of the cluster, in parallel, and waits
+    up to `timeout` seconds for all the calls to complete. Returns a dict from node URL to the value
+    returned by `func` on that node. By default the node URLs are built from their host names in
+    `system.clusters`, but they can be given in `node_urls` instead.
+    '''
+    from concurrent.futures import ThreadPoolExecutor, wait
+    from .database import DatabaseException
+    if node_urls is None:
+        node_urls = [_shard_url(db, host_name) for host_name in get_cluster_hosts(db, cluster)]
+    executor = ThreadPoolExecutor(max_workers=len(node_urls))
+    futures = {executor.submit(lambda url: func(_connect_to_node(db, url, autocreate=True)), url): url
+               for url in node_urls}
+    done, not_done = wait(futures, timeout=timeout)
+    executor.shutdown(wait=False)
+    if not_done:
+        raise DatabaseException('Timed out after %s seconds waiting for %s'
+                                % (timeout, ', '.join(sorted(futures[f] for f in not_done))))
+    failed = sorted(((futures[f], f.exception()) for f in done if f.exception()), key=lambda item: item[0])
+    if failed:
+        raise DatabaseException('Failed on %d of %d nodes: %s' % (len(failed), len(node_urls),
+                                '; '.join('%s: %s' % (url, e) for url, e in failed))) from failed[0][1]
+    return {futures[f]: f.result() for f in done}
+
+
+def _insert_from_queue(shard_db, table_name, q, batch_size):
+    # Inserts the instances put in the queue until None is received
+    done = False
+    def instances():
+        nonlocal done
+        yield from iter(q.get, None)
+        done = True
+    try:
+        shard_db._insert(instances(), batch_size, table_name)
+    finally:
+        # Consume the rest of the queue after a failure, so that the producer does not block
+        if not done:
+            for instance in iter(q.get, None):
+                pass
+
+
+def insert_to_shards(db, model_instances, batch_size=1000, shard_urls=None):
+    '''
+    Implements `Database.insert_to_shards`.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from queue import Queue
+    from .engines import Distributed
+    i = iter(model_instances)
+    try:
+        first_instance = next(i)
+    except StopIteration:
+        return  # model_instances is empty
+    model_class = first_instance.__class__
+    if not isinstance(model_class.engine, Distributed):
+        raise TypeError('%s does not use the Distributed engine' % model_class.__name__)
+    model_class.fix_engine_table()
+    engine = model_class.engine
+    shards = get_shards(db, engine.cluster)
+    # Like ClickHouse, assign each shard a number of slots according to its weight
+    slots = [index for index, shard in enumerate(shards) for _ in range(shard.shard_weight)]
+    if len(shards) > 1:
+        if not engine.sharding_key:
+            raise ValueError('A sharding key is required for inserting into a cluster with several shards')
+        sharding_function = get_sharding_function(engine.sharding_key, model_class)
+    else:
+        sharding_function = lambda instance: 0
+    shard_urls = shard_urls or {}
+    shard_dbs = [_get_shard_database(db, shard_urls.get(shard.shard_num) or _shard_url(db, shard.host_name))
+                 for shard in shards]
+    queues = [Queue(maxsize=batch_size) for shard in shards]
+    counts = [0] * len(shards)
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        futures = [executor.submit(_insert_from_queue, shard_db, engine.table_name, q, batch_size)
+                   for shard_db, q in zip(shard_dbs, queues)]
+        try:
+            for instance in chain([first_instance], i):
+                index = slots[sharding_function(instance) % len(slots)]
+                queues[index].put(instance)
+                counts[index] += 1
+        finally:
+            for q in queues:
+                q.put(None)
+        failed = [index for index, future in enumerate(futures) if future.exception()]
+    if failed:
+        from .database import DatabaseException
+        succeeded = [index for index in range(len(shards)) if index not in failed]
+        message = 'Failed to insert into %d of %d shards: %s' % (len(failed), len(shards), '; '.join(
+            'shard %d (%s, %d rows): %s' % (shards[index].shard_num, shard_dbs[index].db_url, counts[index],
+                                            futures[index].exception())
+            for index in failed))
+        if succeeded:
+            message += '. The rows of the other shards were inserted: %s' % ', '.join(
+                'shard %d (%d rows)' % (shards[index].shard_num, counts[index]) for index in succeeded)
+        raise DatabaseException(message) from futures[failed[0]].exception()
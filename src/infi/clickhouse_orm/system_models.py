@@ -25,6 +25,7 @@ class SystemPart(Model):
     table = StringField()  # Name of the table that this part belongs to.
     engine = StringField()  # Name of the table engine, without parameters.
     partition = StringField()  # Name of the partition, in the format YYYYMM.
+    partition_id = StringField()  # ID of the partition, as used by the _partition_id virtual column.
     name = StringField()  # Name of the part.
 
     # This field is present in the docs (https://clickhouse.tech/docs/en/single/index.html#system-parts),
@@ -39,6 +40,7 @@ class SystemPart(Model):
     # to get the approximate number of rows in the part.
     marks = UInt64Field()
 
+    rows = UInt64Field()  # Number of rows in the part.
     bytes = UInt64Field()  # Number of bytes when compressed.
 
     # Time the directory with the part was modified. Usually corresponds to the part's creation time.
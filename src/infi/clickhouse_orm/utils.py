@@ -1,6 +1,7 @@
 import codecs
 import re
 from datetime import date, datetime, tzinfo, timedelta
+from functools import lru_cache
 
 
 SPECIAL_CHARS = {
@@ -48,8 +49,8 @@ def arg_to_sql(arg):
     Supports functions, model fields, strings, dates, datetimes, timedeltas, booleans,
     None, numbers, timezones, arrays/iterables.
     """
-    from infi.clickhouse_orm import Field, StringField, DateTimeField, DateField, F, QuerySet
-    if isinstance(arg, F):
+    from infi.clickhouse_orm import Field, StringField, DateTimeField, DateField, F, QuerySet, Param
+    if isinstance(arg, (F, Param)):
         return arg.to_sql()
     if isinstance(arg, Field):
         return "`%s`" % arg
@@ -84,38 +85,110 @@ def parse_tsv(line):
     return [unescape(value) for value in line.split(str('\t'))]
 
 
+# A closing quote is any quote that is not preceded by a backslash
+ARRAY_QUOTED_VALUE_END_REGEX = re.compile(r"(?<!\\)'")
+
+ARRAY_UNQUOTED_VALUE_END_REGEX = re.compile(r"[,\])]")
+
+
 def parse_array(array_string):
     """
     Parse an array or tuple string as returned by clickhouse. For example:
         "['hello', 'world']" ==> ["hello", "world"]
-        "(1,2,3)"            ==> [1, 2, 3]
+        "(1,2,3)"            ==> ["1", "2", "3"]
+    Nested arrays and tuples are returned as nested lists:
+        "[[1,2],[3]]"        ==> [["1", "2"], ["3"]]
+    The string is scanned once from start to end, so the parsing time is linear in its length.
     """
     # Sanity check
     if len(array_string) < 2 or array_string[0] not in '[(' or array_string[-1] not in '])':
         raise ValueError('Invalid array string: "%s"' % array_string)
-    # Drop opening brace
-    array_string = array_string[1:]
-    # Go over the string, lopping off each value at the beginning until nothing is left
+    # Skip the opening brace, and go over the string one value at a time
     values = []
-    while True:
-        if array_string in '])':
-            # End of array
-            return values
-        elif array_string[0] in ', ':
+    parents = [] # the enclosing arrays of a nested array
+    pos = 1
+    last = len(array_string) - 1
+    while pos <= last:
+        c = array_string[pos]
+        if c in ', ':
             # In between values
-            array_string = array_string[1:]
-        elif array_string[0] == "'":
+            pos += 1
+        elif c == "'":
             # Start of quoted value, find its end
-            match = re.search(r"[^\\]'", array_string)
+            match = ARRAY_QUOTED_VALUE_END_REGEX.search(array_string, pos + 1)
             if match is None:
-                raise ValueError('Missing closing quote: "%s"' % array_string)
-            values.append(array_string[1 : match.start() + 1])
-            array_string = array_string[match.end():]
+                raise ValueError('Missing closing quote: "%s"' % array_string[pos:])
+            values.append(array_string[pos + 1 : match.start()])
+            pos = match.end()
+        elif c in '[(':
+            # Start of nested array or tuple
+            parents.append(values)
+            values = []
+            pos += 1
+        elif c in '])':
+            if not parents:
+                # End of array
+                if pos != last:
+                    break
+                return values
+            # End of nested array or tuple
+            parents[-1].append(values)
+            values = parents.pop()
+            pos += 1
         else:
             # Start of non-quoted value, find its end
-            match = re.search(r",|\]", array_string)
-            values.append(array_string[0 : match.start()])
-            array_string = array_string[match.end() - 1:]
+            match = ARRAY_UNQUOTED_VALUE_END_REGEX.search(array_string, pos)
+            values.append(array_string[pos : match.start()])
+            pos = match.start()
+    raise ValueError('Invalid array string: "%s"' % array_string)
+
+
+def parse_datetime(value):
+    """
+    Parses a string in the fixed layout that ClickHouse uses for datetimes, for example
+    "2020-01-31 23:59:59" or "2020-01-31 23:59:59.123456789", into a naive datetime.
+    Fractions of a second are truncated to microseconds.
+    Returns None if the string does not match this layout, so that the caller can fall
+    back to a more lenient parser.
+    """
+    if len(value) < 19 or value[4] != '-' or value[7] != '-' or value[10] not in ' T' \
+            or value[13] != ':' or value[16] != ':':
+        return None
+    if len(value) > 19 and (value[19] != '.' or not value[20:].isdigit()):
+        return None
+    if len(value) > 26:
+        value = value[:26]
+    elif 20 < len(value) < 26:
+        value = value.ljust(26, '0')
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def localize(dt, timezone):
+    """
+    Converts a naive datetime to an aware one in the given pytz timezone.
+    This is equivalent to `timezone.localize(dt)`, but the timezone's offset is
+    memoized per hour, which is much faster when converting many datetimes.
+    """
+    year, month, day, hour = dt.year, dt.month, dt.day, dt.hour
+    tz = _get_hour_tzinfo(timezone, year, month, day, hour)
+    if tz is None:
+        return timezone.localize(dt)
+    # Creating a new datetime is faster than calling dt.replace
+    return datetime(year, month, day, hour, dt.minute, dt.second, dt.microsecond, tz)
+
+
+@lru_cache(maxsize=65536)
+def _get_hour_tzinfo(timezone, year, month, day, hour):
+    """
+    Returns the tzinfo that the timezone uses throughout the given hour, or None
+    if the offset changes during that hour (e.g. a half-hour daylight saving shift).
+    """
+    start = timezone.localize(datetime(year, month, day, hour))
+    end = timezone.localize(datetime(year, month, day, hour, 59, 59, 999999))
+    return start.tzinfo if start.tzinfo is end.tzinfo else None
 
 
 def import_submodules(package_name):
@@ -164,4 +237,8 @@ class NoValue:
     def __repr__(self):
         return 'NO_VALUE'
 
+    def __reduce__(self):
+        # Preserve the singleton when pickling or copying
+        return 'NO_VALUE'
+
 NO_VALUE = NoValue()
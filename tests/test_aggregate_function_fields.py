@@ -0,0 +1,92 @@
+import unittest
+from datetime import date
+
+from infi.clickhouse_orm.database import Database
+from infi.clickhouse_orm.models import Model, ModelBase
+from infi.clickhouse_orm.fields import *
+from infi.clickhouse_orm.engines import *
+from infi.clickhouse_orm.funcs import F
+
+
+class AggregateFunctionFieldsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = Database('test-db', log_statements=True)
+        self.database.create_table(EventRollup)
+
+    def tearDown(self):
+        self.database.drop_database()
+
+    def _insert_states(self, start, count):
+        self.database.raw('''
+            INSERT INTO eventrollup (day, event_group, users, heights, total)
+            SELECT toDate('2020-01-01') + (number % 2) AS day, number % 3 AS event_group, uniqState(toUInt32(number % 10)),
+                   quantilesState(0.5, 0.9)(toFloat32(number)), sum(number)
+            FROM numbers({start}, {count})
+            GROUP BY day, event_group
+        '''.format(start=start, count=count))
+
+    def test_create_table_sql(self):
+        sql = EventRollup.create_table_sql(self.database)
+        self.assertIn('users AggregateFunction(uniq, UInt32)', sql)
+        self.assertIn('heights AggregateFunction(quantiles(0.5, 0.9), Float32)', sql)
+        self.assertIn('total SimpleAggregateFunction(sum, UInt64)', sql)
+        self.assertIn('AggregatingMergeTree()', sql)
+
+    def test_read_only(self):
+        field = AggregateFunctionField('uniq', UInt32Field())
+        self.assertTrue(field.readonly)
+        self.assertEqual(['day', 'event_group', 'total'], list(EventRollup.fields(writable=True)))
+        # Inserting instances writes empty states
+        self.database.insert([EventRollup(day=date(2020, 1, 1), event_group=1, total=5)])
+        qs = EventRollup.objects_in(self.database).aggregate(users=F.uniqMerge(EventRollup.users), total=F.sum(EventRollup.total))
+        row = list(qs)[0]
+        self.assertEqual((row.users, row.total), (0, 5))
+
+    def test_merge(self):
+        self._insert_states(0, 1000)
+        self._insert_states(1000, 1000)
+        qs = EventRollup.objects_in(self.database).aggregate(
+            'day',
+            users=F.uniqMerge(EventRollup.users),
+            heights=F.quantilesMerge(0.5, 0.9)(EventRollup.heights),
+            total=F.sum(EventRollup.total)
+        ).order_by('day')
+        results = list(qs)
+        self.assertEqual([r.day for r in results], [date(2020, 1, 1), date(2020, 1, 2)])
+        self.assertEqual([r.users for r in results], [5, 5])
+        self.assertEqual(sum(r.total for r in results), sum(range(2000)))
+        self.assertEqual(len(results[0].heights), 2)
+        # Merging the parts combines rows with the same sorting key
+        self.database.raw('OPTIMIZE TABLE eventrollup FINAL')
+        self.assertEqual(EventRollup.objects_in(self.database).count(), 6)
+        self.assertEqual(EventRollup.objects_in(self.database).aggregate(total=F.sum(EventRollup.total))[0].total,
+                         sum(range(2000)))
+
+    def test_simple_aggregate_function_field(self):
+        f = SimpleAggregateFunctionField('max', DateField())
+        self.assertEqual(f.to_python('2020-01-31', None), date(2020, 1, 31))
+        self.assertEqual(f.to_db_string(date(2020, 1, 31)), "'2020-01-31'")
+        self.assertEqual(f.get_sql(with_default_expression=False), 'SimpleAggregateFunction(max, Date)')
+        with self.assertRaises(ValueError):
+            f.to_python('nope', None)
+
+    def test_ad_hoc_fields(self):
+        for db_type in ['AggregateFunction(uniq, UInt32)',
+                        'AggregateFunction(quantiles(0.5, 0.9), Float32)',
+                        'AggregateFunction(argMax, String, DateTime)',
+                        'AggregateFunction(count)',
+                        'SimpleAggregateFunction(sum, Nullable(UInt64))']:
+            field = ModelBase.create_ad_hoc_field(db_type)
+            self.assertEqual(field.get_sql(), db_type)
+
+
+class EventRollup(Model):
+
+    day = DateField()
+    event_group = UInt32Field()
+    users = AggregateFunctionField('uniq', UInt32Field())
+    heights = AggregateFunctionField('quantiles(0.5, 0.9)', Float32Field())
+    total = SimpleAggregateFunctionField('sum', UInt64Field())
+
+    engine = AggregatingMergeTree(partition_key=('toYYYYMM(day)',), order_by=('day', 'event_group'))
@@ -52,12 +52,19 @@ class ArrayFieldsTest(unittest.TestCase):
         self.assertEqual(parse_array("[1, 2, 395, -44]"), ["1", "2", "395", "-44"])
         self.assertEqual(parse_array("['big','mouse','','!']"), ["big", "mouse", "", "!"])
         self.assertEqual(parse_array(unescape("['\\r\\n\\0\\t\\b']")), ["\r\n\0\t\b"])
+        self.assertEqual(parse_array("(1,2,3)"), ["1", "2", "3"])
+        self.assertEqual(parse_array("['a\\'b', 'c]']"), ["a\\'b", "c]"])
+        self.assertEqual(parse_array("[[1,2],[],[3]]"), [["1", "2"], [], ["3"]])
+        self.assertEqual(parse_array("[('a',1),('b',2)]"), [["a", "1"], ["b", "2"]])
+        self.assertEqual(parse_array("[%s]" % ','.join(map(str, range(10000)))), [str(i) for i in range(10000)])
         for s in ("",
                   "[",
                   "]",
                   "[1, 2",
                   "3, 4]",
-                  "['aaa', 'aaa]"):
+                  "['aaa', 'aaa]",
+                  "[1]2]",
+                  "[[1, 2]"):
             with self.assertRaises(ValueError):
                 parse_array(s)
 
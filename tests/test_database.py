@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 import datetime
+import threading
 
 from infi.clickhouse_orm.database import ServerError, DatabaseException
 from infi.clickhouse_orm.models import Model
@@ -8,6 +9,7 @@ from infi.clickhouse_orm.engines import Memory
 from infi.clickhouse_orm.fields import *
 from infi.clickhouse_orm.funcs import F
 from infi.clickhouse_orm.query import Q
+from infi.clickhouse_orm.utils import escape
 from .base_test_with_data import *
 
 
@@ -145,6 +147,20 @@ class DatabaseTestCase(TestCaseWithData):
             self.assertEqual(page.pages_total, 0)
             self.assertEqual(page.number, max(page_num, 1))
 
+    def test_pagination_single_query(self):
+        self._insert_and_check(self._sample_data(), len(data))
+        for conditions in (None, "first_name < 'Ava'", "first_name = 'Ziggy'"):
+            for page_size in (1, 7, 30, 150):
+                for page_num in (1, 2, 5, 200):
+                    page_a = self.database.paginate(Person, 'first_name, last_name', page_num, page_size, conditions)
+                    page_b = self.database.paginate(Person, 'first_name, last_name', page_num, page_size, conditions,
+                                                    single_query=True)
+                    self.assertEqual(page_a[1:], page_b[1:])
+                    self.assertEqual([obj.to_tsv() for obj in page_a.objects],
+                                     [obj.to_tsv() for obj in page_b.objects])
+        with self.assertRaises(ValueError):
+            self.database.paginate(Person, 'first_name, last_name', 0, 100, single_query=True)
+
     def test_pagination_invalid_page(self):
         self._insert_and_check(self._sample_data(), len(data))
         for page_num in (0, -2, -100):
@@ -269,6 +285,33 @@ class DatabaseTestCase(TestCaseWithData):
             model(first_name='aaa', last_name='bbb', height=1.77)
         ])
 
+    def test_get_models_for_tables(self):
+        models = self.database.get_models_for_tables()
+        self.assertEqual(list(models), ['person'])
+        model = models['person']
+        self.assertEqual(list(model.fields()), list(self.database.get_model_for_table('person').fields()))
+        self.assertFalse(model.is_system_model())
+        self.assertEqual(self.database.get_models_for_tables(['person', 'no_such_table']), models)
+        self.assertEqual(self.database.get_models_for_tables([]), {})
+        # The models are cached, so only the table versions are read
+        requests = self._record_requests(self.database)
+        self.assertIs(self.database.get_models_for_tables()['person'], model)
+        self.assertEqual(len(requests), 1)
+        # Altering the table invalidates its model
+        self.database.raw('ALTER TABLE $db.person ADD COLUMN nickname String')
+        model = self.database.get_models_for_tables()['person']
+        self.assertIn('nickname', model.fields())
+        self.assertEqual(len(requests), 4)
+
+    def test_get_models_for_tables__system(self):
+        models = self.database.get_models_for_tables(['databases', 'one'], system_tables=True)
+        self.assertEqual(sorted(models), ['databases', 'one'])
+        for name, model in models.items():
+            self.assertTrue(model.is_system_model())
+            self.assertTrue(model.is_read_only())
+            self.assertEqual(model.table_name(), name)
+        self.assertTrue(list(models['databases'].objects_in(self.database).filter(name='system')))
+
     def test_get_model_for_table__system(self):
         # Tests that get_model_for_table works for all system tables
         query = "SELECT name FROM system.tables WHERE database='system'"
@@ -291,3 +334,152 @@ class DatabaseTestCase(TestCaseWithData):
                     pass
                 else:
                     raise
+
+    def _record_requests(self, db):
+        # Records the URL and parameters of every request sent by the database
+        requests = []
+        post = db.request_session.post
+        def recording_post(url, params=None, **kwargs):
+            requests.append((url, params))
+            return post(url, params=params, **kwargs)
+        db.request_session.post = recording_post
+        return requests
+
+    def test_read_write_routing(self):
+        write_url = 'http://localhost:8123/'
+        read_urls = ['http://127.0.0.1:8123/', 'http://127.0.0.1:8123']
+        db = Database(self.database.db_name, db_url=[write_url], read_urls=read_urls)
+        requests = self._record_requests(db)
+        db.insert(self._sample_data())
+        self.assertEqual([url for url, params in requests], [write_url])
+        del requests[:]
+        # Reads are spread across the read replicas
+        self.assertEqual(db.count(Person), len(data))
+        self.assertEqual(Person.objects_in(db).filter(first_name='Courtney').count(), 2)
+        list(db.select('SELECT * FROM $table LIMIT 5', Person))
+        db.paginate(Person, 'first_name', page_num=2, page_size=10)
+        self.assertEqual([url for url, params in requests], read_urls * 2 + read_urls[:1])
+        del requests[:]
+        # Other statements go to the write servers
+        db.raw('OPTIMIZE TABLE $db.person')
+        self.assertEqual([url for url, params in requests], [write_url])
+
+    def test_schema_on_first_write_server(self):
+        write_urls = ['http://localhost:8123/', 'http://127.0.0.1:8123/']
+        db = Database(self.database.db_name, db_url=write_urls)
+        requests = self._record_requests(db)
+        # Schema changes and introspection always go to the first write server
+        for i in range(2):
+            db.create_table(Person)
+            self.assertTrue(db.does_table_exist(Person))
+            db.get_model_for_table('person')
+            db.get_models_for_tables(['person'])
+            db.drop_table(Person)
+        self.assertEqual(set(url for url, params in requests), {write_urls[0]})
+        del requests[:]
+        # Other writes are spread across the write servers
+        db.create_table(Person)
+        del requests[:]
+        db.insert(self._sample_data())
+        db.insert(self._sample_data())
+        self.assertEqual([url for url, params in requests], write_urls)
+
+    def test_sequential_consistency(self):
+        self._insert_all()
+        db = Database(self.database.db_name, sequential_consistency=True)
+        requests = self._record_requests(db)
+        self.assertEqual(db.count(Person), len(data))
+        db.raw('OPTIMIZE TABLE $db.person')
+        self.assertEqual([params.get('select_sequential_consistency') for url, params in requests], ['1', None])
+
+    def test_add_on_cluster(self):
+        db = self.database
+        for sql, expected in [
+            ('CREATE DATABASE IF NOT EXISTS `db`', "CREATE DATABASE IF NOT EXISTS `db` ON CLUSTER 'c'"),
+            ('DROP DATABASE `db`', "DROP DATABASE `db` ON CLUSTER 'c'"),
+            ('CREATE TABLE IF NOT EXISTS `db`.`t` (\n    a Int8\n)\nENGINE = Log',
+             "CREATE TABLE IF NOT EXISTS `db`.`t` ON CLUSTER 'c' (\n    a Int8\n)\nENGINE = Log"),
+            ('CREATE MATERIALIZED VIEW IF NOT EXISTS `db`.`v` TO `db`.`t` AS SELECT 1',
+             "CREATE MATERIALIZED VIEW IF NOT EXISTS `db`.`v` ON CLUSTER 'c' TO `db`.`t` AS SELECT 1"),
+            ('DROP TABLE IF EXISTS `db`.`t`', "DROP TABLE IF EXISTS `db`.`t` ON CLUSTER 'c'"),
+            ('ALTER TABLE `db`.`t` ADD COLUMN b Int8', "ALTER TABLE `db`.`t` ON CLUSTER 'c' ADD COLUMN b Int8"),
+            ('OPTIMIZE TABLE db.t FINAL', "OPTIMIZE TABLE db.t ON CLUSTER 'c' FINAL"),
+            ('RENAME TABLE `db`.`a` TO `db`.`b`;', "RENAME TABLE `db`.`a` TO `db`.`b` ON CLUSTER 'c'"),
+            ("ALTER TABLE `db`.`t` ON CLUSTER 'x' DROP COLUMN b", None),
+            ('SELECT 1', None),
+            ('INSERT INTO `db`.`t` FORMAT TabSeparated', None),
+        ]:
+            self.assertEqual(db._add_on_cluster(sql, 'c'), expected)
+
+    def test_create_table_on_cluster(self):
+        cluster = 'test_cluster_two_shards_localhost'
+        if not list(self.database.select("SELECT 1 FROM system.clusters WHERE cluster = %s" % escape(cluster))):
+            raise unittest.SkipTest('The %s cluster is not defined' % cluster)
+        db = Database(self.database.db_name, cluster=cluster, ddl_timeout=30)
+        requests = self._record_requests(db)
+        db.create_table(Person)
+        self.assertTrue(db.does_table_exist(Person))
+        self.assertEqual(requests[0][1]['distributed_ddl_task_timeout'], 30)
+        db.drop_table(Person)
+        self.assertFalse(db.does_table_exist(Person))
+
+    def test_cluster_only_for_schema_changes(self):
+        db = Database(self.database.db_name, cluster='no_such_cluster')
+        # Mutations and other statements are not sent ON CLUSTER
+        db.raw('OPTIMIZE TABLE $db.person')
+        Person.objects_in(db).filter(first_name='Courtney').update(height=1.8)
+        Person.objects_in(db).filter(first_name='Courtney').delete()
+        # Schema changes are
+        with self.assertRaises(ServerError) as cm:
+            db.create_table(Person)
+        self.assertIn('no_such_cluster', str(cm.exception))
+
+    def test_hedged_select(self):
+        self._insert_all()
+        read_urls = ['http://127.0.0.1:8123/', 'http://127.0.0.1:8123']
+        db = Database(self.database.db_name, read_urls=read_urls, hedge_after=0.1)
+        # The replica that receives the query first does not respond until released
+        calls = []
+        release = threading.Event()
+        post = db.request_session.post
+        def slow_post(url, params=None, data=None, **kwargs):
+            calls.append((url, params, data))
+            if data.startswith(b'SELECT') and len(calls) == 1 and not release.is_set():
+                # Another query sent meanwhile moves the replicas cycle
+                next(db._read_url_cycle)
+                release.wait(10)
+            return post(url, params=params, data=data, **kwargs)
+        db.request_session.post = slow_post
+        results = list(db.select('SELECT * FROM $table ORDER BY first_name', Person))
+        self.assertEqual(len(results), len(data))
+        release.set()
+        db._executor.shutdown(wait=True)
+        # The query was sent to both replicas, and the slower one is killed
+        selects = [(url, params['query_id']) for url, params, sql in calls if sql.startswith(b'SELECT')]
+        self.assertEqual(sorted(url for url, query_id in selects), sorted(read_urls))
+        self.assertNotEqual(selects[0][1], selects[1][1])
+        kills = [(url, sql) for url, params, sql in calls if sql.startswith(b'KILL')]
+        kill_sql = 'KILL QUERY WHERE query_id = %s ASYNC' % escape(selects[0][1])
+        self.assertEqual(kills, [(selects[0][0], kill_sql.encode('utf-8'))])
+        # Counting is not hedged
+        del calls[:]
+        db.count(Person)
+        self.assertEqual(len(calls), 1)
+
+    def test_hedged_select_fast_response(self):
+        self._insert_all()
+        read_urls = ['http://127.0.0.1:8123/', 'http://127.0.0.1:8123']
+        db = Database(self.database.db_name, read_urls=read_urls)
+        requests = self._record_requests(db)
+        self.assertEqual(len(list(db.select('SELECT * FROM $table', Person, hedge_after=60))), len(data))
+        self.assertEqual(len(requests), 1)
+
+    def test_hedged_select_auto(self):
+        read_urls = ['http://127.0.0.1:8123/', 'http://127.0.0.1:8123']
+        db = Database(self.database.db_name, read_urls=read_urls, hedge_after='auto')
+        # No hedging until enough latencies are known
+        db._read_latencies.clear()
+        self.assertIsNone(db._get_hedge_delay('auto'))
+        db._read_latencies.extend(i / 100 for i in range(100))
+        self.assertEqual(db._get_hedge_delay('auto'), 0.95)
+        self.assertEqual(db._get_hedge_delay(0.5), 0.5)
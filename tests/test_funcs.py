@@ -9,7 +9,7 @@ from decimal import Decimal
 
 from infi.clickhouse_orm.database import ServerError
 from infi.clickhouse_orm.utils import NO_VALUE
-from infi.clickhouse_orm.funcs import F
+from infi.clickhouse_orm.funcs import F, aggregate
 
 
 class FuncsTestCase(TestCaseWithData):
@@ -673,6 +673,18 @@ class FuncsTestCase(TestCaseWithData):
         self._test_aggr(F.countOrNullIf(Person.last_name > 'Z'), None)
         self._test_aggr(F.minOrNullIf(Person.height, Person.last_name > 'Z'), None)
 
+    def test_aggregate_funcs__state_merge(self):
+        self._test_aggr(F.finalizeAggregation(F.countState()), 100)
+        self._test_aggr(F.finalizeAggregation(F.uniqExactState(Person.first_name, Person.last_name)), 100)
+        self._test_aggr(F.finalizeAggregation(F.minState(Person.height)), 1.59)
+        # The -Merge combinators accept only the state
+        self.assertEqual(F.argMinMerge('state').to_sql(), "argMinMerge('state')")
+        self.assertEqual(F.quantilesMerge(0.5, 0.9)(F.quantilesState(0.5, 0.9)(Person.height)).to_sql(),
+                         'quantilesMerge(0.5, 0.9)(quantilesState(0.5, 0.9)(`height`))')
+        self.assertEqual(F.sumMergeState(F.sumState(1)).to_sql(), 'sumMergeState(sumState(1))')
+        with self.assertRaises(TypeError):
+            F.argMinMerge('state', 'extra')
+
     def test_quantile_funcs(self):
         cond = Person.last_name > 'H'
         weight_expr = F.toUInt32(F.round(Person.height))
@@ -736,3 +748,18 @@ class FuncsTestCase(TestCaseWithData):
         self._test_func(F.isNaN(17), 0)
         self._test_func(F.least(17, 18), 17)
         self._test_func(F.greatest(17, 18), 18)
+
+    def test_lazy_combinators(self):
+        class MyF(F):
+            @staticmethod
+            @aggregate
+            def myAggregate(x):
+                return F('myAggregate', x)
+        # Combinators are generated only when accessed
+        self.assertNotIn('myAggregateIf', vars(MyF))
+        self.assertIn('myAggregateIf', dir(MyF))
+        self.assertEqual(MyF.myAggregateIf(1, 2).to_sql(), 'myAggregateIf(1, 2)')
+        self.assertIn('myAggregateIf', vars(MyF))
+        # Inherited combinators are available too
+        self.assertEqual(MyF.countOrNullIf(3).to_sql(), 'countOrNullIf(3)')
+        self.assertFalse(hasattr(MyF, 'myAggregateUTF8'))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from infi.clickhouse_orm import migrations
+from infi.clickhouse_orm.database import DatabaseException
+from infi.clickhouse_orm.models import MaterializedViewModel
+from infi.clickhouse_orm.engines import *
+from infi.clickhouse_orm.funcs import F
+from .base_test_with_data import *
+
+
+class MaterializedViewTestCase(TestCaseWithData):
+
+    def setUp(self):
+        super(MaterializedViewTestCase, self).setUp()
+        migrations.CreateTable(PersonRollupView).apply(self.database)
+
+    def test_create_table_sql(self):
+        sql = PersonRollupView.create_table_sql(self.database)
+        self.assertTrue(sql.startswith('CREATE MATERIALIZED VIEW IF NOT EXISTS `test-db`.`personrollupview` '
+                                       'TO `test-db`.`personrollup`\nAS SELECT'))
+        self.assertIn('GROUP BY `first_name`', sql)
+
+    def test_insert(self):
+        self.assertTrue(self.database.does_table_exist(PersonRollup))
+        self._insert_all()
+        qs = PersonRollup.objects_in(self.database).aggregate(
+            'first_name',
+            count=F.sum(PersonRollup.count),
+            last_names=F.uniqMerge(PersonRollup.last_names),
+            max_height=F.max(PersonRollup.max_height)
+        ).filter(first_name='Courtney')
+        row = list(qs)[0]
+        self.assertEqual((row.count, row.last_names, row.max_height), (2, 2, 1.76))
+        # The view can be queried too, returning the rows of its target table
+        self.assertEqual(PersonRollupView.objects_in(self.database).count(approximate=True),
+                         PersonRollup.objects_in(self.database).count())
+
+    def test_read_only(self):
+        with self.assertRaises(DatabaseException):
+            self.database.insert([PersonRollupView(first_name='x')])
+
+    def test_drop_table(self):
+        migrations.DropTable(PersonRollupView).apply(self.database)
+        self.assertFalse(self.database.does_table_exist(PersonRollupView))
+        # The target table is not dropped
+        self.assertTrue(self.database.does_table_exist(PersonRollup))
+        self._insert_all()
+        self.assertEqual(PersonRollup.objects_in(self.database).count(), 0)
+
+    def test_target_model(self):
+        self.assertIs(PersonRollupView.target_model(), PersonRollup)
+        class BadView(MaterializedViewModel):
+            view_query = PersonRollupView.view_query
+        with self.assertRaises(TypeError):
+            BadView.create_table_sql(self.database)
+
+
+class PersonRollup(Model):
+
+    first_name = StringField()
+    count = SimpleAggregateFunctionField('sum', UInt64Field())
+    last_names = AggregateFunctionField('uniq', StringField())
+    max_height = SimpleAggregateFunctionField('max', Float32Field())
+
+    engine = AggregatingMergeTree(partition_key=('tuple()',), order_by=('first_name',))
+
+
+class PersonRollupView(PersonRollup, MaterializedViewModel):
+
+    view_query = Person.objects_in(None).aggregate(
+        'first_name',
+        count=F.count(),
+        last_names=F.uniqState(Person.last_name),
+        max_height=F.max(Person.height)
+    )
@@ -1,10 +1,13 @@
 import unittest
+import datetime
 
-from infi.clickhouse_orm.database import Database, ServerError
+from infi.clickhouse_orm.database import Database, ServerError, DatabaseException
 from infi.clickhouse_orm.models import Model, BufferModel, Constraint, Index
 from infi.clickhouse_orm.fields import *
 from infi.clickhouse_orm.engines import *
-from infi.clickhouse_orm.migrations import MigrationHistory
+from infi.clickhouse_orm.system_models import SystemPart
+from infi.clickhouse_orm.migrations import MigrationHistory, AlterTable, RebuildTable
+from infi.clickhouse_orm.utils import escape
 
 from enum import Enum
 # Add tests to path so that migrations will be importable
@@ -37,6 +40,110 @@ class MigrationsTestCase(unittest.TestCase):
     def get_table_def(self, model_class):
         return self.database.raw('SHOW CREATE TABLE $db.`%s`' % model_class.table_name())
 
+    def test_parallel_migrations_unknown_cluster(self):
+        with self.assertRaises(DatabaseException):
+            self.database.migrate('tests.sample_migrations', 1, cluster='no_such_cluster', parallel=True)
+        self.assertFalse(self.table_exists(Model1))
+
+    def test_alter_table_single_statement(self):
+        statements = []
+        raw = self.database.raw
+        def recording_raw(query, *args, **kwargs):
+            statements.append(query)
+            return raw(query, *args, **kwargs)
+        self.database.raw = recording_raw
+        self.database.create_table(Model1)
+        # Dropping, adding and modifying columns is done in a single statement
+        AlterTable(Model3).apply(self.database)
+        self.assertEqual(self.get_table_fields(Model3), [('date', 'Date'), ('f1', 'Int64'), ('f3', 'Float64'), ('f4', 'String')])
+        self.assertEqual(len([sql for sql in statements if sql.startswith('ALTER')]), 1)
+        # No statement is needed when the table matches the model
+        del statements[:]
+        AlterTable(Model3).apply(self.database)
+        self.assertEqual(len([sql for sql in statements if sql.startswith('ALTER')]), 0)
+
+    def _insert_rebuild_data(self):
+        self.database.create_table(RebuildModel)
+        self.database.insert(RebuildModel(date=datetime.date(2020, month, 1 + i % 28), f1=i, f2=str(i))
+                             for month in (1, 2, 3) for i in range(100))
+
+    def test_rebuild_table(self):
+        self._insert_rebuild_data()
+        progress = []
+        RebuildTable(RebuildModel2, workers=2, progress=lambda *args: progress.append(args)).apply(self.database)
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+        self.assertIn('ORDER BY (f1, date)', self.get_table_def(RebuildModel2))
+        self.assertEqual(self.get_table_fields(RebuildModel2), [('date', 'Date'), ('f1', 'Int32'), ('f2', 'String'), ('f3', 'UInt8')])
+        self.assertEqual(self.database.count(RebuildModel2), 300)
+        self.assertEqual(self.database.count(RebuildModel2, 'f3 = 1'), 300)
+        self.assertFalse(self.database.does_table_exist(RebuildModelShadow))
+
+    def test_rebuild_table_resume(self):
+        self._insert_rebuild_data()
+        # Simulate a previous attempt that copied one partition, and part of another
+        operation = RebuildTable(RebuildModel2)
+        versions = operation._get_versions(self.database, 'rebuild')
+        self.database.create_table(RebuildModelShadow)
+        self.database.raw("INSERT INTO $db.rebuild_rebuild (date, f1, f2) SELECT date, f1, f2 FROM $db.rebuild "
+                          "WHERE toMonth(date) = 1 OR (toMonth(date) = 2 AND f1 < 50)")
+        self.database.raw("CREATE TABLE $db.rebuild_rebuild_partitions (partition_id String, version String) ENGINE = Log")
+        self.database.raw("INSERT INTO $db.rebuild_rebuild_partitions VALUES ('202001', %s)" % escape(versions['202001']))
+        progress = []
+        operation.progress = lambda *args: progress.append(args)
+        operation.apply(self.database)
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+        self.assertEqual(self.database.count(RebuildModel2), 300)
+        self.assertFalse(self.table_exists(RebuildModelShadow))
+        self.assertNotIn('rebuild_rebuild_partitions', [row.name for row in self.database.select("SHOW TABLES")])
+
+    def test_rebuild_table_stale_shadow(self):
+        self._insert_rebuild_data()
+        # A previous attempt for another definition of the table is discarded
+        self.database.raw(RebuildModel3.create_table_sql(self.database).replace('`rebuild`', '`rebuild_rebuild`'))
+        self.database.raw("INSERT INTO $db.rebuild_rebuild SELECT * FROM $db.rebuild")
+        self.database.raw("CREATE TABLE $db.rebuild_rebuild_partitions (partition_id String, version String) ENGINE = Log")
+        self.database.raw("INSERT INTO $db.rebuild_rebuild_partitions VALUES ('202001', '1_0')")
+        progress = []
+        RebuildTable(RebuildModel2, progress=lambda *args: progress.append(args)).apply(self.database)
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+        self.assertIn('ORDER BY (f1, date)', self.get_table_def(RebuildModel2))
+        self.assertEqual(self.database.count(RebuildModel2), 300)
+
+    def test_rebuild_table_modified(self):
+        self._insert_rebuild_data()
+        # Keep writing to the table while it is rebuilt
+        def insert(*args):
+            self.database.insert([RebuildModel(date=datetime.date(2020, 1, 1), f1=1000, f2='new')])
+        with self.assertRaises(DatabaseException):
+            RebuildTable(RebuildModel2, progress=insert).apply(self.database)
+        self.assertIn('ORDER BY (date)', self.get_table_def(RebuildModel))
+        # Only the modified partition is copied again
+        progress = []
+        RebuildTable(RebuildModel2, progress=lambda *args: progress.append(args)).apply(self.database)
+        self.assertEqual(progress, [(1, 1)])
+        self.assertEqual(self.database.count(RebuildModel2), 304)
+        self.assertEqual(self.database.count(RebuildModel2, "f2 = 'new'"), 4)
+
+    def test_rebuild_table_new_partition_key(self):
+        self._insert_rebuild_data()
+        RebuildTable(RebuildModel3).apply(self.database)
+        self.assertIn('PARTITION BY (f1 % 10)', self.get_table_def(RebuildModel3))
+        self.assertEqual(self.database.count(RebuildModel3), 300)
+        self.assertEqual(len(set(p.partition_id for p in SystemPart.get_active(self.database, "table = 'rebuild'"))), 10)
+
+    def test_rebuild_table_not_allowed(self):
+        self._insert_rebuild_data()
+        # The data would be copied only on the node that the database is connected to
+        db = Database(self.database.db_name, cluster='test_cluster')
+        with self.assertRaises(DatabaseException):
+            RebuildTable(RebuildModel2).apply(db)
+        with self.assertRaises(DatabaseException), self.database._on_cluster('test_cluster'):
+            RebuildTable(RebuildModel2).apply(self.database)
+        self.assertIn('ORDER BY (date)', self.get_table_def(RebuildModel))
+        # The shadow table would use the same replication path
+        with self.assertRaises(AssertionError):
+            RebuildTable(ReplicatedRebuildModel)
+
     def test_migrations(self):
         # Creation and deletion of table
         self.database.migrate('tests.sample_migrations', 1)
@@ -360,6 +467,59 @@ class ModelWithConstraints2(Model):
         return 'modelwithconstraints'
 
 
+class RebuildModel(Model):
+
+    date = DateField()
+    f1 = Int32Field()
+    f2 = StringField()
+
+    engine = MergeTree('date', ('date',))
+
+    @classmethod
+    def table_name(cls):
+        return 'rebuild'
+
+
+class RebuildModel2(Model):
+
+    date = DateField()
+    f1 = Int32Field()
+    f2 = StringField()
+    f3 = UInt8Field(default=1)
+
+    engine = MergeTree('date', ('f1', 'date'))
+
+    @classmethod
+    def table_name(cls):
+        return 'rebuild'
+
+
+class RebuildModel3(Model):
+
+    date = DateField()
+    f1 = Int32Field()
+    f2 = StringField()
+
+    engine = MergeTree(partition_key=('f1 % 10',), order_by=('f1',))
+
+    @classmethod
+    def table_name(cls):
+        return 'rebuild'
+
+
+class ReplicatedRebuildModel(RebuildModel2):
+
+    engine = MergeTree('date', ('f1', 'date'), replica_table_path='/clickhouse/tables/{shard}/rebuild',
+                       replica_name='{replica}')
+
+
+class RebuildModelShadow(RebuildModel2):
+
+    @classmethod
+    def table_name(cls):
+        return 'rebuild_rebuild'
+
+
 class ModelWithIndex(Model):
 
     date = DateField()
@@ -103,6 +103,56 @@ class ModelTestCase(unittest.TestCase):
             str(cm.exception)
         )
 
+    def test_compact_model(self):
+        instance = CompactModel(str_field='aloha', int_field=-50)
+        self.assertFalse(hasattr(instance, '__dict__'))
+        self.assertTrue(CompactModel.is_compact())
+        self.assertFalse(SimpleModel.is_compact())
+        # Fields are still accessible through the class
+        self.assertIsInstance(CompactModel.int_field, Int32Field)
+        self.assertEqual(CompactModel.int_field.name, 'int_field')
+        # Values are converted, validated and serialized as in regular models
+        self.assertEqual(instance.date_field, datetime.date(1970, 1, 1))
+        self.assertEqual(instance.default_func, NO_VALUE)
+        self.assertIsNone(instance.get_database())
+        with self.assertRaises(ValueError):
+            instance.int_field = 'nope'
+        with self.assertRaises(AttributeError):
+            instance.pineapple = 'tasty'
+        self.assertEqual(instance.to_dict(include_readonly=False), {
+            'date_field': datetime.date(1970, 1, 1),
+            'datetime_field': datetime.datetime(1970, 1, 1, tzinfo=pytz.utc),
+            'str_field': 'aloha',
+            'int_field': -50,
+            'float_field': 0,
+            'default_func': NO_VALUE
+        })
+        self.assertEqual(instance.to_tsv(include_readonly=False),
+                         SimpleModel(str_field='aloha', int_field=-50).to_tsv(include_readonly=False))
+
+    def test_compact_model_inheritance(self):
+        class CompactSubModel(CompactModel):
+            str_field = StringField(default='aloha')
+            extra_field = UInt8Field(default=3)
+
+        self.assertEqual(CompactSubModel.__slots__, ('extra_field',))
+        instance = CompactSubModel()
+        self.assertEqual(instance.str_field, 'aloha')
+        self.assertEqual(instance.extra_field, 3)
+        self.assertIs(CompactSubModel.str_field, CompactSubModel.fields()['str_field'])
+        self.assertEqual(CompactModel().str_field, 'dozo')
+        # Compact models cannot inherit from models that have a __dict__
+        with self.assertRaises(TypeError):
+            class BadCompactModel(SimpleModel):
+                _compact = True
+
+    def test_compact_model_pickling(self):
+        import pickle
+        instance = CompactModel(int_field=42)
+        copied = pickle.loads(pickle.dumps(instance))
+        self.assertEqual(copied.to_dict(), instance.to_dict())
+        self.assertIs(copied.default_func, NO_VALUE)
+
 
 class SimpleModel(Model):
 
@@ -115,3 +165,18 @@ class SimpleModel(Model):
     default_func = Float32Field(default=F.sqrt(float_field) + 17)
 
     engine = MergeTree('date_field', ('int_field', 'date_field'))
+
+
+class CompactModel(Model):
+
+    _compact = True
+
+    date_field = DateField()
+    datetime_field = DateTimeField()
+    str_field = StringField(default='dozo')
+    int_field = Int32Field(default=17)
+    float_field = Float32Field()
+    alias_field = Float32Field(alias='float_field')
+    default_func = Float32Field(default=F.sqrt(float_field) + 17)
+
+    engine = MergeTree('date_field', ('int_field', 'date_field'))
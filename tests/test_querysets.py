@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 import unittest
-from infi.clickhouse_orm.database import Database
-from infi.clickhouse_orm.query import Q
+from infi.clickhouse_orm.database import Database, DatabaseException, ServerError
+from infi.clickhouse_orm.query import Q, Param
 from infi.clickhouse_orm.funcs import F
 from .base_test_with_data import *
 from datetime import date, datetime
 from enum import Enum
 from decimal import Decimal
+from fractions import Fraction
 
 from logging import getLogger
 logger = getLogger('tests')
@@ -44,6 +45,21 @@ class QuerySetTestCase(TestCaseWithData):
         self.assertTrue(qs.filter(first_name='Connor'))
         self.assertFalse(qs.filter(first_name='Willy'))
 
+    def test_exists(self):
+        qs = Person.objects_in(self.database)
+        self.assertTrue(qs.exists())
+        self.assertTrue(qs.filter(first_name='Connor').order_by('-height').exists())
+        self.assertFalse(qs.filter(first_name='Willy').exists())
+        self.assertTrue(qs.filter(first_name='Connor', prewhere=True).exists())
+        # Slices and distinct querysets
+        self.assertTrue(qs[99:].exists())
+        self.assertFalse(qs[100:].exists())
+        self.assertTrue(qs.only('first_name').distinct().exists())
+        # Aggregations
+        self.assertTrue(qs.aggregate('first_name', n='count()').exists())
+        self.assertFalse(qs.filter(first_name='Willy').aggregate('first_name', n='count()'))
+        self.assertTrue(qs.filter(first_name='Willy').aggregate(n='count()'))
+
     def test_filter_null_value(self):
         qs = Person.objects_in(self.database)
         self._test_qs(qs.filter(passport=None), 98)
@@ -262,6 +278,29 @@ class QuerySetTestCase(TestCaseWithData):
         page = qs.paginate(1, 100)
         self.assertEqual(page.number_of_objects, 10)
 
+    def test_pagination_single_query(self):
+        qs = Person.objects_in(self.database).order_by('first_name', 'last_name')
+        aggr_qs = Person.objects_in(self.database).aggregate('first_name', n='count()').order_by('first_name')
+        for tested_qs in (qs, qs.filter(first_name__lt='Ava'), qs.filter(first_name='Ziggy'), aggr_qs):
+            for page_size in (1, 7, 30, 150):
+                for page_num in (1, 2, 5, 20, 200):
+                    page_a = tested_qs.paginate(page_num, page_size)
+                    page_b = tested_qs.paginate(page_num, page_size, single_query=True)
+                    self.assertEqual(page_a[1:], page_b[1:])
+                    self.assertEqual([obj.to_tsv() for obj in page_a.objects],
+                                     [obj.to_tsv() for obj in page_b.objects])
+        # Verify that only one query is sent
+        queries = []
+        send = self.database._send
+        self.database._send = lambda *args, **kwargs: queries.append(args[0]) or send(*args, **kwargs)
+        try:
+            page = qs.paginate(2, 10, single_query=True)
+        finally:
+            del self.database._send
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(page.number_of_objects, 100)
+        self.assertEqual(len(page.objects), 10)
+
     def test_distinct(self):
         qs = Person.objects_in(self.database).distinct()
         self._test_qs(qs, 100)
@@ -285,6 +324,48 @@ class QuerySetTestCase(TestCaseWithData):
         self._test_qs(qs[70:80], 10)
         self._test_qs(qs[80:], 20)
 
+    def test_count_approximate(self):
+        qs = Person.objects_in(self.database)
+        self.assertEqual(qs.count(approximate=True), 100)
+        # Filtered querysets fall back to an exact count
+        self.assertEqual(qs.filter(first_name='Courtney').count(approximate=True), 2)
+        self.assertEqual(qs[:10].count(approximate=True), 10)
+        # Rows that were not collapsed yet are counted too
+        self._insert_sample_collapsing_model()
+        qs = SampleCollapsingModel.objects_in(self.database)
+        self.assertEqual(qs.count(approximate=True), qs.count())
+        self.assertEqual(qs.final().count(approximate=True), 4)
+
+    def test_explain(self):
+        qs = Person.objects_in(self.database).filter(first_name='Courtney')
+        plan = qs.explain()
+        self.assertTrue(any('ReadFromMergeTree' in line for line in plan))
+        pipeline = qs.explain('pipeline')
+        self.assertTrue(pipeline and all(isinstance(line, str) for line in pipeline))
+        # The primary key is used for skipping granules
+        indexes = {index['type']: index for index in qs.explain('indexes')}
+        primary_key = indexes['PrimaryKey']
+        self.assertEqual(primary_key['keys'], ['first_name'])
+        self.assertLess(primary_key['selected_granules'], primary_key['initial_granules'])
+        self.assertTrue(primary_key['table'].endswith('person'))
+        # Aggregates can be explained too
+        indexes = qs.aggregate(num='count()').explain('indexes')
+        self.assertIn('PrimaryKey', [index['type'] for index in indexes])
+        with self.assertRaises(AssertionError):
+            qs.explain('syntax')
+
+    def test_profile(self):
+        qs = Person.objects_in(self.database).filter(first_name='Courtney')
+        try:
+            stats = qs.profile()
+        except ServerError as e:
+            if 'query_log' in e.message:
+                raise unittest.SkipTest('Query log is not available')
+            raise
+        self.assertEqual(stats.result_rows, 2)
+        self.assertGreaterEqual(stats.read_rows, 2)
+        self.assertGreater(stats.read_bytes, 0)
+
     def test_final(self):
         # Final can be used with CollapsingMergeTree/ReplacingMergeTree engines only
         with self.assertRaises(TypeError):
@@ -296,6 +377,35 @@ class QuerySetTestCase(TestCaseWithData):
         for item, exp_color in zip(res, (Color.red, Color.green, Color.white, Color.blue)):
             self.assertEqual(exp_color, item.color)
 
+    def test_sample(self):
+        # Sampling requires a sampling key
+        with self.assertRaises(TypeError):
+            Person.objects_in(self.database).sample(0.1)
+        self.database.create_table(SampledModel)
+        self.database.insert(SampledModel(id=i, value=i % 7) for i in range(10000))
+        qs = SampledModel.objects_in(self.database).filter(value__gt=1)
+        total = qs.count()
+        self.assertTrue(qs.sample(Fraction(1, 2), 0.5).as_sql().endswith('SAMPLE 1/2 OFFSET 0.5\nWHERE value > 1'))
+        # Complementary samples cover the whole table
+        self.assertEqual(qs.sample(0.5).count() + qs.sample(0.5, 0.5).count(), total)
+        sampled = qs.sample(0.1)
+        self.assertTrue(0 < sampled.count() < total / 5)
+        self._test_qs(sampled, sampled.count())
+        self.assertAlmostEqual(sampled.count(scaled=True), total, delta=total * 0.2)
+        self.assertTrue(0 < qs.sample(1000).count() < total)
+        # Scaling aggregates using the _sample_factor virtual column
+        results = {row.value: row.n for row in sampled.aggregate('value', n='sum(_sample_factor)')}
+        self.assertEqual(set(results), {2, 3, 4, 5, 6})
+        for n in results.values():
+            self.assertAlmostEqual(n, total / 5, delta=total * 0.05)
+        # Invalid arguments
+        with self.assertRaises(AssertionError):
+            qs.sample(1.5)
+        with self.assertRaises(AssertionError):
+            qs.sample(1000, 0.5)
+        with self.assertRaises(AssertionError):
+            qs.count(scaled=True)
+
     def test_mixed_filter(self):
         qs = Person.objects_in(self.database)
         qs = qs.filter(Q(first_name='a'), F('greater', Person.height, 1.7), last_name='b')
@@ -314,11 +424,166 @@ class QuerySetTestCase(TestCaseWithData):
         r = ~q & p
         self.assertEqual(r.to_sql(Person), "(NOT (last_name = 'b')) AND (NOT (first_name = 'a'))")
 
+    def test_immutable_conditions(self):
+        values = ['Courtney', 'Cassady']
+        qs1 = Person.objects_in(self.database).filter(first_name__in=values)
+        sql = qs1.conditions_as_sql()
+        values.append('Connor')
+        qs2 = qs1.filter(last_name='b')
+        qs3 = qs1.exclude(height__gt=1.7)
+        # The original queryset and its conditions are not affected
+        self.assertEqual(qs1.conditions_as_sql(), sql)
+        self.assertEqual(qs2.conditions_as_sql(), "(%s) AND (last_name = 'b')" % sql)
+        self.assertEqual(qs3.conditions_as_sql(), "(%s) AND (NOT (height > 1.7))" % sql)
+        # Existing conditions are shared instead of being copied
+        self.assertIs(qs2._where_q._children[0], qs1._where_q._children[0])
+        self.assertIs(qs3._where_q._children[0], qs1._where_q._children[0])
+        self._test_qs(qs1, 4)
+
     def test_invalid_filter(self):
         qs = Person.objects_in(self.database)
         with self.assertRaises(TypeError):
             qs.filter('foo')
 
+    def test_prepared_query(self):
+        qs = Person.objects_in(self.database)
+        query = qs.filter(first_name=Param('name'), height__gt=Param('height')).prepare()
+        self.assertEqual(query.as_sql(), qs.filter(first_name='x', height__gt=1.5).as_sql()
+                         .replace("'x'", '{name:String}').replace('1.5', '{height:Float32}'))
+        self.assertEqual(query.count(name='Courtney', height=1.5), 2)
+        self.assertEqual([p.first_name for p in query.execute(name='Courtney', height=1.5)], ['Courtney'] * 2)
+        self.assertEqual(query.count(name="Cou'rtney\\", height=1.5), 0)
+        self.assertEqual(query.count(name='Courtney', height=2), 0)
+        with self.assertRaises(DatabaseException):
+            query.count(name='Courtney')
+
+    def test_prepared_query_operators(self):
+        qs = Person.objects_in(self.database)
+        def count(**kwargs):
+            return qs.filter(**kwargs).count()
+        def prepared_count(**kwargs):
+            params = {}
+            for key, value in kwargs.items():
+                if isinstance(value, tuple):
+                    params.update({key + '0': value[0], key + '1': value[1]})
+                    kwargs[key] = (Param(key + '0'), Param(key + '1'))
+                else:
+                    params[key] = value
+                    kwargs[key] = Param(key)
+            return qs.filter(**kwargs).prepare().count(**params)
+        for kwargs in [dict(first_name__in=['Courtney', 'Cassady']),
+                       dict(first_name__not_in=['Courtney', 'Cassady']),
+                       dict(first_name__contains='ass'),
+                       dict(first_name__istartswith='CA'),
+                       dict(first_name__iendswith='Y'),
+                       dict(first_name__contains='%'),
+                       dict(first_name__iexact='courtney'),
+                       dict(birthday__between=('1970-01-01', '1980-01-01')),
+                       dict(birthday__gte=date(1980, 1, 1)),
+                       dict(last_name__lt='M')]:
+            self.assertEqual(prepared_count(**kwargs), count(**kwargs), kwargs)
+
+    def test_prepared_query_with_functions(self):
+        qs = Person.objects_in(self.database)
+        query = qs.filter(F.greater(F.length(Person.first_name), Param('length', 'UInt8'))).prepare()
+        self.assertEqual(query.count(length=8), qs.filter(F.greater(F.length(Person.first_name), 8)).count())
+        with self.assertRaises(AssertionError):
+            qs.filter(F.greater(F.length(Person.first_name), Param('length'))).prepare()
+
+    def test_prepared_aggregate_query(self):
+        qs = Person.objects_in(self.database).aggregate('first_name', num='count()')
+        query = qs.filter(first_name__startswith=Param('prefix')).prepare()
+        results = {row.first_name: row.num for row in query.execute(prefix='Cass')}
+        self.assertEqual(results, {row.first_name: row.num for row in qs.filter(first_name__startswith='Cass')})
+        self.assertTrue(results)
+
+    def _check_insert_into(self, qs, **kwargs):
+        self.database.create_table(PersonCopy)
+        try:
+            progress = []
+            qs.insert_into(PersonCopy, progress=lambda *args: progress.append(args), **kwargs)
+            copies = sorted((p.first_name, p.birthday) for p in PersonCopy.objects_in(self.database))
+            self.assertEqual(copies, sorted((p.first_name, p.birthday) for p in qs))
+            self.assertTrue(all(p.copied for p in PersonCopy.objects_in(self.database)))
+            return progress
+        finally:
+            self.database.drop_table(PersonCopy)
+
+    def test_insert_into_by_partition(self):
+        qs = Person.objects_in(self.database).filter(height__gt=1.7)
+        progress = self._check_insert_into(qs, workers=3)
+        partitions = self.database.raw("SELECT uniqExact(_partition_id) FROM $db.person")
+        self.assertEqual(len(progress), int(partitions))
+        self.assertEqual(progress[-1], (len(progress), len(progress)))
+
+    def test_insert_into_by_key(self):
+        qs = Person.objects_in(self.database).filter(first_name__gt='C')
+        progress = self._check_insert_into(qs, workers=2, by_partition=False, key='birthday', chunks=5)
+        self.assertTrue(5 <= len(progress) <= 6)
+        self.assertEqual(self._check_insert_into(qs, by_partition=False), [(1, 1)])
+
+    def test_insert_into_by_float_key(self):
+        # Rows whose key is NaN are not in any of the ranges, but are copied too
+        self.database.insert([Person(first_name='Nan', last_name='Nan', birthday='2000-01-01', height=float('nan'))])
+        qs = Person.objects_in(self.database)
+        progress = self._check_insert_into(qs, by_partition=False, key='height', chunks=4)
+        self.assertEqual(len(progress), 5)
+
+    def test_insert_into_retries(self):
+        raw = self.database.raw
+        calls = []
+        def failing_raw(sql, *args, **kwargs):
+            calls.append(dict(kwargs['settings']))
+            if len(calls) == 1:
+                raise ServerError('Simulated failure')
+            return raw(sql, *args, **kwargs)
+        self.database.raw = failing_raw
+        self._check_insert_into(Person.objects_in(self.database), by_partition=False)
+        self.assertEqual(len(calls), 2)
+        # Each attempt has its own query ID
+        self.assertNotEqual(calls[0]['query_id'], calls[1]['query_id'])
+        del calls[:]
+        self.database.create_table(PersonCopy)
+        with self.assertRaises(ServerError):
+            Person.objects_in(self.database).insert_into(PersonCopy, by_partition=False, retries=0)
+
+    def test_insert_into_timeout(self):
+        from requests.exceptions import ReadTimeout
+        raw = self.database.raw
+        calls = []
+        def failing_raw(sql, *args, **kwargs):
+            calls.append(kwargs['settings']['query_id'])
+            if len(calls) == 1:
+                raise ReadTimeout('Simulated timeout')
+            return raw(sql, *args, **kwargs)
+        self.database.raw = failing_raw
+        killed = []
+        self.database._kill_query = lambda url, query_id, sync=False: killed.append((url, query_id, sync))
+        self._check_insert_into(Person.objects_in(self.database), by_partition=False)
+        # The attempt that timed out is killed before retrying
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(killed, [(self.database.db_url, calls[0], True)])
+
+    def test_insert_into_not_retried(self):
+        calls = []
+        def failing_raw(sql, *args, **kwargs):
+            calls.append(sql)
+            raise DatabaseException('Simulated failure')
+        self.database.raw = failing_raw
+        self.database.create_table(PersonCopy)
+        with self.assertRaises(DatabaseException):
+            Person.objects_in(self.database).insert_into(PersonCopy, by_partition=False)
+        self.assertEqual(len(calls), 1)
+
+    def test_insert_into_not_allowed(self):
+        qs = Person.objects_in(self.database)
+        with self.assertRaises(AssertionError):
+            qs[:10].insert_into(PersonCopy)
+        with self.assertRaises(AssertionError):
+            qs.distinct().insert_into(PersonCopy)
+        with self.assertRaises(NotImplementedError):
+            qs.aggregate('first_name', count='count()').insert_into(PersonCopy)
+
 
 class AggregateTestCase(TestCaseWithData):
 
@@ -467,6 +732,32 @@ class AggregateTestCase(TestCaseWithData):
 
         self.assertEqual(100, result[-1].count)
 
+    def test_aggregate_approximate(self):
+        qs = Person.objects_in(self.database).aggregate(
+            'first_name',
+            names=F.uniqExact(Person.last_name),
+            median=F.quantileExact(0.5)(Person.height),
+            heights=F.quantilesExactIf(0.1, 0.9)(Person.height, cond=Person.height > 1.6),
+            distinct_heights='count(DISTINCT height)',
+            state='finalizeAggregation(uniqExactState(last_name))'
+        )
+        approx_qs = qs.approximate()
+        sql = approx_qs.as_sql()
+        self.assertNotIn('uniqExact(', sql)
+        self.assertNotIn('quantileExact(', sql)
+        self.assertIn('uniq(`last_name`) AS names', sql)
+        self.assertIn('quantile(0.5)(`height`) AS median', sql)
+        self.assertIn('quantilesIf(0.1, 0.9)(', sql)
+        self.assertIn('uniq(height) AS distinct_heights', sql)
+        self.assertIn('uniqExactState(last_name)', sql)
+        # The original queryset is unchanged
+        self.assertIn('uniqExact(`last_name`) AS names', qs.as_sql())
+        # Results are close enough for small sets
+        results = {row.first_name: row for row in qs}
+        for row in approx_qs:
+            self.assertEqual(row.names, results[row.first_name].names)
+            self.assertEqual(row.distinct_heights, results[row.first_name].distinct_heights)
+
     def test_double_underscore_field(self):
         class Mdl(Model):
             the__number = Int32Field()
@@ -507,6 +798,15 @@ class AggregateTestCase(TestCaseWithData):
 Color = Enum('Color', u'red blue green yellow brown white black')
 
 
+class PersonCopy(Model):
+
+    first_name = StringField()
+    birthday = DateField()
+    copied = UInt8Field(default=1)
+
+    engine = MergeTree(partition_key=('tuple()',), order_by=('first_name',))
+
+
 class SampleModel(Model):
 
     timestamp = DateTimeField()
@@ -525,6 +825,14 @@ class SampleCollapsingModel(SampleModel):
     engine = CollapsingMergeTree('materialized_date', ('num',), 'sign')
 
 
+class SampledModel(Model):
+
+    id = UInt64Field()
+    value = UInt32Field()
+
+    engine = MergeTree(partition_key=('tuple()',), order_by=('intHash32(id)',), sampling_expr='intHash32(id)')
+
+
 class Numbers(Model):
 
     number = UInt64Field()
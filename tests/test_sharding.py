@@ -0,0 +1,182 @@
+import unittest
+from datetime import date, datetime
+
+import pytz
+
+from infi.clickhouse_orm.database import Database, DatabaseException
+from infi.clickhouse_orm.engines import Distributed, MergeTree
+from infi.clickhouse_orm.fields import *
+from infi.clickhouse_orm.models import Model, DistributedModel
+from infi.clickhouse_orm.utils import escape
+from infi.clickhouse_orm.sharding import (city_hash64, int_hash64, get_sharding_function, get_shards, run_on_nodes,
+                                          _get_shard_database)
+
+import logging
+logging.getLogger("requests").setLevel(logging.WARNING)
+
+
+class ShardingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.database = Database('test-db', log_statements=True)
+        self.database.create_table(ShardedModel)
+        self.instances = [
+            ShardedModel(id=i, name='name%d' % i, code='c%d' % i, number=i * 7919 - 50000,
+                         day=date(2020, 1, 1 + i % 28), ts=datetime(2020, 1, 1, i % 24, tzinfo=pytz.utc))
+            for i in range(20)
+        ]
+
+    def tearDown(self):
+        self.database.drop_database()
+
+    def _server_value(self, sql):
+        return int(self.database.raw('SELECT %s' % sql))
+
+    def test_city_hash64(self):
+        for length in (0, 1, 3, 4, 8, 9, 16, 17, 32, 33, 64, 65, 128, 129, 1000):
+            s = ''.join(chr(ord('a') + i % 26) for i in range(length))
+            self.assertEqual(city_hash64(s.encode()), self._server_value("cityHash64('%s')" % s))
+
+    def test_int_hash64(self):
+        for value in (0, 1, 255, 2 ** 32 - 1, 2 ** 64 - 1):
+            self.assertEqual(int_hash64(value), self._server_value('intHash64(toUInt64(%d))' % value))
+
+    def _check_sharding_key(self, sharding_key):
+        # Compare to the key computed by the server, as an unsigned integer of the same size
+        func = get_sharding_function(sharding_key, ShardedModel)
+        values = ', '.join('(%d, %s, %s, %d, %s, %s)' % (
+            instance.id, escape(instance.name), escape(instance.code), instance.number,
+            escape(instance.day.isoformat()), escape(instance.ts.strftime('%Y-%m-%d %H:%M:%S')))
+            for instance in self.instances)
+        query = "SELECT reinterpretAsUInt64(%s) AS key FROM values(" \
+                "'id UInt32, name String, code FixedString(4), number Int32, day Date, ts DateTime(\\'UTC\\')', %s)" \
+                % (sharding_key, values)
+        expected = [row.key for row in self.database.select(query)]
+        self.assertEqual([func(instance) for instance in self.instances], expected)
+
+    def test_sharding_key_column(self):
+        self._check_sharding_key('id')
+
+    def test_sharding_key_modulo(self):
+        self._check_sharding_key('id % 3')
+        self._check_sharding_key('number % 7')
+
+    def test_sharding_key_city_hash(self):
+        self._check_sharding_key('cityHash64(name)')
+        self._check_sharding_key('cityHash64(name, id) % 10')
+        self._check_sharding_key('cityHash64(code, number, day, ts)')
+
+    def test_sharding_key_int_hash(self):
+        self._check_sharding_key('intHash64(number)')
+
+    def test_sharding_key_rand(self):
+        func = get_sharding_function('rand()', ShardedModel)
+        values = set(func(None) for i in range(100))
+        self.assertTrue(len(values) > 1)
+        self.assertTrue(all(0 <= v < 2 ** 32 for v in values))
+
+    def test_unsupported_sharding_key(self):
+        for sharding_key in ('sipHash64(name)', 'name', 'unknown', 'id + 1'):
+            with self.assertRaises(ValueError):
+                get_sharding_function(sharding_key, ShardedModel)
+
+    def test_unknown_cluster(self):
+        with self.assertRaises(DatabaseException):
+            get_shards(self.database, 'no_such_cluster')
+
+    def _skip_without_two_shards(self):
+        if not list(self.database.select("SELECT 1 FROM system.clusters WHERE cluster = 'test_cluster_two_shards_localhost'")):
+            raise unittest.SkipTest('The test_cluster_two_shards_localhost cluster is not defined')
+
+    def _record_shard_inserts(self, shard_urls):
+        # Records the ids of the instances inserted through each shard URL
+        inserted = {}
+        for url in shard_urls.values():
+            shard_db = _get_shard_database(self.database, url)
+            def recording_insert(model_instances, batch_size, table_name=None, url=url, insert=shard_db._insert):
+                instances = list(model_instances)
+                inserted[url] = [instance.id for instance in instances]
+                insert(instances, batch_size, table_name)
+            shard_db._insert = recording_insert
+        return inserted
+
+    def test_insert_to_shards(self):
+        self._skip_without_two_shards()
+        self.database.create_table(DistributedShardedModel)
+        # Use a different URL for each shard, to tell apart the rows sent to them
+        shard_urls = {1: 'http://127.0.0.1:8123/', 2: 'http://localhost:8123/'}
+        inserted = self._record_shard_inserts(shard_urls)
+        instances = [DistributedShardedModel(id=i, name='name%d' % i) for i in range(100)]
+        self.database.insert_to_shards(instances, shard_urls=shard_urls)
+        # Both shards are on the same server, so the underlying table contains all the rows
+        self.assertEqual(self.database.count(ShardedModel), 100)
+        # Each row was sent to the shard that ClickHouse selects by evaluating the sharding key
+        shards = get_shards(self.database, 'test_cluster_two_shards_localhost')
+        slots = [shard.shard_num for shard in shards for _ in range(shard.shard_weight)]
+        query = 'SELECT id, cityHash64(name) AS key FROM $db.shardedmodel'
+        expected = {row.id: shard_urls[slots[row.key % len(slots)]] for row in self.database.select(query)}
+        actual = {id: url for url, ids in inserted.items() for id in ids}
+        self.assertEqual(actual, expected)
+        sharding_function = get_sharding_function('cityHash64(name)', ShardedModel)
+        for instance in instances:
+            self.assertEqual(shard_urls[slots[sharding_function(instance) % len(slots)]], actual[instance.id])
+
+    def test_insert_to_shards_failure(self):
+        self._skip_without_two_shards()
+        self.database.create_table(DistributedShardedModel)
+        shard_urls = {1: 'http://127.0.0.1:8123/', 2: 'http://localhost:8123/'}
+        def failing_insert(model_instances, batch_size, table_name=None):
+            raise DatabaseException('Simulated failure')
+        _get_shard_database(self.database, shard_urls[2])._insert = failing_insert
+        instances = [DistributedShardedModel(id=i, name='name%d' % i) for i in range(100)]
+        with self.assertRaises(DatabaseException) as cm:
+            self.database.insert_to_shards(instances, shard_urls=shard_urls)
+        # Only the rows of the first shard were inserted
+        count = self.database.count(ShardedModel)
+        self.assertIn('Failed to insert into 1 of 2 shards: shard 2 (http://localhost:8123/, %d rows)' % (100 - count),
+                      str(cm.exception))
+        self.assertIn('shard 1 (%d rows)' % count, str(cm.exception))
+
+    def test_insert_to_shards_not_distributed(self):
+        with self.assertRaises(TypeError):
+            self.database.insert_to_shards([ShardedModel(id=1)])
+
+    def test_run_on_nodes(self):
+        node_urls = ['http://127.0.0.1:8123/', 'http://localhost:8123/']
+        results = run_on_nodes(self.database, None, lambda db: (db.db_url, db.db_name), node_urls=node_urls)
+        self.assertEqual(results, {url: (url, self.database.db_name) for url in node_urls})
+
+    def test_run_on_nodes_failure(self):
+        node_urls = ['http://127.0.0.1:8123/', 'http://localhost:8123/']
+        def func(db):
+            if 'localhost' in db.db_url:
+                db.raw('SELECT no_such_function()')
+        with self.assertRaises(DatabaseException) as cm:
+            run_on_nodes(self.database, None, func, node_urls=node_urls)
+        self.assertIn('Failed on 1 of 2 nodes: http://localhost:8123/', str(cm.exception))
+
+    def test_run_on_nodes_timeout(self):
+        with self.assertRaises(DatabaseException):
+            run_on_nodes(self.database, None, lambda db: db.raw('SELECT sleep(1)'), timeout=0.1,
+                         node_urls=['http://127.0.0.1:8123/'])
+
+    def test_run_on_unknown_cluster(self):
+        with self.assertRaises(DatabaseException):
+            run_on_nodes(self.database, 'no_such_cluster', lambda db: None)
+
+
+class ShardedModel(Model):
+
+    id = UInt32Field()
+    name = StringField()
+    code = FixedStringField(4)
+    number = Int32Field()
+    day = DateField()
+    ts = DateTimeField()
+
+    engine = MergeTree('day', ('id',))
+
+
+class DistributedShardedModel(DistributedModel, ShardedModel):
+
+    engine = Distributed('test_cluster_two_shards_localhost', ShardedModel, sharding_key='cityHash64(name)')
@@ -1,6 +1,6 @@
 import unittest
 from infi.clickhouse_orm.fields import *
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import pytz
 
 
@@ -97,6 +97,33 @@ class SimpleFieldsTest(unittest.TestCase):
         ):
             self.assertEqual(f.to_python(value, pytz.utc), utc_value)
 
+    def test_datetime_field_localization(self):
+        # Verify that the memoized localization agrees with pytz, including around
+        # daylight saving transitions that happen in the middle of an hour
+        f = DateTime64Field()
+        for tz_name in ('Asia/Jerusalem', 'America/St_Johns', 'Australia/Lord_Howe'):
+            tz = pytz.timezone(tz_name)
+            transitions = [pytz.utc.localize(t).astimezone(tz).replace(tzinfo=None)
+                           for t in tz._utc_transition_times if t.year == 2020]
+            self.assertTrue(transitions)
+            for transition in transitions:
+                for minutes in range(-180, 180):
+                    naive = transition + timedelta(minutes=minutes, microseconds=minutes + 180)
+                    value = naive.strftime('%Y-%m-%d %H:%M:%S.%f')
+                    self.assertEqual(f.to_python(value, tz).utcoffset(), tz.localize(naive).utcoffset(), value)
+
+    def test_datetime_field_clickhouse_layout(self):
+        f = DateTime64Field()
+        tz = pytz.timezone('Europe/Moscow')
+        expected = tz.localize(datetime(2020, 1, 31, 23, 59, 59, 123456))
+        for value in ('2020-01-31 23:59:59.123456', '2020-01-31 23:59:59.123456789', '2020-01-31T23:59:59.1234567'):
+            self.assertEqual(f.to_python(value, tz), expected)
+        self.assertEqual(f.to_python('2020-01-31 23:59:59.1', tz), expected.replace(microsecond=100000))
+        self.assertEqual(DateTimeField().to_python('2020-01-31 23:59:59', tz), expected.replace(microsecond=0))
+        for value in ('2020-01-31 23:59:59.', '2020-01-31 23:59:59.12a', '2020-02-30 23:59:59', '2020-01-31 24:59:59'):
+            with self.assertRaises(ValueError):
+                f.to_python(value, tz)
+
     def test_uint8_field(self):
         f = UInt8Field()
         # Valid values
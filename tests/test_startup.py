@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import subprocess
+import unittest
+from logging import getLogger
+
+logger = getLogger('tests')
+
+
+class StartupTestCase(unittest.TestCase):
+
+    def _import(self, code):
+        # Runs the code in a new interpreter with "-X importtime", and returns the modules
+        # imported after the "infi" namespace, along with their cumulative import times
+        # in microseconds (modules imported via importlib have no timing)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        code = 'import infi, sys; before = set(sys.modules); sys.stderr.write("---\\n"); %s; ' \
+               'print("\\n".join(set(sys.modules) - before))' % code
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        times = dict.fromkeys(result.stdout.split())
+        for line in result.stderr.split('---\n', 1)[1].splitlines():
+            if line.startswith('import time:') and '|' in line:
+                self_time, cumulative, name = line[12:].split('|')
+                if cumulative.strip().isdigit():
+                    times[name.strip()] = int(cumulative)
+        return times
+
+    def test_import_time(self):
+        times = self._import('import infi.clickhouse_orm')
+        logger.info('Importing infi.clickhouse_orm took %.1f ms', times['infi.clickhouse_orm'] / 1000.0)
+        # Libraries that are only needed when connecting to a database or parsing values
+        for name in ['requests', 'iso8601', 'infi.clickhouse_orm.migrations']:
+            self.assertNotIn(name, times)
+
+    def test_lazy_migrations(self):
+        times = self._import('from infi.clickhouse_orm import CreateTable')
+        self.assertIn('infi.clickhouse_orm.migrations', times)